@@ -1,36 +1,140 @@
-import requests
+import asyncio
+import hmac
 import json
 import os
-from typing import List, Dict
-from mcp.server.fastmcp import FastMCP
+import threading
+import time
+import anyio
+import uvicorn
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import List, Dict, Union
+from mcp.server.fastmcp import Context, FastMCP
+from mcp.types import TextContent
 from dotenv import load_dotenv
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+import attachments
+import blobs
+import claude_client
+import conversations
+import deadlines
+import metrics
+import model_catalog
+import model_router
+import rate_limiter
+import retry
+import response_cache
+import scheduler
+import singleflight
+import state_backend
+import tracing
+import usage_ledger
 
 load_dotenv()
 
 # Get port from environment variable (Railway sets this, defaults to 8080 for local dev)
 PORT = int(os.environ.get("PORT", 8080))
 
-# Initialize FastMCP server with host and port in constructor
-mcp = FastMCP("claude", host="0.0.0.0", port=PORT)
+# MCP transport served over HTTP: "sse", "streamable-http" or "both"
+MCP_TRANSPORT = os.environ.get("MCP_TRANSPORT", "sse").lower()
+
+# Initialize FastMCP server with host and port in constructor.
+# In stateless mode every Streamable HTTP request is self-contained (no session
+# kept in memory), so any worker or replica can answer it.
+mcp = FastMCP(
+    "claude",
+    host="0.0.0.0",
+    port=PORT,
+    stateless_http=os.environ.get("MCP_STATELESS_HTTP", "true").lower() in ("1", "true", "yes"),
+    json_response=os.environ.get("MCP_JSON_RESPONSE", "false").lower() in ("1", "true", "yes"),
+)
 
 # Get API key from environment
 anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
 
+# Minimum seconds between streaming notifications sent to the MCP client
+STREAM_FLUSH_INTERVAL = float(os.environ.get("CLAUDE_STREAM_FLUSH_INTERVAL", 0.05))
+
+# Response cache for repeated requests (None when disabled with CLAUDE_CACHE_ENABLED=false)
+cache = response_cache.cache_from_env()
+
+# Concurrency for call_claude_batch: default per call and hard cap
+BATCH_CONCURRENCY = int(os.environ.get("CLAUDE_BATCH_CONCURRENCY", 8))
+BATCH_MAX_CONCURRENCY = int(os.environ.get("CLAUDE_BATCH_MAX_CONCURRENCY", 32))
+BATCH_MAX_ITEMS = int(os.environ.get("CLAUDE_BATCH_MAX_ITEMS", 100))
+
+# Per-model client-side rate limiting with adaptive concurrency
+governor = rate_limiter.governor_from_env()
+# Priority classes and per-client fair queuing in front of the governor, sized by its adaptive limit
+call_scheduler = scheduler.scheduler_from_env(governor.capacity)
+
+# Retries with jittered backoff and optional hedging for short prompts
+retry_policy = retry.policy_from_env()
+
+# Identical concurrent requests share one upstream call (CLAUDE_COALESCE_ENABLED=false disables it)
+coalescer = singleflight.SingleFlight() if os.environ.get("CLAUDE_COALESCE_ENABLED", "true").lower() not in ("0", "false", "no") else None
+
+# Anthropic prompt caching: "auto" marks stable prefixes (system prompt, context blocks) with cache_control
+PROMPT_CACHE = os.environ.get("CLAUDE_PROMPT_CACHE", "auto").lower() not in ("0", "off", "false", "no")
+# Prefixes shorter than this (estimated tokens) are not worth a cache write; the API minimum is 1024
+PROMPT_CACHE_MIN_TOKENS = int(os.environ.get("CLAUDE_PROMPT_CACHE_MIN_TOKENS", 1024))
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# Multi-turn conversations held server-side (LRU in memory, optional SQLite spill)
+conversation_store = conversations.store_from_env()
+
+# Token/cost ledger with per-client budgets (None when disabled with CLAUDE_USAGE_ENABLED=false)
+ledger = usage_ledger.ledger_from_env()
+# Bearer token that lets get_claude_usage query other clients' usage; client ids are self-declared, so they can't grant it
+USAGE_ADMIN_TOKEN = os.environ.get("CLAUDE_USAGE_ADMIN_TOKEN", "")
+
+# Models available upstream, downloaded once and refreshed in the background
+catalog = model_catalog.catalog_from_env(anthropic_api_key)
+
+# auto:fast / auto:quality routing, sibling fallback and per-model circuit breakers
+router = model_router.router_from_env(catalog)
+
+# Large prompts uploaded once and sent by reference, and long outputs returned as paged links
+blob_store = blobs.store_from_env()
+# Images and PDFs are kept in the blob store too, already base64-encoded
+attachment_store = attachments.AttachmentStore(blob_store)
+# Outputs longer than this (characters) are stored as a blob and returned as their first page plus a link (0 = never)
+OUTPUT_INLINE_MAX_CHARS = int(os.environ.get("CLAUDE_OUTPUT_INLINE_MAX_CHARS", 65536))
+
+# Per-call traces split into phases, slow-call log and OTLP export
+tracer = tracing.tracer_from_env()
+# Sampling profiler behind GET /debug/profile, created (and imported) on the first request
+PROFILER_ENABLED = os.environ.get("CLAUDE_PROFILER_ENABLED", "false").lower() in ("1", "true", "yes")
+# Bearer token the endpoint requires; without one an enabled profiler refuses every request
+PROFILER_TOKEN = os.environ.get("CLAUDE_PROFILER_TOKEN", "")
+sampler = None
+
+# State shared by every replica and worker: response cache, rate limits, budgets and conversations
+state = state_backend.backend_from_env()
+STATE_SYNC_INTERVAL = state_backend.sync_interval_from_env()
+if state.shared:
+    if cache is not None:
+        cache.shared = state
+    governor.attach(state, STATE_SYNC_INTERVAL)
+    if ledger is not None:
+        ledger.attach(state, STATE_SYNC_INTERVAL)
+    conversation_store.shared = state
+
 def call_claude_api(model: str, prompt: str, max_tokens: int = 1024) -> str:
-    """Llama a la API de Claude con el modelo especificado"""
-    try:
-        response = requests.post(
-            "https://api.anthropic.com/v1/messages",
-            headers={
-                "Content-Type": "application/json",
-                "x-api-key": anthropic_api_key,
-                "anthropic-version": "2023-06-01",
-            },
+    """Llama a la API de Claude con el modelo especificado (versión síncrona, para scripts)"""
+    try:
+        timeout = claude_client.get_timeout()
+        response = claude_client.get_sync_session().post(
+            claude_client.get_api_url(),
+            headers=claude_client.build_headers(anthropic_api_key),
             json={
                 "model": model,
                 "messages": [{"role": "user", "content": prompt}],
                 "max_tokens": max_tokens,
             },
+            timeout=(timeout.connect, timeout.read),
         )
 
         if response.status_code != 200:
@@ -38,64 +142,936 @@ def call_claude_api(model: str, prompt: str, max_tokens: int = 1024) -> str:
             raise Exception(f"Anthropic API error: {json.dumps(error_data)}")
 
         data = response.json()
-        return data["content"][0]["text"]
+        return response_text(data)
+
+    except Exception as e:
+        raise Exception(f"Failed to call Claude: {str(e)}")
+
+async def send_message(
+    payload: Dict,
+    on_text=None,
+    use_cache: bool = True,
+    tool: str = "call_claude",
+    caller: usage_ledger.Caller = None,
+) -> Dict:
+    """
+    Envía una petición a la API de mensajes pasando por la caché de respuestas
+    y la coalescencia de peticiones en vuelo.
+
+    El modelo pasa por el enrutador: los alias se resuelven con el catálogo,
+    auto:fast y auto:quality eligen un modelo según latencia y errores
+    recientes, y ante un 529, un 5xx o un timeout la llamada pasa al siguiente
+    modelo del plan (mientras no se haya enviado texto parcial). Si se pasa
+    `on_text`, la respuesta se pide en modo streaming y el callback recibe cada
+    fragmento de texto a medida que llega (o el texto completo de una sola vez
+    si la respuesta viene de la caché). `tool` etiqueta las métricas de
+    latencia con la herramienta que hizo la llamada y `caller` indica a quién
+    se atribuye el uso en el registro de tokens.
+
+    Raises:
+        usage_ledger.BudgetExceeded: si el cliente o la sesión agotaron su presupuesto
+        model_catalog.UnknownModel: si el modelo no existe
+        model_router.CircuitOpen: si todos los modelos del plan están degradados
+    """
+    caller = caller or usage_ledger.Caller()
+    if ledger is not None:
+        with tracing.span("budget.check"):
+            await ledger.check_async(caller)
+
+    await catalog.ensure_loaded()
+    requested = payload["model"]
+    plan = router.plan(requested)
+
+    # Falling back to another model is only safe while no partial text reached the client
+    streamed = {"text": False}
+    relay = None
+    if on_text is not None:
+        async def relay(text: str):
+            streamed["text"] = True
+            await on_text(text)
+
+    skipped = []
+    error = None
+    for index, model in enumerate(plan):
+        last = index == len(plan) - 1
+        if not last and governor.paused_for(model):
+            # Waiting out the model's Retry-After pause is slower than going to the next model
+            skipped.append(model)
+            continue
+        if not router.allow(model):
+            skipped.append(model)
+            error = error or model_router.CircuitOpen(model, router.retry_in(model))
+            continue
+        try:
+            with metrics.requests_in_flight.track(tool=tool), metrics.request_duration.time(tool=tool, model=model):
+                data = await _send_message(
+                    {**payload, "model": model}, relay, use_cache, tool, caller,
+                    give_up=None if last else model_router.is_failure,
+                )
+        except Exception as e:
+            if last or streamed["text"] or not model_router.is_failure(e):
+                raise
+            skipped.append(model)
+            error = e
+            continue
+
+        if skipped:
+            router.record_fallback(skipped[0], model)
+        if model != requested:
+            data = {**data, "routing": {"requested": requested, "model": model, "skipped": skipped}}
+        return data
+    raise error
+
+async def _send_message(payload: Dict, on_text, use_cache: bool, tool: str, caller: usage_ledger.Caller, give_up=None) -> Dict:
+    model = payload["model"]
+    key = response_cache.make_key(payload)
+    use_cache = cache is not None and use_cache
+    if use_cache:
+        with tracing.span("cache.lookup") as span:
+            data = await cache.fetch(key)
+            span.set_attribute("cache.hit", data is not None)
+        if data is not None:
+            if on_text is not None:
+                await on_text(response_text(data))
+            return data
+
+    stream_response_min_tokens = claude_client.get_stream_response_min_tokens() or float("inf")
+
+    async def upstream(publish):
+        streamed = {"text": False}
+
+        async def relay(text: str):
+            streamed["text"] = True
+            await publish(text)
+
+        async def attempt():
+            with tracing.span("claude.attempt", tracing.CLIENT, model=model):
+                return await send_attempt()
+
+        async def send_attempt():
+            scheduled_trace = time.perf_counter()
+            async with call_scheduler.slot(model, caller.priority, caller.client, caller.session, rate_limiter.estimate_tokens(payload)) as slot:
+                tracing.record("scheduler.queue", scheduled_trace, time.perf_counter(), priority=slot.priority)
+                return await governed_attempt()
+
+        async def governed_attempt():
+            queued_at = time.monotonic()
+            queued_trace = time.perf_counter()
+            async with governor.permit(payload) as permit:
+                sent_at = time.monotonic()
+                metrics.queue_wait.observe(sent_at - queued_at, tool=tool, model=model)
+                tracing.record("rate_limiter.queue", queued_trace, time.perf_counter())
+
+                def on_headers(headers):
+                    metrics.upstream_ttfb.observe(time.monotonic() - sent_at, tool=tool, model=model)
+                    permit.observe_headers(headers)
+
+                try:
+                    # Long answers come as SSE and are decoded event by event instead of as one big JSON body
+                    if on_text is not None or payload.get("max_tokens", 0) >= stream_response_min_tokens:
+                        data = await claude_client.stream_message(anthropic_api_key, payload, relay if on_text is not None else None, on_headers)
+                    else:
+                        data = await claude_client.create_message(anthropic_api_key, payload, on_headers)
+                except claude_client.AnthropicAPIError as e:
+                    metrics.upstream_responses.inc(model=model, status=e.status_code)
+                    router.record(model, time.monotonic() - sent_at, e)
+                    raise
+                except Exception as e:
+                    metrics.upstream_responses.inc(model=model, status="error")
+                    router.record(model, time.monotonic() - sent_at, e)
+                    raise
+                metrics.upstream_responses.inc(model=model, status=200)
+                router.record(model, time.monotonic() - sent_at)
+                metrics.record_usage(model, data.get("usage"))
+                permit.record_usage(data.get("usage"))
+                if ledger is not None:
+                    ledger.record(caller, model, data.get("usage"))
+                return data
+
+        # A streamed answer cannot be retried once partial text reached the client
+        data = await retry_policy.run(
+            attempt,
+            model,
+            prompt_chars=claude_client.payload_chars(payload["messages"]),
+            can_retry=lambda: not streamed["text"],
+            hedge=on_text is None,
+            give_up=give_up,
+        )
+        # use_cache=False (and conversation turns) neither read nor fill the cache
+        if use_cache:
+            cache.set(key, data)
+        return data
+
+    if coalescer is not None:
+        return await coalescer.do(key, upstream, on_text)
+    return await upstream(on_text)
+
+def build_payload(
+    model: str,
+    prompt: str,
+    max_tokens: int = 1024,
+    system: str = "",
+    context: List[str] = None,
+    document: blobs.BlobRef = None,
+    attached: List[attachments.Attachment] = None,
+) -> Dict:
+    """
+    Construye la petición a la API de mensajes.
+
+    `system` se envía como system prompt y cada bloque de `context` como un
+    bloque de texto antes del prompt en el mensaje del usuario. `document` es
+    un texto subido como blob: va como último bloque de contexto y se lee del
+    disco al enviar la petición. Los adjuntos (`attached`: imágenes, PDF,
+    documentos de texto) van después, antes del prompt, como recomienda la
+    API. Con CLAUDE_PROMPT_CACHE=auto, el system prompt y el final del
+    contexto y los adjuntos se marcan con cache_control cuando el
+    prefijo que cierran es lo bastante largo, para que las llamadas que lo
+    repiten lo lean de la caché de Anthropic.
+    """
+    payload = {"model": model, "max_tokens": max_tokens}
+    # Same ~4 characters per token estimate used by the rate governor
+    prefix_tokens = 0
+
+    if system:
+        prefix_tokens += len(system) // 4
+        block = {"type": "text", "text": system}
+        if PROMPT_CACHE and prefix_tokens >= PROMPT_CACHE_MIN_TOKENS:
+            block["cache_control"] = CACHE_CONTROL
+        payload["system"] = [block]
+
+    context = list(context or []) + ([document] if document is not None else [])
+    blocks = [{"type": "text", "text": text} for text in context]
+    blocks += [attachment.block() for attachment in attached or []]
+    if blocks:
+        prefix_tokens += claude_client.payload_chars(blocks) // 4
+        if PROMPT_CACHE and prefix_tokens >= PROMPT_CACHE_MIN_TOKENS:
+            blocks[-1]["cache_control"] = CACHE_CONTROL
+        content = blocks + ([{"type": "text", "text": prompt}] if prompt else [])
+    else:
+        content = prompt
+
+    payload["messages"] = [{"role": "user", "content": content}]
+    return payload
+
+def build_conversation_payload(conversation: conversations.Conversation, prompt: str) -> Dict:
+    """
+    Construye la petición del siguiente turno de una conversación.
+
+    El system prompt y el contexto van como bloques de system y el historial
+    como mensajes. Con CLAUDE_PROMPT_CACHE=auto se marcan con cache_control el
+    final del system y los dos últimos mensajes del usuario: cada turno lee de
+    la caché el prefijo que ya se envió en el anterior y solo paga por lo nuevo.
+    """
+    payload = {"model": conversation.model, "max_tokens": conversation.max_tokens}
+
+    texts = ([conversation.system] if conversation.system else []) + conversation.context
+    system_blocks = [{"type": "text", "text": text} for text in texts]
+    prefix_tokens = sum(len(text) for text in texts) // 4
+    if system_blocks:
+        if PROMPT_CACHE and prefix_tokens >= PROMPT_CACHE_MIN_TOKENS:
+            system_blocks[-1]["cache_control"] = CACHE_CONTROL
+        payload["system"] = system_blocks
+
+    messages = [{"role": role, "content": [{"type": "text", "text": text}]} for role, text in conversation.messages]
+    messages.append({"role": "user", "content": [{"type": "text", "text": prompt}]})
+    if PROMPT_CACHE and prefix_tokens + (conversation.chars + len(prompt)) // 4 >= PROMPT_CACHE_MIN_TOKENS:
+        # The previous user turn is where last turn's cache entry ends; the new one starts the next entry
+        for message in [m for m in messages if m["role"] == "user"][-2:]:
+            message["content"][-1]["cache_control"] = CACHE_CONTROL
+
+    payload["messages"] = messages
+    return payload
+
+async def call_claude_message_async(
+    model: str,
+    prompt: str,
+    max_tokens: int = 1024,
+    on_text=None,
+    use_cache: bool = True,
+    tool: str = "call_claude",
+    caller: usage_ledger.Caller = None,
+    system: str = "",
+    context: List[str] = None,
+    document: blobs.BlobRef = None,
+    attached: List[attachments.Attachment] = None,
+) -> Dict:
+    """Llama a la API de Claude y retorna la respuesta completa (contenido y usage)"""
+    try:
+        payload = build_payload(model, prompt, max_tokens, system, context, document, attached)
+        return await send_message(payload, on_text, use_cache, tool, caller)
 
     except Exception as e:
         raise Exception(f"Failed to call Claude: {str(e)}")
 
+async def call_claude_api_async(
+    model: str,
+    prompt: str,
+    max_tokens: int = 1024,
+    on_text=None,
+    use_cache: bool = True,
+    tool: str = "call_claude",
+    caller: usage_ledger.Caller = None,
+    system: str = "",
+    context: List[str] = None,
+    document: blobs.BlobRef = None,
+    attached: List[attachments.Attachment] = None,
+) -> str:
+    """Llama a la API de Claude sin bloquear el event loop, usando el cliente HTTP compartido"""
+    data = await call_claude_message_async(model, prompt, max_tokens, on_text, use_cache, tool, caller, system, context, document, attached)
+    return response_text(data)
+
+def response_text(data: Dict) -> str:
+    """Texto de la respuesta: todos los bloques de texto, en orden (con citas la API parte el texto en varios)"""
+    return "".join(block.get("text", "") for block in data.get("content", []) if block.get("type") == "text")
+
+def response_contents(data: Dict, text: str, meta: Dict) -> List[TextContent]:
+    """
+    Contenido del resultado de una herramienta: el texto con los metadatos y,
+    detrás, un elemento por cada bloque que no es texto (tool_use, thinking...)
+    con el bloque en JSON y su tipo en `_meta.block_type`
+    """
+    contents = [TextContent(type="text", text=text, _meta=meta)]
+    for block in data.get("content", []):
+        if block.get("type") != "text":
+            contents.append(TextContent(type="text", text=json.dumps(block, ensure_ascii=False), _meta={"block_type": block.get("type")}))
+    return contents
+
+def usage_meta(data: Dict) -> Dict:
+    """
+    Metadatos de uso de una respuesta para el resultado de la herramienta (tokens de caché incluidos,
+    y el modelo pedido y los descartados si el enrutador eligió otro)
+    """
+    usage = data.get("usage") or {}
+    meta = {
+        "model": data.get("model"),
+        "usage": {
+            "input_tokens": usage.get("input_tokens", 0),
+            "output_tokens": usage.get("output_tokens", 0),
+            "cache_creation_input_tokens": usage.get("cache_creation_input_tokens") or 0,
+            "cache_read_input_tokens": usage.get("cache_read_input_tokens") or 0,
+        },
+    }
+    if "routing" in data:
+        meta["routing"] = data["routing"]
+    return meta
+
+def page_note(page: Dict) -> str:
+    """Nota al final de una página de un blob indicando cómo leer la siguiente"""
+    if page["page"] >= page["pages"]:
+        return ""
+    return (
+        f"\n\n[Página {page['page']} de {page['pages']} de {page['uri']} ({page['bytes']} bytes). "
+        f"Lee la siguiente con read_claude_blob(blob_id=\"{page['blob_id']}\", page={page['page'] + 1})]"
+    )
+
+async def link_long_output(text: str, meta: Dict) -> str:
+    """
+    Retorna `text` tal cual si es corto. Si supera CLAUDE_OUTPUT_INLINE_MAX_CHARS
+    lo guarda como blob (en un hilo, fuera del event loop) y retorna solo su
+    primera página con una nota para leer el resto; el enlace (uri, bytes,
+    páginas) queda en meta["output"].
+    """
+    if not OUTPUT_INLINE_MAX_CHARS or len(text) <= OUTPUT_INLINE_MAX_CHARS:
+        return text
+    info = await asyncio.to_thread(blob_store.write_text, text)
+    page = await asyncio.to_thread(blob_store.page, info["blob_id"], 1)
+    meta["output"] = {"blob_id": info["blob_id"], "uri": info["uri"], "chars": len(text), "bytes": info["bytes"], "pages": info["pages"]}
+    return page["text"] + page_note(page)
+
+def get_caller(ctx: Context, priority: str = "") -> usage_ledger.Caller:
+    """
+    Identifica al cliente y la sesión MCP de la petición actual.
+
+    El cliente es el client_id de la petición, la cabecera X-Client-Id o el
+    nombre que el cliente envió en initialize; la sesión es el session_id de
+    SSE o la cabecera mcp-session-id de Streamable HTTP. `priority` es la
+    clase con la que el planificador encola sus llamadas.
+    """
+    priority = scheduler.check_priority(priority)
+    if ctx is None:
+        return usage_ledger.Caller(priority=priority)
+    try:
+        request_context = ctx.request_context
+    except ValueError:
+        return usage_ledger.Caller(priority=priority)
+
+    client = ctx.client_id
+    session = ""
+    request = request_context.request
+    if request is not None:
+        client = client or request.headers.get("x-client-id")
+        session = request.query_params.get("session_id") or request.headers.get("mcp-session-id") or ""
+    client_params = getattr(request_context.session, "client_params", None)
+    if not client and client_params is not None:
+        client = client_params.clientInfo.name
+    return usage_ledger.Caller(client, session, priority)
+
+def is_usage_admin(ctx: Context) -> bool:
+    """Indica si la petición trae `Authorization: Bearer <CLAUDE_USAGE_ADMIN_TOKEN>` (nunca sin token configurado)"""
+    if not USAGE_ADMIN_TOKEN or ctx is None:
+        return False
+    try:
+        request = ctx.request_context.request
+    except ValueError:
+        return False
+    if request is None:
+        return False
+    return hmac.compare_digest(request.headers.get("authorization", "").encode(), f"Bearer {USAGE_ADMIN_TOKEN}".encode())
+
+def make_stream_relay(ctx: Context):
+    """
+    Crea un callback que reenvía el texto parcial al cliente MCP.
+
+    Usa notificaciones de progreso si el cliente envió un progressToken y
+    mensajes de log en caso contrario. Los fragmentos se agrupan para no
+    enviar más de una notificación cada STREAM_FLUSH_INTERVAL segundos.
+    """
+    try:
+        meta = ctx.request_context.meta
+    except ValueError:
+        # Outside an MCP request there is no client to notify
+        return None
+
+    loop = asyncio.get_running_loop()
+    state = {"buffer": "", "chars": 0, "last_flush": 0.0}
+    use_progress = meta is not None and meta.progressToken is not None
+
+    async def flush():
+        if not state["buffer"]:
+            return
+        text, state["buffer"] = state["buffer"], ""
+        state["last_flush"] = loop.time()
+        if use_progress:
+            await ctx.report_progress(state["chars"], message=text)
+        else:
+            await ctx.info(text)
+
+    async def on_text(text: str):
+        state["buffer"] += text
+        state["chars"] += len(text)
+        if loop.time() - state["last_flush"] >= STREAM_FLUSH_INTERVAL:
+            await flush()
+
+    on_text.flush = flush
+    return on_text
+
 @mcp.tool()
-def call_claude(model: str, prompt: str, max_tokens: int = 1024) -> str:
+@tracer.tool
+async def call_claude(
+    model: str,
+    prompt: str = "",
+    max_tokens: int = 1024,
+    stream: bool = False,
+    use_cache: bool = True,
+    system: str = "",
+    context: List[str] = None,
+    timeout_s: float = 0,
+    prompt_ref: str = "",
+    attachments: List[Union[str, Dict]] = None,
+    priority: str = "interactive",
+    ctx: Context = None,
+) -> List[TextContent]:
     """
     Llama a Claude con el modelo especificado y retorna la respuesta.
 
     Args:
-        model: El modelo de Claude a utilizar (ej: claude-3-5-sonnet-20241022)
-        prompt: El prompt a enviar al modelo
+        model: El modelo de Claude a utilizar: un id de get_claude_models, un alias como "latest sonnet" u "opus 4",
+               o "auto:fast" / "auto:quality" para que el servidor elija según latencia y errores recientes
+        prompt: El prompt a enviar al modelo (obligatorio salvo que se use prompt_ref)
         max_tokens: Máximo número de tokens en la respuesta (opcional, default: 1024)
+        stream: Si es true, envía el texto parcial como notificaciones de progreso mientras se genera (opcional, default: false)
+        use_cache: Si es false, ignora la caché de respuestas y llama siempre a la API (opcional, default: true)
+        system: System prompt (opcional). Si es largo y se repite entre llamadas se reutiliza desde la caché de prompts de Anthropic
+        context: Bloques de contexto reutilizables (documentos, instrucciones) que se envían antes del prompt (opcional)
+        timeout_s: Plazo total de la llamada en segundos, incluidas colas y reintentos; al vencer se aborta la petición
+                   a Anthropic (opcional, default del servidor)
+        prompt_ref: Texto grande subido antes con upload_claude_blob o POST /blobs (blob_id o claude://blobs/{blob_id}),
+                    también una respuesta larga anterior. Se envía antes de `prompt`, que hace de instrucción (opcional)
+        attachments: Imágenes (JPEG, PNG, GIF, WebP) y documentos (PDF o texto) que se envían antes del prompt (opcional).
+                     Cada uno es una URI ya subida ("claude://attachments/{id}", o "claude://blobs/{id}" para un texto),
+                     un ImageContent de MCP {"type": "image", "data": base64, "mimeType"}, un EmbeddedResource
+                     {"type": "resource", "resource": {"uri", "mimeType", "blob" | "text"}}, o {"data": base64} / {"text", "title"}.
+                     Los adjuntos en base64 se guardan y `_meta.attachments` retorna su URI para reutilizarlos sin reenviarlos
+        priority: "interactive" o "bulk": con el servidor saturado, las llamadas interactive pasan antes que las bulk
+                  (opcional, default: interactive; la configuración del cliente puede rebajarla a bulk)
 
     Returns:
-        Respuesta de Claude como string
+        Respuesta de Claude como texto. Si es más larga que CLAUDE_OUTPUT_INLINE_MAX_CHARS se retorna su primera
+        página y `_meta.output` enlaza el resto (leer con read_claude_blob). `_meta.usage` incluye los tokens
+        leídos y escritos en la caché de prompts. Los bloques de la respuesta que no son texto (tool_use, thinking)
+        siguen como elementos aparte, en JSON
     """
     try:
         if not anthropic_api_key:
             return "Error: ANTHROPIC_API_KEY no está configurada"
-        
-        result = call_claude_api(model, prompt, max_tokens)
-        return result
+        if not prompt and not prompt_ref and not attachments:
+            return "Error: indica el prompt, un prompt_ref o algún adjunto"
+        caller = get_caller(ctx, priority)
+        document = blob_store.ref(prompt_ref) if prompt_ref else None
+        # Validating, hashing and writing base64 of several MB is kept off the event loop
+        attached = await asyncio.to_thread(attachment_store.resolve_all, attachments) if attachments else []
+
+        on_text = make_stream_relay(ctx) if stream and ctx is not None else None
+        data = await deadlines.run(
+            lambda: call_claude_message_async(
+                model, prompt, max_tokens, on_text, use_cache, caller=caller, system=system, context=context,
+                document=document, attached=attached,
+            ),
+            deadlines.timeout_for(timeout_s),
+            deadlines.disconnect_event(ctx),
+        )
+        if on_text is not None:
+            await on_text.flush()
+        meta = usage_meta(data)
+        if attached:
+            meta["attachments"] = [attachment.info() for attachment in attached]
+        text = await link_long_output(response_text(data), meta)
+        return response_contents(data, text, meta)
         
     except Exception as e:
         return f"Error llamando a Claude: {str(e)}"
 
 @mcp.tool()
+@tracer.tool
+async def call_claude_batch(
+    items: List[Dict],
+    concurrency: int = 0,
+    use_cache: bool = True,
+    timeout_s: float = 0,
+    priority: str = "bulk",
+    ctx: Context = None,
+) -> str:
+    """
+    Llama a Claude con varios prompts en paralelo y retorna las respuestas en orden.
+
+    Args:
+        items: Lista de objetos {"model": str, "prompt": str, "max_tokens": int (opcional, default: 1024),
+               "system": str (opcional), "context": [str] (opcional), "prompt_ref": str y "attachments": [...] (opcionales,
+               como en call_claude)}
+        concurrency: Máximo de llamadas simultáneas (opcional, default del servidor)
+        use_cache: Si es false, ignora la caché de respuestas (opcional, default: true)
+        timeout_s: Plazo del lote completo en segundos; los items que no terminen a tiempo retornan error
+                   y los demás conservan su resultado (opcional, default del servidor)
+        priority: "bulk" o "interactive": clase con la que se encolan los items cuando el servidor está saturado;
+                  las llamadas interactive de otros clientes pasan antes (opcional, default: bulk)
+
+    Returns:
+        JSON string con una entrada por item, en el mismo orden: {"index", "result", "model", "usage"} o {"index", "error"};
+        los resultados largos traen solo su primera página y un enlace en "output", y los bloques que no son texto
+        van en "blocks"
+    """
+    if not anthropic_api_key:
+        return "Error: ANTHROPIC_API_KEY no está configurada"
+    if len(items) > BATCH_MAX_ITEMS:
+        return f"Error: el lote tiene {len(items)} items y el máximo es {BATCH_MAX_ITEMS}"
+
+    limit = min(concurrency or BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY)
+    semaphore = asyncio.Semaphore(max(limit, 1))
+    try:
+        caller = get_caller(ctx, priority)
+    except ValueError as e:
+        return f"Error: {e}"
+    timeout = deadlines.timeout_for(timeout_s)
+    deadline = time.monotonic() + timeout if timeout else None
+    disconnected = deadlines.disconnect_event(ctx)
+
+    async def call_item(item: Dict) -> Dict:
+        attached = await asyncio.to_thread(attachment_store.resolve_all, item["attachments"]) if item.get("attachments") else []
+        async with semaphore:
+            return await call_claude_message_async(
+                item["model"], item.get("prompt", ""), int(item.get("max_tokens", 1024)),
+                use_cache=use_cache, tool="call_claude_batch", caller=caller,
+                system=item.get("system", ""), context=item.get("context"),
+                document=blob_store.ref(item["prompt_ref"]) if item.get("prompt_ref") else None,
+                attached=attached,
+            )
+
+    async def run_item(index: int, item: Dict) -> Dict:
+        try:
+            if "model" not in item or not (item.get("prompt") or item.get("prompt_ref") or item.get("attachments")):
+                raise ValueError("cada item necesita 'model' y 'prompt' (o 'prompt_ref' o 'attachments')")
+            # One deadline for the whole batch, including the wait for a concurrency slot
+            remaining = deadline - time.monotonic() if deadline is not None else None
+            data = await deadlines.run(lambda: call_item(item), remaining, disconnected)
+            meta = usage_meta(data)
+            text = await link_long_output(response_text(data), meta)
+            blocks = [block for block in data["content"] if block.get("type") != "text"]
+            return {"index": index, "result": text, **meta, **({"blocks": blocks} if blocks else {})}
+        except Exception as e:
+            return {"index": index, "error": str(e)}
+
+    results = await asyncio.gather(*[run_item(i, item) for i, item in enumerate(items)])
+    return json.dumps(results, indent=2, ensure_ascii=False)
+
+@mcp.tool()
+@tracer.tool
+async def submit_claude_batch(jsonl: str, model: str = "latest sonnet", max_tokens: int = 1024) -> str:
+    """
+    Envía un conjunto de prompts como trabajo batch asíncrono (Message Batches API).
+
+    Más barato que call_claude para cargas offline grandes (evaluaciones,
+    etiquetado de corpus). Los resultados suelen estar listos en minutos u horas.
+
+    Args:
+        jsonl: Contenido JSONL, una petición por línea con "prompt" (o "title"/"body") y opcionalmente "custom_id"/"request_id", "model" y "max_tokens"
+        model: Modelo o alias por defecto para las líneas que no lo indiquen (opcional, default: latest sonnet)
+        max_tokens: max_tokens por defecto (opcional, default: 1024)
+
+    Returns:
+        JSON string con el job_id y el estado del trabajo
+    """
+    try:
+        if not anthropic_api_key:
+            return "Error: ANTHROPIC_API_KEY no está configurada"
+
+        import batch_jobs
+
+        requests = batch_jobs.parse_jsonl(jsonl, model, max_tokens)
+        # An unknown model fails the whole submission here instead of every line after hours in the queue
+        await catalog.ensure_loaded()
+        for request in requests:
+            request["params"]["model"] = router.choose(request["params"]["model"])
+        job = await batch_jobs.submit(anthropic_api_key, requests)
+        return json.dumps(job, indent=2)
+
+    except Exception as e:
+        return f"Error enviando el batch: {str(e)}"
+
+@mcp.tool()
+@tracer.tool
+async def get_claude_batch_status(job_id: str) -> str:
+    """
+    Consulta el estado de un trabajo batch.
+
+    Args:
+        job_id: Identificador retornado por submit_claude_batch
+
+    Returns:
+        JSON string con el estado y los contadores del trabajo
+    """
+    import batch_jobs
+
+    try:
+        job = await batch_jobs.refresh(anthropic_api_key, job_id)
+        return json.dumps(job, indent=2)
+
+    except Exception as e:
+        return f"Error consultando el batch: {str(e)}"
+
+@mcp.tool()
+@tracer.tool
+async def get_claude_batch_results(job_id: str, page: int = 1, page_size: int = 50) -> str:
+    """
+    Retorna una página de resultados de un trabajo batch terminado.
+
+    Args:
+        job_id: Identificador retornado por submit_claude_batch
+        page: Número de página, empezando en 1 (opcional, default: 1)
+        page_size: Resultados por página (opcional, default: 50, máximo 500)
+
+    Returns:
+        JSON string con el estado del trabajo y los resultados de la página
+    """
+    import batch_jobs
+
+    try:
+        job = await batch_jobs.fetch_results(anthropic_api_key, job_id)
+        if job["status"] != batch_jobs.ENDED_STATUS:
+            return json.dumps({"job": job, "results": [], "message": "El trabajo aún no ha terminado"}, indent=2, ensure_ascii=False)
+
+        page_size = max(1, min(page_size, 500))
+        results = batch_jobs.get_store().page(job_id, max(page, 1), page_size)
+        return json.dumps({
+            "job": job,
+            "page": page,
+            "page_size": page_size,
+            "has_more": page * page_size < job["request_count"],
+            "results": results,
+        }, indent=2, ensure_ascii=False)
+
+    except Exception as e:
+        return f"Error obteniendo resultados del batch: {str(e)}"
+
+@mcp.tool()
+@tracer.tool
+def list_claude_batches(limit: int = 20) -> str:
+    """
+    Lista los trabajos batch registrados en el almacén local, del más reciente al más antiguo.
+
+    Args:
+        limit: Máximo de trabajos a retornar (opcional, default: 20)
+
+    Returns:
+        JSON string con los trabajos
+    """
+    import batch_jobs
+
+    return json.dumps(batch_jobs.get_store().list(limit), indent=2)
+
+@mcp.tool()
+@tracer.tool
+def start_claude_conversation(model: str, system: str = "", context: List[str] = None, max_tokens: int = 1024, ctx: Context = None) -> str:
+    """
+    Inicia una conversación multi-turno guardada en el servidor.
+
+    El historial se guarda en el servidor: cada turno con continue_claude_conversation
+    envía solo el mensaje nuevo y el prefijo ya enviado se reutiliza desde la caché
+    de prompts de Anthropic.
+
+    Args:
+        model: El modelo de Claude a utilizar en toda la conversación (id o alias; los alias se fijan al empezar)
+        system: System prompt (opcional)
+        context: Bloques de contexto fijos para toda la conversación (opcional)
+        max_tokens: Máximo de tokens por respuesta (opcional, default: 1024)
+
+    Returns:
+        JSON string con el conversation_id
+    """
+    try:
+        model = router.choose(model)
+    except (model_catalog.UnknownModel, model_router.CircuitOpen) as e:
+        return f"Error: {str(e)}"
+    conversation = conversation_store.create(model, system, context, max_tokens, client=get_caller(ctx).client)
+    return json.dumps(conversation.info(), indent=2)
+
+@mcp.tool()
+@tracer.tool
+async def continue_claude_conversation(conversation_id: str, prompt: str, stream: bool = False, timeout_s: float = 0, ctx: Context = None) -> TextContent:
+    """
+    Envía un mensaje en una conversación y retorna la respuesta de Claude.
+
+    Args:
+        conversation_id: Identificador retornado por start_claude_conversation
+        prompt: El mensaje del usuario para este turno
+        stream: Si es true, envía el texto parcial como notificaciones mientras se genera (opcional, default: false)
+        timeout_s: Plazo del turno en segundos; si vence, el turno no se guarda (opcional, default del servidor)
+
+    Returns:
+        Respuesta de Claude como texto (las largas, como en call_claude, con su primera página y un enlace en
+        `_meta.output`); `_meta` incluye el usage (con tokens de caché) y el estado de la conversación
+    """
+    try:
+        if not anthropic_api_key:
+            return "Error: ANTHROPIC_API_KEY no está configurada"
+        conversation = await conversation_store.fetch(conversation_id)
+        if conversation is None:
+            return f"Error: conversación desconocida o expirada: {conversation_id}"
+
+        async with conversation.lock:
+            on_text = make_stream_relay(ctx) if stream and ctx is not None else None
+            payload = build_conversation_payload(conversation, prompt)
+            # Each turn is a new exchange, never answered from the response cache
+            data = await deadlines.run(
+                lambda: send_message(payload, on_text, use_cache=False, tool="continue_claude_conversation", caller=get_caller(ctx)),
+                deadlines.timeout_for(timeout_s),
+                deadlines.disconnect_event(ctx),
+            )
+            if on_text is not None:
+                await on_text.flush()
+            text = response_text(data)
+            conversation_store.append(conversation, prompt, text)
+
+        meta = {**usage_meta(data), "conversation": conversation.info()}
+        return TextContent(type="text", text=await link_long_output(text, meta), _meta=meta)
+
+    except Exception as e:
+        return f"Error en la conversación: {str(e)}"
+
+@mcp.tool()
+@tracer.tool
+async def end_claude_conversation(conversation_id: str) -> str:
+    """
+    Termina una conversación y borra su historial del servidor.
+
+    Args:
+        conversation_id: Identificador retornado por start_claude_conversation
+
+    Returns:
+        Confirmación o error si la conversación no existe
+    """
+    # It may live in another replica, known here only through the shared state
+    if await conversation_store.fetch(conversation_id) is not None and conversation_store.delete(conversation_id):
+        return f"Conversación {conversation_id} terminada"
+    return f"Error: conversación desconocida o expirada: {conversation_id}"
+
+@mcp.tool()
+@tracer.tool
+async def upload_claude_blob(content: str, upload_id: str = "", final: bool = True) -> str:
+    """
+    Sube un texto grande (documento, código, transcripción) para usarlo como prompt por referencia (prompt_ref).
+
+    El texto se guarda una sola vez en el servidor y se puede reutilizar en
+    varias llamadas sin volver a enviarlo. Los textos muy grandes se suben a
+    trozos: las llamadas con final=false añaden `content` a la subida
+    `upload_id` (la crean si está vacío) y la llamada con final=true la cierra.
+    Sin pasar por MCP, POST /blobs con el texto como cuerpo hace lo mismo.
+
+    Args:
+        content: Texto (o el siguiente trozo del texto)
+        upload_id: Subida a la que añadir el trozo (opcional, vacío para empezar una nueva)
+        final: Si es true cierra la subida y crea el blob (opcional, default: true)
+
+    Returns:
+        JSON string con el upload_id mientras la subida sigue abierta, o con blob_id, uri, bytes y pages al cerrarla
+    """
+    try:
+        # Encoding, hashing and writing megabytes of text would stall every other session on the loop
+        if not final:
+            return json.dumps({"upload_id": await asyncio.to_thread(blob_store.append, upload_id, content)})
+        if upload_id:
+            await asyncio.to_thread(blob_store.append, upload_id, content)
+            return json.dumps(await asyncio.to_thread(blob_store.finish, upload_id), indent=2)
+        return json.dumps(await asyncio.to_thread(blob_store.write_text, content), indent=2)
+
+    except Exception as e:
+        return f"Error subiendo el blob: {str(e)}"
+
+@mcp.tool()
+@tracer.tool
+def read_claude_blob(blob_id: str, page: int = 1) -> TextContent:
+    """
+    Lee una página de un blob: una respuesta larga de Claude o un texto subido.
+
+    Args:
+        blob_id: Id del blob o su uri claude://blobs/{blob_id} (viene en `_meta.output` de call_claude)
+        page: Página a leer, desde 1 (opcional, default: 1)
+
+    Returns:
+        El texto de la página; si quedan más, una nota final indica cómo leer la siguiente.
+        `_meta` incluye page, pages y bytes
+    """
+    try:
+        result = blob_store.page(blob_id, page)
+        meta = {key: result[key] for key in ("blob_id", "uri", "page", "pages", "bytes")}
+        return TextContent(type="text", text=result["text"] + page_note(result), _meta=meta)
+
+    except Exception as e:
+        return f"Error leyendo el blob: {str(e)}"
+
+@mcp.resource("claude://blobs/{blob_id}")
+def get_blob(blob_id: str) -> str:
+    """Primera página de un blob (respuesta larga o texto subido)"""
+    page = blob_store.page(blob_id, 1)
+    return page["text"] + page_note(page)
+
+@mcp.resource("claude://blobs/{blob_id}/pages/{page}")
+def get_blob_page(blob_id: str, page: int) -> str:
+    """Página `page` (desde 1) de un blob"""
+    result = blob_store.page(blob_id, page)
+    return result["text"] + page_note(result)
+
+@mcp.custom_route("/blobs", methods=["POST"])
+async def upload_blob_endpoint(request: Request) -> Response:
+    """
+    Sube el cuerpo de la petición (texto UTF-8) como blob. Se escribe a disco a
+    medida que llega, sin cargarlo entero en memoria ni pasar por JSON-RPC
+    """
+    length = request.headers.get("content-length")
+    if length and int(length) > blob_store.max_bytes:
+        return JSONResponse({"error": f"el blob supera el máximo de {blob_store.max_bytes} bytes"}, status_code=413)
+    try:
+        info = await blob_store.write_async(request.stream())
+    except blobs.BlobTooLarge as e:
+        return JSONResponse({"error": str(e)}, status_code=413)
+    except blobs.BlobError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return JSONResponse(info, status_code=201)
+
+@mcp.tool()
+@tracer.tool
+async def upload_claude_attachment(data: str) -> str:
+    """
+    Sube una imagen (JPEG, PNG, GIF, WebP) o un PDF para adjuntarlo en varias llamadas sin reenviarlo.
+
+    El adjunto se guarda una vez (el mismo fichero subido dos veces tiene el
+    mismo id) y se usa en call_claude con attachments=["claude://attachments/{id}"].
+    Sin pasar por MCP ni por base64, POST /attachments con el fichero como cuerpo hace lo mismo.
+
+    Args:
+        data: Contenido en base64 (también un data URL "data:image/png;base64,...")
+
+    Returns:
+        JSON string con attachment_id, uri, media_type (deducido del contenido) y bytes
+    """
+    try:
+        # Decoding and writing a large image or PDF would stall every other session on the loop
+        return json.dumps(await asyncio.to_thread(attachment_store.write_base64, data), indent=2)
+
+    except Exception as e:
+        return f"Error subiendo el adjunto: {str(e)}"
+
+@mcp.custom_route("/attachments", methods=["POST"])
+async def upload_attachment_endpoint(request: Request) -> Response:
+    """
+    Sube el cuerpo de la petición (la imagen o el PDF en binario) como adjunto.
+    Se codifica a base64 y se escribe a disco a medida que llega
+    """
+    length = request.headers.get("content-length")
+    if length and -(-int(length) // 3) * 4 > blob_store.max_bytes:
+        return JSONResponse({"error": f"el adjunto supera el máximo de {blob_store.max_bytes} bytes en base64"}, status_code=413)
+    try:
+        info = await attachment_store.write_binary_async(request.stream())
+    except blobs.BlobTooLarge as e:
+        return JSONResponse({"error": str(e)}, status_code=413)
+    except (blobs.BlobError, attachments.AttachmentError) as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return JSONResponse(info, status_code=201)
+
+@mcp.tool()
+@tracer.tool
+async def get_claude_usage(group_by: str = "model", client: str = "", session: str = "", model: str = "", days: int = 1, ctx: Context = None) -> str:
+    """
+    Consulta el uso de tokens y el coste estimado registrados por el servidor.
+
+    Cada cliente solo ve su propio uso; las peticiones con la cabecera
+    `Authorization: Bearer <CLAUDE_USAGE_ADMIN_TOKEN>` pueden consultar el de cualquiera.
+
+    Args:
+        group_by: Agrupar por "client", "session", "model" o "day" (opcional, default: model)
+        client: Filtra por cliente (opcional, solo administradores; por defecto el propio)
+        session: Filtra por sesión (opcional)
+        model: Filtra por modelo (opcional)
+        days: Días hacia atrás a incluir, contando hoy (opcional, default: 1)
+
+    Returns:
+        JSON string con los totales por grupo y el presupuesto restante del cliente que consulta
+    """
+    try:
+        if ledger is None:
+            return "Error: el registro de uso está desactivado (CLAUDE_USAGE_ENABLED=false)"
+
+        caller = get_caller(ctx)
+        if not is_usage_admin(ctx):
+            if client and client != caller.client:
+                return f"Error: el cliente '{caller.client}' solo puede consultar su propio uso"
+            client = caller.client
+        since_day = usage_ledger.today(time.time() - 86400 * (max(days, 1) - 1))
+        usage = await ledger.summary_async(group_by, client, session, model, since_day)
+        await ledger.load(caller)
+        return json.dumps({
+            "since": since_day,
+            "group_by": group_by,
+            "client": client or None,
+            "usage": usage,
+            "budget": ledger.remaining(caller),
+        }, indent=2, ensure_ascii=False)
+
+    except Exception as e:
+        return f"Error consultando el uso: {str(e)}"
+
+@mcp.tool()
+@tracer.tool
 def get_claude_models() -> str:
     """
     Obtiene la lista de modelos de Claude disponibles.
 
+    La lista viene de la API de Anthropic y se sirve desde memoria; cada modelo
+    indica los alias que lo seleccionan (por ejemplo "latest sonnet").
+
     Returns:
-        JSON string con los modelos disponibles
-    """
-    models = [
-        {
-            "name": "claude-3-5-sonnet-20241022",
-            "description": "Claude 3.5 Sonnet - Modelo más reciente y potente",
-            "max_tokens": 8192,
-            "recommended": True
-        },
-        {
-            "name": "claude-3-5-haiku-20241022", 
-            "description": "Claude 3.5 Haiku - Modelo rápido y eficiente",
-            "max_tokens": 8192,
-            "recommended": False
-        },
-        {
-            "name": "claude-3-opus-20240229",
-            "description": "Claude 3 Opus - Modelo anterior pero potente",
-            "max_tokens": 4096,
-            "recommended": False
-        }
-    ]
-    
-    return json.dumps(models, indent=2)
+        JSON string con los modelos disponibles, del más reciente al más antiguo
+    """
+    return json.dumps(catalog.describe(), indent=2)
 
 @mcp.resource("claude://models")
 def get_available_models() -> str:
@@ -103,22 +1079,117 @@ def get_available_models() -> str:
     Recurso que lista todos los modelos de Claude disponibles.
     """
     try:
+        models = catalog.describe()
         content = "# Modelos de Claude Disponibles\n\n"
+        if not catalog.authoritative:
+            content += "_Lista de respaldo: aún no se pudo descargar la lista de la API._\n\n"
+        latest = [model for model in models if any(alias.startswith("latest ") for alias in model["aliases"])]
         content += "## Modelos Recomendados\n\n"
-        content += "- **claude-3-5-sonnet-20241022**: Modelo más reciente y potente (recomendado)\n"
-        content += "- **claude-3-5-haiku-20241022**: Modelo rápido y eficiente\n\n"
-        content += "## Modelos Anteriores\n\n"
-        content += "- **claude-3-opus-20240229**: Modelo anterior pero potente\n\n"
-        content += "## Uso\n\n"
+        for model in latest:
+            content += f"- **{model['name']}**: {model['description']}{' (recomendado)' if model['recommended'] else ''} — alias: {', '.join(model['aliases'])}\n"
+        content += "\n## Todos los Modelos\n\n"
+        for model in models:
+            content += f"- **{model['name']}**: {model['description']}\n"
+        content += "\n## Uso\n\n"
         content += "Usa `call_claude(model='nombre_del_modelo', prompt='tu_pregunta')` para llamar a cualquier modelo.\n"
-        
+        content += "También acepta alias como `latest sonnet`, `opus 4` o `haiku`, que se resuelven al modelo más reciente.\n"
+
         return content
-        
+
     except Exception as e:
         return f"# Error\n\nError obteniendo modelos: {str(e)}"
 
+def metrics_summary() -> str:
+    """Resumen en markdown de las métricas que expone /metrics"""
+    content = "## Métricas\n\n"
+    content += f"- **Sesiones SSE activas**: {metrics.sse_sessions.get():g}\n"
+    in_flight = {key[0]: value for key, value in metrics.requests_in_flight.values.items() if value}
+    content += f"- **Llamadas en curso**: {sum(in_flight.values()):g}"
+    content += f" ({', '.join(f'{tool}: {value:g}' for tool, value in in_flight.items())})\n" if in_flight else "\n"
+    statuses = metrics.upstream_responses.values
+    if statuses:
+        content += "- **Respuestas upstream**: " + ", ".join(f"{model} {status}: {count:g}" for (model, status), count in statuses.items()) + "\n"
+    if metrics.calls_cancelled.values:
+        content += "- **Llamadas abortadas**: " + ", ".join(f"{reason}: {count:g}" for (reason,), count in metrics.calls_cancelled.values.items()) + "\n"
+    if metrics.tokens.values:
+        content += "- **Tokens**: " + ", ".join(f"{model} {kind}: {count:g}" for (model, kind), count in metrics.tokens.values.items()) + "\n"
+    content += "\n"
+
+    durations = metrics.request_duration.values
+    if durations:
+        content += "| Herramienta | Modelo | Llamadas | Total p50 | Total p95 | Cola media | TTFB p50 |\n"
+        content += "|-------------|--------|----------|-----------|-----------|------------|----------|\n"
+        for key, entry in durations.items():
+            queue = metrics.queue_wait.values.get(key)
+            ttfb = metrics.upstream_ttfb.quantile(key, 0.5)
+            content += (
+                f"| {key[0]} | {key[1]} | {entry.count} "
+                f"| {1000 * metrics.request_duration.quantile(key, 0.5):.0f} ms "
+                f"| {1000 * metrics.request_duration.quantile(key, 0.95):.0f} ms "
+                f"| {f'{1000 * queue.sum / queue.count:.0f} ms' if queue and queue.count else '-'} "
+                f"| {f'{1000 * ttfb:.0f} ms' if ttfb is not None else '-'} |\n"
+            )
+        content += "\n"
+    return content
+
+@mcp.custom_route("/metrics", methods=["GET"])
+async def metrics_endpoint(request: Request) -> Response:
+    """Métricas en formato Prometheus (con SO_REUSEPORT, las de todos los workers)"""
+    text = metrics.REGISTRY.render()
+    peers = os.environ.get("MCP_WORKER_PEERS", "")
+    if peers and not request.query_params.get("local"):
+        # No router in front to merge them: whichever worker gets the scrape asks its siblings
+        import multiworker
+
+        text = await multiworker.merge_peer_metrics(os.environ.get("MCP_WORKER_INDEX", "0"), text, peers)
+    return Response(text, media_type=metrics.CONTENT_TYPE)
+
+@mcp.custom_route("/health", methods=["GET"])
+async def health_endpoint(request: Request) -> Response:
+    """Comprobación de salud: si responde, la app está importada y su lifespan arrancado"""
+    return JSONResponse({"status": "ready", "transport": MCP_TRANSPORT})
+
+@mcp.custom_route("/debug/profile", methods=["GET"])
+async def profile_endpoint(request: Request) -> Response:
+    """
+    Perfil por muestreo del event loop (solo con CLAUDE_PROFILER_ENABLED=true).
+
+    Exige la cabecera `Authorization: Bearer <CLAUDE_PROFILER_TOKEN>`.
+    Parámetros: seconds (default 10), interval_ms (default 5) y format:
+    folded (default, para flamegraphs) o top (funciones con más muestras, en JSON).
+    """
+    global sampler
+    if not PROFILER_ENABLED:
+        return JSONResponse({"error": "profiler desactivado (CLAUDE_PROFILER_ENABLED=true para activarlo)"}, status_code=404)
+    if not PROFILER_TOKEN:
+        return JSONResponse({"error": "el profiler exige un token: configura CLAUDE_PROFILER_TOKEN"}, status_code=403)
+    if not hmac.compare_digest(request.headers.get("authorization", "").encode(), f"Bearer {PROFILER_TOKEN}".encode()):
+        return JSONResponse({"error": "token del profiler inválido o ausente"}, status_code=401, headers={"WWW-Authenticate": "Bearer"})
+    import profiler
+
+    if sampler is None:
+        sampler = profiler.profiler_from_env()
+    try:
+        seconds = float(request.query_params.get("seconds", 10))
+        interval = max(float(request.query_params.get("interval_ms", 5)), 1) / 1000
+    except ValueError:
+        return JSONResponse({"error": "seconds e interval_ms deben ser números"}, status_code=400)
+    try:
+        # Sampled from another thread; this handler runs on the loop thread, which is the one profiled
+        profile = await asyncio.to_thread(sampler.sample, threading.get_ident(), seconds, interval)
+    except profiler.ProfilerBusy as e:
+        return JSONResponse({"error": str(e)}, status_code=409)
+    if request.query_params.get("format") == "top":
+        return JSONResponse({
+            "samples": profile["samples"],
+            "seconds": profile["seconds"],
+            "interval": profile["interval"],
+            "functions": profiler.top(profile),
+        })
+    return Response(profiler.folded(profile), media_type="text/plain; charset=utf-8")
+
 @mcp.resource("claude://status")
-def get_server_status() -> str:
+async def get_server_status() -> str:
     """
     Recurso que muestra el estado del servidor Claude MCP.
     """
@@ -127,12 +1198,152 @@ def get_server_status() -> str:
         content += f"**Servidor**: Claude MCP Server\n"
         content += f"**Puerto**: {PORT}\n"
         content += f"**API Key**: {'✅ Configurada' if anthropic_api_key else '❌ No configurada'}\n\n"
+        pool = claude_client.pool_stats()
+        content += "## Pool de Conexiones\n\n"
+        content += f"- **HTTP/2**: {'sí' if pool['http2'] else 'no'}\n"
+        content += f"- **Límite de conexiones**: {pool['max_connections']} (keep-alive: {pool['max_keepalive_connections']}, expiran tras {pool['keepalive_expiry']:g}s inactivas)\n"
+        content += f"- **Peticiones**: {pool['requests']}\n"
+        content += f"- **Conexiones reutilizadas (hits)**: {pool['hits']} ({pool['hit_ratio']:.0%})\n"
+        content += f"- **Conexiones nuevas**: {pool['new_connections']} (setup medio {pool['connect_time_avg_ms']:.1f} ms)\n"
+        content += f"- **Espera por conexión**: media {pool['wait_time_avg_ms']:.1f} ms, máxima {pool['wait_time_max_ms']:.1f} ms\n\n"
+        if cache is not None:
+            stats = await cache.stats_async()
+            content += "## Caché de Respuestas\n\n"
+            content += f"- **Entradas en memoria**: {stats['entries']}/{stats['max_entries']} (TTL {stats['ttl']:g}s)\n"
+            if stats["disk"]:
+                content += f"- **Disco**: `{stats['disk']}` ({stats['disk_entries']} entradas)\n"
+            content += f"- **Aciertos**: {stats['hits']} ({stats['hit_ratio']:.0%}, {stats['disk_hits']} desde disco, {stats['shared_hits']} de otras réplicas)\n"
+            content += f"- **Fallos**: {stats['misses']}\n"
+            content += f"- **Desalojos**: {stats['evictions']} (expiradas: {stats['expirations']})\n\n"
+        else:
+            content += "## Caché de Respuestas\n\n- Desactivada\n\n"
+        limits = governor.stats()
+        if limits:
+            content += "## Límites de Uso por Modelo\n\n"
+            content += "| Modelo | Concurrencia | En vuelo | En cola | Espera media | Espera máx. | 429/529 | Rechazadas |\n"
+            content += "|--------|--------------|----------|---------|--------------|-------------|---------|------------|\n"
+            for model_name, stats in limits.items():
+                content += (
+                    f"| {model_name} | {stats['concurrency_limit']:g} | {stats['in_flight']} | {stats['queued']} "
+                    f"| {stats['wait_time_avg_ms']:.0f} ms | {stats['wait_time_max_ms']:.0f} ms "
+                    f"| {stats['overloads']} | {stats['rejected']} |\n"
+                )
+            content += "\n"
+        stats = call_scheduler.stats()
+        content += "## Planificación\n\n"
+        content += f"- **Reparto justo por**: {'sesión' if stats['fair_by'] == 'session' else 'cliente'} (bulk hasta el {stats['bulk_share']:.0%} de los slots de cada modelo)\n"
+        if stats["client_concurrency"]:
+            content += f"- **Llamadas en vuelo por cliente**: máximo {stats['client_concurrency']}\n"
+        content += f"- **Rebajadas a bulk por política del cliente**: {stats['demoted']} (esperas por límite del cliente: {stats['capped']})\n\n"
+        content += "| Clase | En cola | En vuelo | Admitidas | Espera media | Espera máx. |\n"
+        content += "|-------|---------|----------|-----------|--------------|-------------|\n"
+        for priority, class_stats in stats["classes"].items():
+            content += (
+                f"| {priority} | {class_stats['queued']} | {class_stats['in_flight']} | {class_stats['admitted']} "
+                f"| {class_stats['wait_time_avg_ms']:.0f} ms | {class_stats['wait_time_max_ms']:.0f} ms |\n"
+            )
+        content += "\n"
+        if stats["clients"]:
+            content += "Clientes activos: " + ", ".join(
+                f"`{client}` ({client_stats['in_flight']} en vuelo, {client_stats['queued']} en cola)"
+                for client, client_stats in list(stats["clients"].items())[:10]
+            ) + "\n\n"
+        stats = retry_policy.stats()
+        content += "## Reintentos\n\n"
+        content += f"- **Intentos máximos**: {stats['max_attempts']} (plazo total {stats['deadline']:g}s)\n"
+        content += f"- **Reintentos**: {stats['retries']} (abandonadas: {stats['gave_up']})\n"
+        content += f"- **Hedging**: {'activo' if stats['hedge_enabled'] else 'inactivo'} ({stats['hedges']} duplicadas, {stats['hedge_wins']} ganaron)\n\n"
+        content += metrics_summary()
+        stats = conversation_store.stats()
+        content += "## Conversaciones\n\n"
+        content += f"- **Activas en memoria**: {stats['active']}/{stats['max_entries']} (expiran tras {stats['ttl']:g}s inactivas)\n"
+        if stats["disk"]:
+            content += f"- **Volcadas a disco**: {stats['disk_entries']} en `{stats['disk']}` ({stats['spilled']} volcados, {stats['restored']} recuperadas)\n"
+        content += f"- **Creadas**: {stats['created']} (desalojadas: {stats['evictions']}, expiradas: {stats['expirations']})\n"
+        content += f"- **Turnos recortados por tamaño**: {stats['trimmed_turns']}\n"
+        content += f"- **Recuperadas del estado compartido**: {stats['shared_loads']}\n\n"
+        if ledger is not None:
+            stats = await ledger.stats_async()
+            content += "## Uso y Presupuestos\n\n"
+            content += f"- **Registro**: `{stats['path']}` ({stats['rows']} filas, {stats['calls']} llamadas)\n"
+            content += f"- **Coste estimado**: {stats['cost_usd_today']:.4f} USD hoy, {stats['cost_usd']:.4f} USD en total\n"
+            content += f"- **Llamadas rechazadas por presupuesto**: {stats['rejected']}\n\n"
+        stats = catalog.stats()
+        content += "## Catálogo de Modelos\n\n"
+        content += f"- **Origen**: {'API' if stats['source'] == 'api' else 'lista de respaldo'} ({stats['models']} modelos)\n"
+        if stats["age"] is not None:
+            content += f"- **Antigüedad**: {stats['age']:.0f}s (se refresca cada {stats['ttl']:g}s)\n"
+        content += f"- **Descargas**: {stats['refreshes']} (fallidas: {stats['failures']})\n"
+        if stats["last_error"]:
+            content += f"- **Último error**: {stats['last_error']}\n"
+        content += f"- **Alias resueltos**: {stats['resolved_aliases']}\n"
+        content += f"- **Modelos rechazados**: {stats['rejected']}\n\n"
+        stats = router.stats()
+        content += "## Enrutado de Modelos\n\n"
+        content += f"- **Clases**: {', '.join(f'`{name}`' for name in stats['routes'])} ({stats['routed']} llamadas enrutadas)\n"
+        content += f"- **Respaldo automático**: {'activo' if stats['fallback_enabled'] else 'inactivo'} ({stats['fallbacks']} llamadas pasaron a otro modelo)\n"
+        content += f"- **Rechazadas por circuito abierto**: {stats['short_circuited']}\n\n"
+        if stats["models"]:
+            content += "| Modelo | Muestras | p50 | p95 | Errores | Circuito |\n"
+            content += "|--------|----------|-----|-----|---------|----------|\n"
+            for model_name, model_stats in stats["models"].items():
+                p50 = f"{1000 * model_stats['p50']:.0f} ms" if model_stats["p50"] is not None else "-"
+                p95 = f"{1000 * model_stats['p95']:.0f} ms" if model_stats["p95"] is not None else "-"
+                circuit = model_stats["circuit"] + (f" ({model_stats['retry_in']:.0f}s)" if model_stats["retry_in"] else "")
+                content += f"| {model_name} | {model_stats['samples']} | {p50} | {p95} | {model_stats['error_rate']:.0%} | {circuit} |\n"
+            content += "\n"
+        if coalescer is not None:
+            stats = coalescer.stats()
+            content += "## Coalescencia de Peticiones\n\n"
+            content += f"- **En vuelo**: {stats['in_flight']}\n"
+            content += f"- **Llamadas upstream**: {stats['upstream_calls']}\n"
+            content += f"- **Peticiones coalescidas**: {stats['coalesced']}\n\n"
+        stats = tracer.stats()
+        content += "## Trazas\n\n"
+        if stats["enabled"]:
+            exports = [target for target in (stats["export_file"], stats["export_endpoint"]) if target]
+            content += f"- **Trazas**: {stats['traces']} (exportación: {', '.join(f'`{target}`' for target in exports) if exports else 'ninguna'}, muestreo {stats['sample_rate']:.0%})\n"
+            if exports:
+                content += f"- **Exportadas**: {stats['exported']} (descartadas: {stats['export_dropped']}, fallos: {stats['export_failures']})\n"
+            if stats["slow_threshold"]:
+                content += f"- **Llamadas lentas** (más de {1000 * stats['slow_threshold']:.0f} ms): {stats['slow_calls']}\n"
+            for entry in reversed(stats["recent_slow_calls"][-5:]):
+                phases = sorted(entry["phases"].items(), key=lambda item: -item[1])[:3]
+                content += f"  - `{entry['tool']}` {entry['duration_ms']:.0f} ms: " + ", ".join(f"{name} {ms:.0f} ms" for name, ms in phases) + f" (traza `{entry['trace_id']}`)\n"
+            profile_status = ("`GET /debug/profile`" if PROFILER_TOKEN else "sin CLAUDE_PROFILER_TOKEN, rechaza las peticiones") if PROFILER_ENABLED else "desactivado"
+            content += f"- **Profiler**: {profile_status}\n\n"
+        else:
+            content += "- Desactivadas\n\n"
+        stats = state.stats()
+        content += "## Estado Compartido\n\n"
+        if stats["shared"]:
+            content += f"- **Backend**: {stats['backend']} (sincronización cada {STATE_SYNC_INTERVAL:g}s)\n"
+            content += f"- **Operaciones**: {stats['ops']} en {stats['batches']} lotes ({stats['ops_per_batch']:g} por lote, {stats['pending']} pendientes)\n"
+            content += f"- **Lotes fallidos**: {stats['errors']} ({stats['skipped']} operaciones omitidas mientras no respondía)\n"
+            if stats["last_error"]:
+                content += f"- **Último error**: {stats['last_error']}\n"
+            content += "\n"
+        else:
+            content += "- En memoria de este proceso (CLAUDE_STATE_BACKEND para compartirlo entre réplicas)\n\n"
+        stats = blob_store.stats()
+        content += "## Blobs\n\n"
+        content += f"- **Blobs guardados**: {stats['blobs']} ({stats['bytes'] / 1024 / 1024:.1f} MB de {stats['max_total_bytes'] / 1024 / 1024:.0f} MB)\n"
+        content += f"- **Escrituras**: {stats['writes']} ({stats['deduplicated']} deduplicadas)\n"
+        content += f"- **Páginas servidas**: {stats['pages_served']}\n"
+        content += f"- **Caducados**: {stats['expired']}\n\n"
         content += "## Herramientas Disponibles\n\n"
         content += "- `call_claude`: Llama a cualquier modelo de Claude\n"
+        content += "- `call_claude_batch`: Llama a Claude con varios prompts en paralelo\n"
+        content += "- `submit_claude_batch`, `get_claude_batch_status`, `get_claude_batch_results`, `list_claude_batches`: Trabajos batch offline\n"
+        content += "- `start_claude_conversation`, `continue_claude_conversation`, `end_claude_conversation`: Conversaciones multi-turno\n"
+        content += "- `upload_claude_blob`, `read_claude_blob`: Textos grandes por referencia y respuestas largas por páginas\n"
+        content += "- `upload_claude_attachment`: Imágenes y PDF para adjuntar en varias llamadas\n"
+        content += "- `get_claude_usage`: Uso de tokens y coste por cliente, sesión y modelo\n"
         content += "- `get_claude_models`: Obtiene lista de modelos disponibles\n\n"
         content += "## Recursos Disponibles\n\n"
         content += "- `claude://models`: Lista de modelos\n"
-        content += "- `claude://status`: Estado del servidor\n\n"
+        content += "- `claude://status`: Estado del servidor\n"
+        content += "- `claude://blobs/{blob_id}`, `claude://blobs/{blob_id}/pages/{page}`: Blobs por páginas\n\n"
         
         return content
         
@@ -140,14 +1351,18 @@ def get_server_status() -> str:
         return f"# Error\n\nError obteniendo estado: {str(e)}"
 
 @mcp.prompt()
-def generate_claude_prompt(question: str, model: str = "claude-3-5-sonnet-20241022") -> str:
+def generate_claude_prompt(question: str, model: str = "") -> str:
     """
     Genera un prompt optimizado para obtener la mejor respuesta de Claude.
     
     Args:
         question: La pregunta o tarea a realizar
-        model: El modelo de Claude a usar (opcional)
+        model: El modelo de Claude a usar (opcional, default: el Sonnet más reciente)
     """
+    try:
+        model = catalog.resolve(model or "latest sonnet")
+    except model_catalog.UnknownModel:
+        model = catalog.resolve("latest sonnet")
     return f"""Usa Claude para responder la siguiente pregunta de manera completa y útil:
 
 **Pregunta**: {question}
@@ -165,15 +1380,82 @@ call_claude(model='{model}', prompt='{question}', max_tokens=1024)
 
 Responde de manera clara y profesional."""
 
+def uses_streamable_http() -> bool:
+    return MCP_TRANSPORT in ("streamable-http", "both")
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Arranca el gestor de Streamable HTTP (si se usa), el refresco del catálogo
+    de modelos y la sincronización con el estado compartido; al terminar cierra
+    el cliente HTTP compartido, vacía las escrituras pendientes del estado
+    compartido y vuelca a disco las conversaciones activas
+    """
+    async with AsyncExitStack() as stack:
+        stack.push_async_callback(claude_client.close_async_client)
+        stack.callback(conversation_store.spill_all)
+        stack.push_async_callback(state.close)
+        tracer.start()
+        stack.push_async_callback(tracer.stop)
+        catalog.start()
+        stack.push_async_callback(catalog.stop)
+        governor.start()
+        stack.push_async_callback(governor.stop)
+        if ledger is not None:
+            ledger.start()
+            stack.push_async_callback(ledger.stop)
+        if uses_streamable_http():
+            await stack.enter_async_context(mcp.session_manager.run())
+        yield
+
+def create_app():
+    """
+    Fábrica ASGI del servidor MCP.
+
+    Según MCP_TRANSPORT sirve SSE (/sse y /messages/), Streamable HTTP (/mcp)
+    o ambos. La usan tanto el modo de un proceso como cada worker del modo
+    multi-proceso: uvicorn app:create_app --factory
+    """
+    if MCP_TRANSPORT == "sse":
+        app = mcp.sse_app()
+    elif MCP_TRANSPORT == "streamable-http":
+        app = mcp.streamable_http_app()
+    elif MCP_TRANSPORT == "both":
+        sse_routes = mcp.sse_app().routes
+        # Custom routes are shared by both apps, keep a single copy
+        http_routes = [route for route in mcp.streamable_http_app().routes if route not in sse_routes]
+        app = Starlette(debug=mcp.settings.debug, routes=sse_routes + http_routes)
+    else:
+        raise ValueError(f"MCP_TRANSPORT inválido: '{MCP_TRANSPORT}' (usa sse, streamable-http o both)")
+    app.router.lifespan_context = lifespan
+    app.add_middleware(deadlines.DisconnectMiddleware, cancel_paths=(mcp.settings.sse_path,))
+    app.add_middleware(metrics.SSESessionMiddleware, path=mcp.settings.sse_path)
+    # Outermost, so the MCP dispatch phase starts when the request arrives
+    app.add_middleware(tracing.TraceMiddleware)
+    return app
+
+async def run_server() -> None:
+    """Ejecuta el servidor en un solo proceso"""
+    config = uvicorn.Config(create_app(), host=mcp.settings.host, port=mcp.settings.port, log_level=mcp.settings.log_level.lower())
+    await uvicorn.Server(config).serve()
+
 if __name__ == "__main__":
     # Initialize and run the server
     print(f"🚀 Iniciando Claude MCP Server en 0.0.0.0:{PORT}")
-    print("📡 Usando FastMCP con transporte SSE")
+    print(f"📡 Usando FastMCP con transporte {MCP_TRANSPORT}")
     print("🔗 Compatible con OpenAI y Claude")
     
     if not anthropic_api_key:
         print("⚠️  ADVERTENCIA: ANTHROPIC_API_KEY no está configurada")
         print("   Configura la variable de entorno para que funcione correctamente")
     
-    # Run with SSE transport (host and port already set in constructor)
-    mcp.run(transport='sse')
\ No newline at end of file
+    # WEB_CONCURRENCY > 1 runs several worker processes behind a sticky router
+    workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+    if workers > 1:
+        import multiworker
+
+        print(f"🧩 Modo multi-proceso: {workers} workers")
+        multiworker.main(workers, mcp.settings.host, PORT)
+    else:
+        # Run with the configured transport (host and port already set in constructor)
+        anyio.run(run_server)
\ No newline at end of file
@@ -0,0 +1,262 @@
+"""
+Adjuntos multimodales (imágenes y documentos) para las llamadas a Claude
+Las imágenes y los PDF llegan en base64 (dentro de la llamada MCP, como
+ImageContent o EmbeddedResource) o en binario por POST /attachments, y se
+guardan una sola vez en el almacén de blobs, ya en base64 y direccionados por
+su sha256. Cada llamada que los usa envía a Anthropic el base64 leyéndolo del
+disco a trozos: no se decodifica ni se vuelve a codificar, y el mismo adjunto
+reutilizado en varias llamadas (claude://attachments/{id}) no ocupa más disco
+ni vuelve a viajar por MCP.
+"""
+
+import base64
+import binascii
+from typing import AsyncIterable, Dict, List, Optional, Union
+
+import blobs
+
+URI_PREFIX = "claude://attachments/"
+
+# Media types the Messages API accepts in base64 image and document blocks
+IMAGE_TYPES = ("image/jpeg", "image/png", "image/gif", "image/webp")
+DOCUMENT_TYPES = ("application/pdf",)
+
+# The API rejects larger images; fail before uploading them
+IMAGE_MAX_BYTES = 5 * 1024 * 1024
+
+# Rough token cost for the rate governor, reconciled with the real usage after the call:
+# images are resized to ~1.15 megapixels (~1600 tokens), PDFs cost text plus an image per page
+IMAGE_TOKENS = 1600
+DOCUMENT_BYTES_PER_TOKEN = 30
+
+# Base64 is validated in slices of this many characters (a multiple of 4)
+VALIDATE_CHUNK = 64 * 1024
+
+class AttachmentError(ValueError):
+    """Adjunto con base64 inválido, tipo no soportado o inexistente"""
+
+def sniff(head: bytes) -> Optional[str]:
+    """Media type a partir de los primeros bytes del fichero (None si no es un tipo soportado)"""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith(b"%PDF-"):
+        return "application/pdf"
+    return None
+
+def decoded_size(encoded_size: int, tail: str) -> int:
+    """Bytes originales de un base64 de `encoded_size` caracteres que termina en `tail`"""
+    return encoded_size // 4 * 3 - tail[-2:].count("=")
+
+class EncodedRef(blobs.BlobRef):
+    """
+    Base64 de un adjunto guardado como blob, dentro de una petición a la API.
+
+    Es ASCII, así que claude_client lo copia al cuerpo JSON sin escaparlo
+    (`json_safe`), y `chars` es una estimación de su coste en tokens (x4) en
+    lugar de su tamaño, que sobrestimaría mucho una imagen.
+    """
+
+    json_safe = True
+
+    def __init__(self, path: str, blob_id: str, size: int, media_type: str, data_bytes: int):
+        super().__init__(path, blob_id, size)
+        self.media_type = media_type
+        self.data_bytes = data_bytes
+
+    @property
+    def ref(self) -> str:
+        return URI_PREFIX + self.blob_id
+
+    @property
+    def chars(self) -> int:
+        if self.media_type in IMAGE_TYPES:
+            return IMAGE_TOKENS * 4
+        return self.data_bytes // DOCUMENT_BYTES_PER_TOKEN * 4
+
+class Attachment:
+    """Un adjunto listo para ir en el mensaje del usuario"""
+
+    def __init__(self, media_type: str, data: Union[EncodedRef, blobs.BlobRef, str], uri: str = "", bytes: int = 0, title: str = ""):
+        self.media_type = media_type
+        self.data = data
+        self.uri = uri
+        self.bytes = bytes
+        self.title = title
+
+    def block(self) -> Dict:
+        """Bloque de contenido de la API de mensajes (image o document)"""
+        if self.media_type in IMAGE_TYPES:
+            return {"type": "image", "source": {"type": "base64", "media_type": self.media_type, "data": self.data}}
+        if self.media_type in DOCUMENT_TYPES:
+            block = {"type": "document", "source": {"type": "base64", "media_type": self.media_type, "data": self.data}}
+        else:
+            block = {"type": "document", "source": {"type": "text", "media_type": "text/plain", "data": self.data}}
+        if self.title:
+            block["title"] = self.title
+        return block
+
+    def info(self) -> Dict:
+        return {"uri": self.uri, "media_type": self.media_type, "bytes": self.bytes}
+
+class AttachmentStore:
+    """
+    Adjuntos binarios guardados en base64 en un BlobStore.
+
+    No hay metadatos aparte: el media type se deduce de los primeros bytes y
+    el tamaño original del tamaño del base64, así que un adjunto caduca y se
+    deduplica exactamente igual que cualquier otro blob.
+    """
+
+    def __init__(self, store: blobs.BlobStore):
+        self.store = store
+
+    def write_base64(self, data: str) -> Dict:
+        """
+        Valida y guarda un adjunto en base64 (se admite un data URL
+        `data:image/png;base64,...`) y retorna su info
+        """
+        if data.startswith("data:"):
+            data = data[data.find(",") + 1:]
+        if "\n" in data or " " in data:
+            # Line-wrapped base64 (MIME style) is normalized once, so the same file always hashes the same
+            data = "".join(data.split())
+        if not data or len(data) % 4 or data.find("=", 0, len(data) - 2) != -1:
+            raise AttachmentError("el adjunto no es base64 válido")
+        try:
+            for start in range(0, len(data), VALIDATE_CHUNK):
+                binascii.a2b_base64(data[start:start + VALIDATE_CHUNK], strict_mode=True)
+        except binascii.Error:
+            raise AttachmentError("el adjunto no es base64 válido")
+        media_type = self._check(data[:16], len(data), data[-2:])
+        blob = self.store.write_text(data)
+        return self._info(blob["blob_id"], media_type, blob["bytes"], data[-2:])
+
+    async def write_binary_async(self, chunks: AsyncIterable[bytes]) -> Dict:
+        """Guarda un adjunto que llega en binario (cuerpo HTTP) codificándolo a base64 al vuelo"""
+        state = {"head": b"", "media_type": None, "size": 0}
+
+        def check(data: bytes) -> None:
+            if state["media_type"] is None:
+                state["head"] = (state["head"] + data)[:12]
+                if len(state["head"]) < 12:
+                    return
+                state["media_type"] = sniff(state["head"])
+                if state["media_type"] is None:
+                    raise AttachmentError(self._unsupported())
+            if state["media_type"] in IMAGE_TYPES and state["size"] > IMAGE_MAX_BYTES:
+                raise AttachmentError(f"la imagen supera los {IMAGE_MAX_BYTES} bytes que admite la API")
+
+        async def encoded():
+            pending = b""
+            async for chunk in chunks:
+                state["size"] += len(chunk)
+                check(chunk)
+                data = pending + chunk
+                # Encode whole 3-byte groups only, so the concatenated output is the base64 of the whole file
+                cut = len(data) - len(data) % 3
+                pending = data[cut:]
+                if cut:
+                    yield base64.b64encode(data[:cut])
+            if state["media_type"] is None:
+                state["media_type"] = sniff(state["head"])
+                if state["media_type"] is None:
+                    raise AttachmentError(self._unsupported())
+            if pending:
+                yield base64.b64encode(pending)
+
+        # Errors raised while encoding abort the upload, so nothing invalid is ever stored
+        blob = await self.store.write_async(encoded())
+        return self._info(blob["blob_id"], state["media_type"], blob["bytes"], self._tail(blob["uri"]))
+
+    def ref(self, value: str) -> Attachment:
+        """Adjunto ya subido a partir de su id o su URI (claude://attachments/{id})"""
+        blob_id = blobs.parse_ref(value[len(URI_PREFIX):] if value.startswith(URI_PREFIX) else value)
+        try:
+            blob = self.store.ref(blob_id)
+        except blobs.BlobError:
+            raise AttachmentError(f"no existe el adjunto '{value}' (o caducó)")
+        with open(blob.path, "rb") as source:
+            head = source.read(16).decode("ascii", errors="replace")
+            source.seek(max(0, blob.size - 2))
+            tail = source.read().decode("ascii", errors="replace")
+        media_type = sniff(self._decode_head(head))
+        if media_type is None:
+            raise AttachmentError(f"'{value}' no es un adjunto (para usar un texto subido como documento usa claude://blobs/{blob_id})")
+        data_bytes = decoded_size(blob.size, tail)
+        data = EncodedRef(blob.path, blob_id, blob.size, media_type, data_bytes)
+        return Attachment(media_type, data, URI_PREFIX + blob_id, data_bytes)
+
+    def resolve(self, item: Union[str, Dict]) -> Attachment:
+        """
+        Convierte un adjunto tal como llega en la llamada en un Attachment.
+
+        Formas aceptadas:
+        - "claude://attachments/{id}" o {"uri": ...}: un adjunto ya subido
+        - "claude://blobs/{id}" o {"uri": ...}: un texto subido, como documento de texto
+        - {"type": "image", "data": base64, "mimeType": ...}: ImageContent de MCP
+        - {"type": "resource", "resource": {"uri", "mimeType", "blob" | "text"}}: EmbeddedResource de MCP
+        - {"data": base64} o {"text": ...}, con "title" opcional para documentos
+        """
+        if isinstance(item, str):
+            item = {"uri": item}
+        resource = item.get("resource") if isinstance(item.get("resource"), dict) else {}
+        title = item.get("title") or ""
+        data = item.get("data") or resource.get("blob")
+        text = item.get("text") if "text" in item else resource.get("text")
+        uri = item.get("uri") or ""
+
+        if data:
+            info = self.write_base64(data)
+            return self.ref(info["uri"])
+        if text is not None:
+            return Attachment("text/plain", text, resource.get("uri", ""), len(text.encode("utf-8")), title or resource.get("uri", ""))
+        if uri.startswith(blobs.URI_PREFIX):
+            document = self.store.ref(uri)
+            return Attachment("text/plain", document, document.ref, document.size, title)
+        if uri:
+            return self.ref(uri)
+        raise AttachmentError("cada adjunto necesita 'data' (base64), 'text' o una 'uri' de claude://attachments o claude://blobs")
+
+    def resolve_all(self, items: Optional[List[Union[str, Dict]]]) -> List[Attachment]:
+        return [self.resolve(item) for item in items or []]
+
+    def _check(self, head: str, encoded_size: int, tail: str) -> str:
+        """Media type de un base64 a partir de su inicio, validando el tipo y el tamaño"""
+        media_type = sniff(self._decode_head(head))
+        if media_type is None:
+            raise AttachmentError(self._unsupported())
+        size = decoded_size(encoded_size, tail)
+        if media_type in IMAGE_TYPES and size > IMAGE_MAX_BYTES:
+            raise AttachmentError(f"la imagen ocupa {size} bytes y la API admite hasta {IMAGE_MAX_BYTES}")
+        return media_type
+
+    @staticmethod
+    def _decode_head(head) -> bytes:
+        try:
+            return base64.b64decode(head[:16])
+        except (binascii.Error, ValueError):
+            return b""
+
+    @staticmethod
+    def _unsupported() -> str:
+        return f"tipo de adjunto no soportado (se admiten {', '.join(IMAGE_TYPES + DOCUMENT_TYPES)}; los textos van en 'text')"
+
+    def _tail(self, value: str) -> str:
+        blob = self.store.ref(value)
+        with open(blob.path, "rb") as source:
+            source.seek(max(0, blob.size - 2))
+            return source.read().decode("ascii")
+
+    def _info(self, blob_id: str, media_type: str, encoded_size: int, tail: str) -> Dict:
+        return {
+            "attachment_id": blob_id,
+            "uri": URI_PREFIX + blob_id,
+            "media_type": media_type,
+            "bytes": decoded_size(encoded_size, tail),
+        }
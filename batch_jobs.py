@@ -0,0 +1,257 @@
+"""
+Trabajos offline con la Message Batches API de Anthropic
+Los trabajos y sus resultados se guardan en un almacén SQLite local para que
+sobrevivan a reinicios del servidor
+"""
+
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+import claude_client
+
+CUSTOM_ID_PATTERN = re.compile(r"^[a-zA-Z0-9_-]{1,64}$")
+ENDED_STATUS = "ended"
+
+# Result rows written to the store per transaction while the results JSONL downloads
+RESULTS_CHUNK_SIZE = 500
+
+def get_batches_url() -> str:
+    """URL del endpoint de batches, derivada del endpoint de mensajes"""
+    return claude_client.get_api_url().rstrip("/") + "/batches"
+
+def parse_jsonl(jsonl: str, model: str, max_tokens: int) -> List[Dict]:
+    """
+    Convierte un JSONL de prompts en peticiones para la Message Batches API.
+
+    Cada línea acepta `custom_id` o `request_id` como identificador y `prompt`
+    o `body` (con `title` opcional, como en requests.jsonl) como texto. `model`
+    y `max_tokens` por línea sobrescriben los valores por defecto.
+    """
+    requests = []
+    for line_number, line in enumerate(jsonl.splitlines(), 1):
+        if not line.strip():
+            continue
+        item = json.loads(line)
+
+        custom_id = str(item.get("custom_id") or item.get("request_id") or f"item-{line_number}")
+        if not CUSTOM_ID_PATTERN.match(custom_id):
+            raise ValueError(f"línea {line_number}: custom_id inválido '{custom_id}' (solo letras, números, '-' y '_', máximo 64)")
+
+        prompt = item.get("prompt")
+        if prompt is None and "body" in item:
+            prompt = f"{item['title']}\n\n{item['body']}" if item.get("title") else item["body"]
+        if prompt is None:
+            raise ValueError(f"línea {line_number}: falta 'prompt' o 'body'")
+
+        requests.append({
+            "custom_id": custom_id,
+            "params": {
+                "model": item.get("model", model),
+                "max_tokens": int(item.get("max_tokens", max_tokens)),
+                "messages": [{"role": "user", "content": prompt}],
+            },
+        })
+
+    if not requests:
+        raise ValueError("el JSONL no contiene ninguna petición")
+    return requests
+
+class JobStore:
+    """Almacén SQLite de trabajos batch y sus resultados descargados"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # Results are written from worker threads while the loop keeps reading jobs
+        self._lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " job_id TEXT PRIMARY KEY, status TEXT NOT NULL, request_count INTEGER NOT NULL,"
+            " counts TEXT NOT NULL, results_url TEXT, results_stored INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL, updated_at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS results ("
+            " job_id TEXT NOT NULL, position INTEGER NOT NULL, custom_id TEXT NOT NULL,"
+            " type TEXT NOT NULL, text TEXT, error TEXT, PRIMARY KEY (job_id, position));"
+        )
+        self.conn.commit()
+
+    def save(self, batch: Dict, request_count: Optional[int] = None) -> None:
+        """Inserta o actualiza un trabajo a partir de la respuesta de la API"""
+        now = time.time()
+        job = self.get(batch["id"])
+        with self._lock:
+            self._save(batch, job, request_count, now)
+
+    def _save(self, batch: Dict, job: Optional[Dict], request_count: Optional[int], now: float) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO jobs (job_id, status, request_count, counts, results_url, results_stored, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                batch["id"],
+                batch["processing_status"],
+                request_count if request_count is not None else job["request_count"],
+                json.dumps(batch.get("request_counts", {})),
+                batch.get("results_url"),
+                job["results_stored"] if job else 0,
+                job["created_at"] if job else now,
+                now,
+            ),
+        )
+        self.conn.commit()
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        row = self.conn.execute(
+            "SELECT job_id, status, request_count, counts, results_url, results_stored, created_at, updated_at"
+            " FROM jobs WHERE job_id = ?",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "job_id": row[0],
+            "status": row[1],
+            "request_count": row[2],
+            "request_counts": json.loads(row[3]),
+            "results_url": row[4],
+            "results_stored": bool(row[5]),
+            "created_at": row[6],
+            "updated_at": row[7],
+        }
+
+    def list(self, limit: int = 20) -> List[Dict]:
+        rows = self.conn.execute("SELECT job_id FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+        return [self.get(row[0]) for row in rows]
+
+    def clear_results(self, job_id: str) -> None:
+        """Borra los resultados de una descarga anterior que no llegó a completarse"""
+        with self._lock:
+            self.conn.execute("DELETE FROM results WHERE job_id = ?", (job_id,))
+            self.conn.commit()
+
+    def add_results(self, job_id: str, start: int, results: List[Dict]) -> None:
+        """Guarda un trozo de resultados a partir de la posición `start`"""
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO results (job_id, position, custom_id, type, text, error) VALUES (?, ?, ?, ?, ?, ?)",
+                [(job_id, start + i, r["custom_id"], r["type"], r.get("text"), r.get("error")) for i, r in enumerate(results)],
+            )
+            self.conn.commit()
+
+    def finish_results(self, job_id: str) -> None:
+        """Marca el trabajo como completo cuando ya están guardados todos sus resultados"""
+        with self._lock:
+            self.conn.execute("UPDATE jobs SET results_stored = 1 WHERE job_id = ?", (job_id,))
+            self.conn.commit()
+
+    def page(self, job_id: str, page: int, page_size: int) -> List[Dict]:
+        rows = self.conn.execute(
+            "SELECT custom_id, type, text, error FROM results WHERE job_id = ? ORDER BY position LIMIT ? OFFSET ?",
+            (job_id, page_size, (page - 1) * page_size),
+        ).fetchall()
+        results = []
+        for custom_id, result_type, text, error in rows:
+            entry = {"custom_id": custom_id, "type": result_type}
+            if text is not None:
+                entry["result"] = text
+            if error is not None:
+                entry["error"] = error
+            results.append(entry)
+        return results
+
+_store = None
+
+def get_store() -> JobStore:
+    """Retorna el almacén de trabajos (CLAUDE_BATCH_DB, default batch_jobs.db)"""
+    global _store
+
+    if _store is None:
+        _store = JobStore(os.environ.get("CLAUDE_BATCH_DB", "batch_jobs.db"))
+    return _store
+
+def _parse_result_line(line: str) -> Dict:
+    """Convierte una línea del JSONL de resultados en una fila del almacén"""
+    item = json.loads(line)
+    result = item["result"]
+    entry = {"custom_id": item["custom_id"], "type": result["type"]}
+    if result["type"] == "succeeded":
+        entry["text"] = "".join(
+            block.get("text", "") for block in result["message"]["content"] if block.get("type") == "text"
+        )
+    elif result["type"] == "errored":
+        entry["error"] = json.dumps(result.get("error", {}))
+    return entry
+
+async def submit(api_key: str, requests: List[Dict]) -> Dict:
+    """Crea un batch en la API y lo registra en el almacén local"""
+    client = claude_client.get_async_client()
+    response = await client.post(
+        get_batches_url(),
+        headers=claude_client.build_headers(api_key),
+        json={"requests": requests},
+    )
+    if response.status_code != 200:
+        raise claude_client.AnthropicAPIError(response.status_code, claude_client.error_body(response), response.headers)
+
+    batch = response.json()
+    get_store().save(batch, request_count=len(requests))
+    return get_store().get(batch["id"])
+
+async def refresh(api_key: str, job_id: str) -> Dict:
+    """Consulta el estado de un batch en la API (si no ha terminado) y lo actualiza"""
+    store = get_store()
+    job = store.get(job_id)
+    if job is None:
+        raise ValueError(f"trabajo desconocido: {job_id}")
+    if job["status"] == ENDED_STATUS:
+        return job
+
+    client = claude_client.get_async_client()
+    response = await client.get(f"{get_batches_url()}/{job_id}", headers=claude_client.build_headers(api_key))
+    if response.status_code != 200:
+        raise claude_client.AnthropicAPIError(response.status_code, claude_client.error_body(response), response.headers)
+
+    store.save(response.json())
+    return store.get(job_id)
+
+async def fetch_results(api_key: str, job_id: str) -> Dict:
+    """
+    Descarga los resultados de un batch terminado y los guarda en el almacén.
+
+    El JSONL de resultados se procesa línea a línea a medida que llega y se
+    guarda en trozos de RESULTS_CHUNK_SIZE filas (en un hilo, fuera del event
+    loop), así que la memoria no crece con el tamaño del batch. El trabajo
+    solo se marca como completo cuando se guardó el último trozo.
+    """
+    job = await refresh(api_key, job_id)
+    if job["status"] != ENDED_STATUS or job["results_stored"]:
+        return job
+
+    store = get_store()
+    await asyncio.to_thread(store.clear_results, job_id)
+    stored = 0
+    chunk = []
+    client = claude_client.get_async_client()
+    async with client.stream("GET", job["results_url"], headers=claude_client.build_headers(api_key)) as response:
+        if response.status_code != 200:
+            await response.aread()
+            raise claude_client.AnthropicAPIError(response.status_code, claude_client.error_body(response), response.headers)
+        async for line in response.aiter_lines():
+            if not line.strip():
+                continue
+            chunk.append(_parse_result_line(line))
+            if len(chunk) >= RESULTS_CHUNK_SIZE:
+                await asyncio.to_thread(store.add_results, job_id, stored, chunk)
+                stored += len(chunk)
+                chunk = []
+
+    if chunk:
+        await asyncio.to_thread(store.add_results, job_id, stored, chunk)
+    await asyncio.to_thread(store.finish_results, job_id)
+    return store.get(job_id)
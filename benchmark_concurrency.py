@@ -0,0 +1,78 @@
+"""
+Benchmark de concurrencia para call_claude
+Mide cuántas invocaciones concurrentes de call_claude puede atender un solo
+proceso contra un mock local de la API de Anthropic (no usa internet ni saldo)
+
+Uso:
+    python benchmark_concurrency.py --latency 0.5 --levels 1,10,50,100
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+import mock_anthropic
+
+async def run_level(mcp, concurrency: int) -> float:
+    """Lanza `concurrency` llamadas distintas a call_claude a la vez y retorna el tiempo total"""
+    # A different prompt per call, so neither the response cache nor coalescing can merge them
+    calls = [{"model": "claude-3-5-sonnet-20241022", "prompt": f"Hola {index}", "max_tokens": 16} for index in range(concurrency)]
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[mcp.call_tool("call_claude", arguments) for arguments in calls])
+    elapsed = time.perf_counter() - start
+
+    errors = [r for r in results if r[0].text.startswith("Error")]
+    if errors:
+        raise RuntimeError(f"{len(errors)} llamadas fallaron: {errors[0][0].text}")
+
+    return elapsed
+
+async def run_sync_level(app, concurrency: int) -> float:
+    """Mismo escenario usando el cliente bloqueante (requests) dentro del event loop"""
+
+    async def blocking_call():
+        return app.call_claude_api("claude-3-5-sonnet-20241022", "Hola", 16)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[blocking_call() for _ in range(concurrency)])
+    return time.perf_counter() - start
+
+async def main(latency: float, levels, include_sync: bool) -> None:
+    import app
+
+    # httpx logs every request at INFO level, which would flood the report
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    print(f"{'modo':<8}{'concurrencia':>14}{'tiempo (s)':>14}{'llamadas/s':>14}")
+    for concurrency in levels:
+        elapsed = await run_level(app.mcp, concurrency)
+        print(f"{'async':<8}{concurrency:>14}{elapsed:>14.2f}{concurrency / elapsed:>14.1f}")
+
+        if include_sync:
+            elapsed = await run_sync_level(app, concurrency)
+            print(f"{'sync':<8}{concurrency:>14}{elapsed:>14.2f}{concurrency / elapsed:>14.1f}")
+
+    await app.claude_client.close_async_client()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de concurrencia de call_claude")
+    parser.add_argument("--latency", type=float, default=0.5, help="Latencia simulada del upstream en segundos")
+    parser.add_argument("--levels", default="1,10,50,100", help="Niveles de concurrencia separados por comas")
+    parser.add_argument("--no-sync", action="store_true", help="No medir el cliente bloqueante")
+    args = parser.parse_args()
+
+    port = mock_anthropic.find_free_port()
+    mock_anthropic.start_in_thread(port, args.latency)
+
+    # Point the server at the local mock before importing app
+    os.environ["ANTHROPIC_API_URL"] = f"http://127.0.0.1:{port}/v1/messages"
+    os.environ["ANTHROPIC_API_KEY"] = "sk-ant-benchmark"
+    # Measure the upstream path only: no response cache and no merging of concurrent calls
+    os.environ["CLAUDE_CACHE_ENABLED"] = "false"
+    os.environ["CLAUDE_COALESCE_ENABLED"] = "false"
+
+    levels = [int(level) for level in args.levels.split(",")]
+    asyncio.run(main(args.latency, levels, not args.no_sync))
@@ -0,0 +1,335 @@
+"""
+Benchmark de carga del servidor MCP completo
+Arranca el mock de Anthropic y el servidor (app.py) en un proceso aparte, abre
+N sesiones MCP reales (SSE o Streamable HTTP) que llaman a call_claude y
+reporta throughput, latencias p50/p95/p99 y memoria del servidor. No usa
+internet ni saldo, así que sirve para detectar regresiones antes de desplegar.
+
+Uso:
+    python benchmark_load.py --sessions 1,10,100 --calls 5
+    python benchmark_load.py --sessions 50 --latency-dist lognormal --error-529 0.02 --json resultados.json
+    python benchmark_load.py --sessions 200 --workers 4 --server-env CLAUDE_RATE_MAX_CONCURRENCY=64
+    python benchmark_load.py --sessions 100 --workers 4 --state redis
+    python benchmark_load.py --sessions 10 --bulk-sessions 4 --server-env CLAUDE_RATE_MAX_CONCURRENCY=8
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+import httpx
+from mcp import ClientSession
+from mcp.client.sse import sse_client
+from mcp.client.streamable_http import streamablehttp_client
+
+import mock_anthropic
+import mock_redis
+
+MODEL = "claude-3-5-sonnet-20241022"
+
+def percentile(values: List[float], q: float) -> float:
+    """Percentil `q` (0-100) por rango más cercano"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))]
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """Memoria residente del proceso y sus descendientes (router y workers); None fuera de Linux"""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as children:
+                    pending.extend(int(child) for child in children.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            if current == pid:
+                return None
+    return total
+
+class MemorySampler:
+    """Muestrea la memoria del servidor en segundo plano y guarda el pico"""
+
+    def __init__(self, pid: int, interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+
+    async def run(self) -> None:
+        while True:
+            self.peak = max(self.peak, rss_bytes(self.pid) or 0)
+            await asyncio.sleep(self.interval)
+
+def wait_for_port(port: int, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("el servidor terminó al arrancar")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"el servidor no respondió en {timeout:g}s")
+
+def start_server(
+    port: int,
+    mock_port: int,
+    transport: str,
+    workers: int,
+    extra_env: Dict[str, str],
+    state_dir: str,
+    script: str = "app.py",
+    wait: bool = True,
+) -> subprocess.Popen:
+    """Arranca el servidor (`script`) apuntando al mock, con almacenes en un directorio temporal"""
+    env = dict(
+        os.environ,
+        PORT=str(port),
+        ANTHROPIC_API_URL=f"http://127.0.0.1:{mock_port}/v1/messages",
+        ANTHROPIC_API_KEY="sk-ant-benchmark",
+        MCP_TRANSPORT=transport,
+        WEB_CONCURRENCY=str(workers),
+        # Every call is distinct, but keep the response cache out of the measurement anyway
+        CLAUDE_CACHE_ENABLED="false",
+        CLAUDE_BATCH_DB=os.path.join(state_dir, "batch_jobs.db"),
+        CLAUDE_USAGE_DB=os.path.join(state_dir, "usage_ledger.db"),
+        CLAUDE_BLOB_DIR=os.path.join(state_dir, "blobs"),
+    )
+    env.update(extra_env)
+    process = subprocess.Popen(
+        [sys.executable, script],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    if wait:
+        wait_for_port(port, process)
+    return process
+
+def open_session(base_url: str, transport: str, client_id: Optional[str] = None):
+    headers = {"X-Client-Id": client_id} if client_id else None
+    if transport == "sse":
+        return sse_client(f"{base_url}/sse", headers=headers, timeout=30, sse_read_timeout=600)
+    return streamablehttp_client(f"{base_url}/mcp/", headers=headers, timeout=timedelta(seconds=30), sse_read_timeout=timedelta(seconds=600))
+
+async def run_session(base_url: str, transport: str, index: int, calls: int, stream: bool, ready: asyncio.Event, opened: List[int], results: Dict) -> None:
+    """Una sesión MCP: se conecta, espera a que todas estén abiertas y hace `calls` llamadas seguidas"""
+    try:
+        async with open_session(base_url, transport, f"bench-{index}") as streams:
+            async with ClientSession(streams[0], streams[1]) as session:
+                await session.initialize()
+                opened.append(index)
+                await ready.wait()
+
+                for call in range(calls):
+                    arguments = {"model": MODEL, "prompt": f"Pregunta {index}-{call}", "max_tokens": 64, "stream": stream}
+                    start = time.perf_counter()
+                    result = await session.call_tool("call_claude", arguments)
+                    elapsed = time.perf_counter() - start
+                    text = result.content[0].text if result.content else ""
+                    if result.isError or text.startswith("Error"):
+                        results["errors"].append(text)
+                    else:
+                        results["latencies"].append(elapsed)
+    except Exception as e:
+        opened.append(index)
+        results["errors"].append(f"sesión {index}: {e!r}")
+
+async def run_bulk_session(args, base_url: str, index: int, ready: asyncio.Event, done: asyncio.Event, opened: List[int], results: Dict) -> None:
+    """Una sesión de carga bulk: repite call_claude_batch con `--bulk-items` prompts hasta que terminan las sesiones interactivas"""
+    try:
+        async with open_session(base_url, args.transport, f"bulk-{index}") as streams:
+            async with ClientSession(streams[0], streams[1]) as session:
+                await session.initialize()
+                opened.append(-1 - index)
+                await ready.wait()
+
+                batch = 0
+                while not done.is_set():
+                    items = [{"model": MODEL, "prompt": f"Lote {index}-{batch}-{item}", "max_tokens": 64} for item in range(args.bulk_items)]
+                    result = await session.call_tool("call_claude_batch", {"items": items, "priority": args.bulk_priority})
+                    text = result.content[0].text if result.content else ""
+                    if result.isError or text.startswith("Error"):
+                        results["bulk_errors"].append(text)
+                        continue
+                    entries = json.loads(text)
+                    results["bulk_calls"] += sum(1 for entry in entries if "error" not in entry)
+                    results["bulk_errors"].extend(entry["error"] for entry in entries if "error" in entry)
+                    batch += 1
+    except Exception as e:
+        opened.append(-1 - index)
+        results["bulk_errors"].append(f"sesión bulk {index}: {e!r}")
+
+async def run_level(args, sessions: int, mock_port: int) -> Dict:
+    """Arranca un servidor limpio, abre `sessions` sesiones y mide la carga"""
+    port = mock_anthropic.find_free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as state_dir:
+        server_env = dict(args.server_env)
+        if args.state == "sqlite":
+            server_env["CLAUDE_STATE_BACKEND"] = f"sqlite:///{os.path.join(state_dir, 'state.db')}"
+        elif args.state == "redis":
+            server_env["CLAUDE_STATE_BACKEND"] = f"redis://127.0.0.1:{args.redis_port}/0"
+        server = start_server(port, mock_port, args.transport, args.workers, server_env, state_dir)
+        try:
+            await asyncio.sleep(0.5)
+            baseline = rss_bytes(server.pid)
+            async with httpx.AsyncClient() as client:
+                upstream_before = (await client.get(f"http://127.0.0.1:{mock_port}/stats")).json()
+            sampler = MemorySampler(server.pid)
+            sampling = asyncio.ensure_future(sampler.run())
+
+            ready = asyncio.Event()
+            bulk_ready = asyncio.Event()
+            done = asyncio.Event()
+            opened: List[int] = []
+            results = {"latencies": [], "errors": [], "bulk_calls": 0, "bulk_errors": []}
+            tasks = [
+                asyncio.ensure_future(run_session(base_url, args.transport, i, args.calls, args.stream, ready, opened, results))
+                for i in range(sessions)
+            ]
+            bulk_tasks = [
+                asyncio.ensure_future(run_bulk_session(args, base_url, i, bulk_ready, done, opened, results))
+                for i in range(args.bulk_sessions)
+            ]
+            while len(opened) < sessions + args.bulk_sessions:
+                await asyncio.sleep(0.05)
+            with_sessions = rss_bytes(server.pid)
+
+            if bulk_tasks:
+                # Let the bulk load fill the queues before the interactive calls start
+                bulk_ready.set()
+                await asyncio.sleep(2 * args.latency)
+            start = time.perf_counter()
+            ready.set()
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - start
+            done.set()
+            await asyncio.gather(*bulk_tasks)
+            sampling.cancel()
+
+            async with httpx.AsyncClient() as client:
+                upstream_after = (await client.get(f"http://127.0.0.1:{mock_port}/stats")).json()
+            upstream = {key: upstream_after[key] - upstream_before.get(key, 0) for key in upstream_after}
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+    latencies = results["latencies"]
+    mb = 1024 * 1024
+    return {
+        "sessions": sessions,
+        "calls": len(latencies) + len(results["errors"]),
+        "errors": len(results["errors"]),
+        "first_error": results["errors"][0] if results["errors"] else None,
+        "seconds": round(elapsed, 3),
+        "calls_per_second": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(1000 * percentile(latencies, 50), 1),
+        "p95_ms": round(1000 * percentile(latencies, 95), 1),
+        "p99_ms": round(1000 * percentile(latencies, 99), 1),
+        "rss_baseline_mb": round(baseline / mb, 1) if baseline else None,
+        "rss_sessions_mb": round(with_sessions / mb, 1) if with_sessions else None,
+        "kb_per_session": round((with_sessions - baseline) / 1024 / sessions, 1) if baseline and with_sessions else None,
+        "rss_peak_mb": round(sampler.peak / mb, 1) if sampler.peak else None,
+        "bulk_calls": results["bulk_calls"],
+        "bulk_errors": len(results["bulk_errors"]),
+        "upstream": upstream,
+    }
+
+def print_row(row: Dict) -> None:
+    def value(key: str, width: int) -> str:
+        cell = row[key]
+        return f"{'-' if cell is None else cell:>{width}}"
+
+    print(
+        value("sessions", 9) + value("calls", 9) + value("errors", 8) + value("calls_per_second", 12)
+        + value("p50_ms", 10) + value("p95_ms", 10) + value("p99_ms", 10)
+        + value("rss_baseline_mb", 10) + value("rss_sessions_mb", 12) + value("kb_per_session", 12) + value("rss_peak_mb", 10)
+    )
+
+async def main(args) -> None:
+    mock_port = mock_anthropic.find_free_port()
+    mock_anthropic.start_in_thread(
+        mock_port,
+        args.latency,
+        latency_dist=args.latency_dist,
+        error_429=args.error_429,
+        error_529=args.error_529,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    if args.state == "redis":
+        # Local stand-in for the shared Redis of a multi-replica deployment
+        args.redis_port = mock_anthropic.find_free_port()
+        mock_redis.start_in_thread(args.redis_port)
+
+    print(
+        f"🧪 {args.transport}, {args.workers} worker(s), estado {args.state}, {args.calls} llamadas por sesión, "
+        f"latencia {args.latency}s ({args.latency_dist}), 429: {args.error_429:.1%}, 529: {args.error_529:.1%}"
+    )
+    print(
+        f"{'sesiones':>9}{'llamadas':>9}{'errores':>8}{'llamadas/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        f"{'RSS MB':>10}{'+sesiones':>12}{'KB/sesión':>12}{'pico MB':>10}"
+    )
+    report = []
+    for sessions in args.sessions:
+        row = await run_level(args, sessions, mock_port)
+        report.append(row)
+        print_row(row)
+        if args.bulk_sessions:
+            print(f"   📦 bulk ({args.bulk_priority}): {row['bulk_calls']} llamadas, {row['bulk_errors']} errores")
+        if row["first_error"]:
+            print(f"   ⚠️  {row['first_error'][:200]}")
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump({"config": {k: v for k, v in vars(args).items() if k != "json"}, "results": report}, output, indent=2)
+        print(f"📄 Resultados guardados en {args.json}")
+
+def parse_env(values: List[str]) -> Dict[str, str]:
+    env = {}
+    for item in values:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return env
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de carga del servidor MCP con sesiones reales")
+    parser.add_argument("--sessions", default="1,10,50", help="Sesiones concurrentes por nivel, separadas por comas")
+    parser.add_argument("--calls", type=int, default=5, help="Llamadas a call_claude por sesión")
+    parser.add_argument("--transport", choices=("sse", "streamable-http"), default="sse")
+    parser.add_argument("--workers", type=int, default=1, help="WEB_CONCURRENCY del servidor")
+    parser.add_argument("--stream", action="store_true", help="Llamar a call_claude con stream=true")
+    parser.add_argument("--latency", type=float, default=0.5, help="Latencia media del upstream en segundos")
+    parser.add_argument("--latency-dist", choices=mock_anthropic.LATENCY_DISTRIBUTIONS, default="lognormal")
+    parser.add_argument("--error-429", type=float, default=0.0, help="Fracción de respuestas 429 del upstream")
+    parser.add_argument("--error-529", type=float, default=0.0, help="Fracción de respuestas 529 del upstream")
+    parser.add_argument("--retry-after", type=float, default=0.5, help="Retry-After de los errores inyectados")
+    parser.add_argument("--seed", type=int, default=1, help="Semilla del mock")
+    parser.add_argument("--state", choices=("memory", "sqlite", "redis"), default="memory", help="Backend de estado compartido del servidor (redis usa mock_redis)")
+    parser.add_argument("--bulk-sessions", type=int, default=0, help="Sesiones extra que lanzan call_claude_batch sin parar mientras se mide")
+    parser.add_argument("--bulk-items", type=int, default=20, help="Items por cada call_claude_batch de las sesiones bulk")
+    parser.add_argument("--bulk-priority", choices=("bulk", "interactive"), default="bulk", help="Prioridad de las llamadas de las sesiones bulk")
+    parser.add_argument("--server-env", action="append", default=[], metavar="CLAVE=VALOR", help="Variable de entorno extra para el servidor")
+    parser.add_argument("--json", help="Fichero donde guardar los resultados")
+    args = parser.parse_args()
+    args.sessions = [int(level) for level in args.sessions.split(",")]
+    args.server_env = parse_env(args.server_env)
+
+    asyncio.run(main(args))
@@ -0,0 +1,169 @@
+"""
+Benchmark de arranque del servidor MCP
+Mide, desde que se lanza el proceso, cuánto tarda en aceptar conexiones, en
+responder 200 en /health y en completar la primera llamada a call_claude
+(contra el mock de Anthropic), comparando startup.py (carga en segundo plano)
+con python app.py. También desglosa el tiempo de importación de app.py por
+paquete con `python -X importtime`.
+
+Uso:
+    python benchmark_startup.py --runs 5
+    python benchmark_startup.py --entry startup.py --transport streamable-http --json arranque.json
+    python benchmark_startup.py --imports-only --top 20
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+from mcp import ClientSession
+
+import benchmark_load
+import mock_anthropic
+
+POLL_INTERVAL = 0.02
+
+def import_breakdown(state_dir: str) -> Dict:
+    """Importa app.py en un proceso limpio con -X importtime y agrupa el tiempo propio por paquete"""
+    env = dict(
+        os.environ,
+        CLAUDE_BATCH_DB=os.path.join(state_dir, "batch_jobs.db"),
+        CLAUDE_USAGE_DB=os.path.join(state_dir, "usage_ledger.db"),
+    )
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    wall = time.perf_counter() - start
+
+    packages: Dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(self_us)
+    total = sum(packages.values())
+    return {
+        "process_seconds": round(wall, 3),
+        "import_ms": round(total / 1000, 1),
+        "packages": {name: round(us / 1000, 1) for name, us in sorted(packages.items(), key=lambda item: -item[1])},
+    }
+
+async def wait_listening(port: int, start: float) -> float:
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return time.perf_counter() - start
+        except OSError:
+            await asyncio.sleep(POLL_INTERVAL)
+
+async def wait_healthy(base_url: str, start: float) -> float:
+    """Primer 200 en /health (app.py solo responde cuando ya cargó todo)"""
+    async with httpx.AsyncClient(timeout=5) as client:
+        while True:
+            try:
+                if (await client.get(f"{base_url}/health")).status_code == 200:
+                    return time.perf_counter() - start
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(POLL_INTERVAL)
+
+async def first_call(base_url: str, transport: str, start: float) -> float:
+    """Lo que vería un agente: conectar (reintentando si el puerto aún no está abierto) y llamar a call_claude"""
+    while True:
+        try:
+            async with benchmark_load.open_session(base_url, transport) as streams:
+                async with ClientSession(streams[0], streams[1]) as session:
+                    await session.initialize()
+                    result = await session.call_tool("call_claude", {"model": benchmark_load.MODEL, "prompt": "hola", "max_tokens": 16})
+                    if result.isError or result.content[0].text.startswith("Error"):
+                        raise RuntimeError(result.content[0].text)
+                    return time.perf_counter() - start
+        except (httpx.TransportError, OSError):
+            await asyncio.sleep(POLL_INTERVAL)
+        except Exception as e:
+            # anyio task groups wrap connection errors in ExceptionGroup
+            if not any(isinstance(error, (httpx.TransportError, OSError)) for error in getattr(e, "exceptions", [])):
+                raise
+            await asyncio.sleep(POLL_INTERVAL)
+
+async def measure(args, entry: str, mock_port: int) -> Dict:
+    port = mock_anthropic.find_free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as state_dir:
+        start = time.perf_counter()
+        server = benchmark_load.start_server(port, mock_port, args.transport, args.workers, {}, state_dir, script=entry, wait=False)
+        try:
+            listen, healthy, call = await asyncio.wait_for(asyncio.gather(
+                wait_listening(port, start),
+                wait_healthy(base_url, start),
+                first_call(base_url, args.transport, start),
+            ), timeout=60)
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+    return {"listen": listen, "healthy": healthy, "first_call": call}
+
+def summarize(samples: List[Dict]) -> Dict:
+    return {
+        key: {"median_ms": round(1000 * statistics.median(s[key] for s in samples), 1), "min_ms": round(1000 * min(s[key] for s in samples), 1)}
+        for key in samples[0]
+    }
+
+async def main(args) -> None:
+    report = {}
+    with tempfile.TemporaryDirectory() as state_dir:
+        breakdown = import_breakdown(state_dir)
+    report["imports"] = breakdown
+    print(f"📦 import app: {breakdown['import_ms']:.0f} ms de importación ({breakdown['process_seconds']:.2f}s con el intérprete)")
+    for name, ms in list(breakdown["packages"].items())[:args.top]:
+        print(f"   {name:<28}{ms:>8.1f} ms {ms / breakdown['import_ms']:>6.1%}")
+
+    if not args.imports_only:
+        mock_port = mock_anthropic.find_free_port()
+        mock_anthropic.start_in_thread(mock_port, args.latency)
+        print(f"\n🧪 {args.transport}, {args.workers} worker(s), {args.runs} arranques por entrada (mediana / mínimo)")
+        print(f"{'entrada':<14}{'escucha ms':>18}{'/health ms':>18}{'1ª llamada ms':>18}")
+        report["entries"] = {}
+        for entry in args.entry:
+            samples = [await measure(args, entry, mock_port) for _ in range(args.runs)]
+            summary = summarize(samples)
+            report["entries"][entry] = summary
+            print(f"{entry:<14}" + "".join(
+                f"{summary[key]['median_ms']:>10.0f} / {summary[key]['min_ms']:<5.0f}" for key in ("listen", "healthy", "first_call")
+            ))
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump({"config": {k: v for k, v in vars(args).items() if k != "json"}, "results": report}, output, indent=2)
+        print(f"📄 Resultados guardados en {args.json}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de arranque del servidor MCP")
+    parser.add_argument("--runs", type=int, default=5, help="Arranques por entrada")
+    parser.add_argument("--entry", default="startup.py,app.py", help="Scripts a comparar, separados por comas")
+    parser.add_argument("--transport", choices=("sse", "streamable-http"), default="sse")
+    parser.add_argument("--workers", type=int, default=1, help="WEB_CONCURRENCY del servidor")
+    parser.add_argument("--latency", type=float, default=0.05, help="Latencia del mock en segundos")
+    parser.add_argument("--top", type=int, default=12, help="Paquetes a mostrar en el desglose de importación")
+    parser.add_argument("--imports-only", action="store_true", help="Solo el desglose de importación")
+    parser.add_argument("--json", help="Fichero donde guardar los resultados")
+    args = parser.parse_args()
+    args.entry = args.entry.split(",")
+
+    asyncio.run(main(args))
@@ -0,0 +1,338 @@
+"""
+Almacén de blobs para prompts y respuestas grandes
+Guarda en disco, un fichero por blob con su sha256 como id, los textos que los
+clientes suben por HTTP (POST /blobs) o a trozos con upload_claude_blob, y las
+respuestas de Claude demasiado largas para devolverlas enteras. Una llamada
+puede usar un blob como prompt por referencia: se envía a Anthropic leyéndolo
+del disco a trozos, sin cargarlo entero en memoria. Las respuestas largas se
+devuelven como un enlace claude://blobs/{id} que el cliente lee por páginas.
+"""
+
+import codecs
+import hashlib
+import os
+import re
+import time
+import uuid
+from typing import AsyncIterable, Dict, Iterable, Iterator
+
+URI_PREFIX = "claude://blobs/"
+CHUNK_SIZE = 64 * 1024
+
+_BLOB_ID = re.compile(r"^[0-9a-f]{64}$")
+_UPLOAD_ID = re.compile(r"^[0-9a-f]{32}$")
+# Expired blobs and abandoned uploads are removed at most this often
+SWEEP_INTERVAL = 60
+
+class BlobError(ValueError):
+    """Blob inexistente o caducado, o subida inválida"""
+
+class BlobTooLarge(BlobError):
+    """El blob supera CLAUDE_BLOB_MAX_BYTES"""
+
+def parse_ref(value: str) -> str:
+    """Retorna el id de un blob a partir de su URI (claude://blobs/{id}) o del id suelto"""
+    blob_id = value.strip()
+    if blob_id.startswith(URI_PREFIX):
+        blob_id = blob_id[len(URI_PREFIX):].split("/", 1)[0]
+    if not _BLOB_ID.match(blob_id):
+        raise BlobError(f"referencia de blob inválida: '{value}' (usa el blob_id o claude://blobs/{{blob_id}})")
+    return blob_id
+
+class BlobRef:
+    """
+    Texto de un blob dentro de una petición a la API.
+
+    claude_client lo serializa leyendo el fichero a trozos (`iter_text`), así
+    que el texto no llega a estar entero en memoria. `size` (bytes UTF-8) sirve
+    para estimar tokens y `ref` identifica el contenido en la caché de respuestas.
+    """
+
+    # The text may need JSON escaping (see attachments.EncodedRef for base64, which does not)
+    json_safe = False
+
+    def __init__(self, path: str, blob_id: str, size: int):
+        self.path = path
+        self.blob_id = blob_id
+        self.size = size
+
+    @property
+    def ref(self) -> str:
+        return URI_PREFIX + self.blob_id
+
+    @property
+    def chars(self) -> int:
+        """Tamaño para estimar tokens (~4 por token)"""
+        return self.size
+
+    def iter_text(self) -> Iterator[str]:
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        with open(self.path, "rb") as source:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                text = decoder.decode(chunk)
+                if text:
+                    yield text
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            yield tail
+
+    def read(self) -> str:
+        return "".join(self.iter_text())
+
+class _Writer:
+    """Fichero temporal de un blob en escritura: calcula el sha256 y valida UTF-8 y tamaño al vuelo"""
+
+    def __init__(self, store: "BlobStore", path: str, mode: str = "wb"):
+        self.store = store
+        self.path = path
+        self.file = open(path, mode)
+        self.size = self.file.tell()
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+
+    def write(self, chunk: bytes) -> None:
+        self.size += len(chunk)
+        if self.size > self.store.max_bytes:
+            self.abort()
+            raise BlobTooLarge(f"el blob supera el máximo de {self.store.max_bytes} bytes (CLAUDE_BLOB_MAX_BYTES)")
+        try:
+            self.decoder.decode(chunk)
+        except UnicodeDecodeError:
+            self.abort()
+            raise BlobError("el contenido no es texto UTF-8 válido")
+        self.file.write(chunk)
+
+    def abort(self) -> None:
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class BlobStore:
+    """
+    Blobs de texto direccionados por contenido en un directorio.
+
+    Subir dos veces el mismo texto produce el mismo id y un solo fichero. Los
+    blobs caducan tras `ttl` segundos sin usarse (leerlos o usarlos como prompt
+    renueva el plazo) y, si el total supera `max_total_bytes`, se borran los
+    menos usados. El directorio se crea con la primera escritura.
+    """
+
+    def __init__(self, path: str = "blobs", max_bytes: int = 20 * 1024 * 1024, max_total_bytes: int = 1024 ** 3, ttl: float = 86400, page_bytes: int = 65536):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_total_bytes = max_total_bytes
+        self.ttl = ttl
+        self.page_bytes = page_bytes
+        self.last_sweep = 0.0
+        self.writes = 0
+        self.deduplicated = 0
+        self.pages_served = 0
+        self.expired = 0
+
+    def _blob_path(self, blob_id: str) -> str:
+        return os.path.join(self.path, blob_id)
+
+    def _upload_path(self, upload_id: str) -> str:
+        if not _UPLOAD_ID.match(upload_id):
+            raise BlobError(f"upload_id inválido: '{upload_id}'")
+        return os.path.join(self.path, f"upload-{upload_id}.part")
+
+    def _new_writer(self) -> _Writer:
+        os.makedirs(self.path, exist_ok=True)
+        return _Writer(self, os.path.join(self.path, f"tmp-{uuid.uuid4().hex}.part"))
+
+    def _commit(self, writer: _Writer) -> Dict:
+        """Cierra un fichero temporal completo y lo publica con su sha256 como id"""
+        try:
+            writer.decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            writer.abort()
+            raise BlobError("el contenido termina a mitad de un carácter UTF-8")
+        writer.file.close()
+
+        digest = hashlib.sha256()
+        with open(writer.path, "rb") as source:
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+        blob_id = digest.hexdigest()
+        path = self._blob_path(blob_id)
+        if os.path.exists(path):
+            os.remove(writer.path)
+            os.utime(path)
+            self.deduplicated += 1
+        else:
+            os.replace(writer.path, path)
+        self.writes += 1
+        self.sweep()
+        return self.info(blob_id)
+
+    def write(self, chunks: Iterable[bytes]) -> Dict:
+        """Guarda un blob a partir de trozos de bytes UTF-8 y retorna su info"""
+        writer = self._new_writer()
+        for chunk in chunks:
+            writer.write(chunk)
+        return self._commit(writer)
+
+    async def write_async(self, chunks: AsyncIterable[bytes]) -> Dict:
+        """Igual que write() para un cuerpo HTTP que llega a trozos (no se acumula en memoria)"""
+        writer = self._new_writer()
+        try:
+            async for chunk in chunks:
+                writer.write(chunk)
+        except BaseException:
+            if not writer.file.closed:
+                writer.abort()
+            raise
+        return self._commit(writer)
+
+    def write_text(self, text: str) -> Dict:
+        """Guarda un texto codificándolo a trozos, sin una copia completa en bytes"""
+        step = CHUNK_SIZE // 4
+        return self.write(text[i:i + step].encode("utf-8") for i in range(0, len(text), step))
+
+    def append(self, upload_id: str, text: str) -> str:
+        """Añade texto a una subida a trozos (la crea si `upload_id` está vacío) y retorna su id"""
+        if not upload_id:
+            os.makedirs(self.path, exist_ok=True)
+            upload_id = uuid.uuid4().hex
+            open(self._upload_path(upload_id), "wb").close()
+        path = self._upload_path(upload_id)
+        if not os.path.exists(path):
+            raise BlobError(f"no existe la subida '{upload_id}' (o caducó)")
+        writer = _Writer(self, path, "ab")
+        writer.write(text.encode("utf-8"))
+        writer.file.close()
+        return upload_id
+
+    def finish(self, upload_id: str) -> Dict:
+        """Cierra una subida a trozos y la convierte en un blob"""
+        path = self._upload_path(upload_id)
+        if not os.path.exists(path):
+            raise BlobError(f"no existe la subida '{upload_id}' (o caducó)")
+        writer = _Writer(self, path, "ab")
+        return self._commit(writer)
+
+    def _existing_path(self, blob_id: str) -> str:
+        path = self._blob_path(blob_id)
+        try:
+            modified = os.stat(path).st_mtime
+        except FileNotFoundError:
+            raise BlobError(f"no existe el blob '{blob_id}' (o caducó)")
+        if time.time() - modified > self.ttl:
+            raise BlobError(f"no existe el blob '{blob_id}' (o caducó)")
+        # Using a blob keeps it alive
+        os.utime(path)
+        return path
+
+    def ref(self, value: str) -> BlobRef:
+        """Referencia para usar el blob como texto de una petición"""
+        blob_id = parse_ref(value)
+        path = self._existing_path(blob_id)
+        return BlobRef(path, blob_id, os.path.getsize(path))
+
+    def info(self, blob_id: str) -> Dict:
+        size = os.path.getsize(self._blob_path(blob_id))
+        return {
+            "blob_id": blob_id,
+            "uri": URI_PREFIX + blob_id,
+            "bytes": size,
+            "pages": max(1, -(-size // self.page_bytes)),
+            "page_bytes": self.page_bytes,
+        }
+
+    def page(self, value: str, page: int = 1) -> Dict:
+        """
+        Lee la página `page` (desde 1) de un blob.
+
+        Las páginas son de `page_bytes` bytes, con los bordes movidos al
+        siguiente inicio de carácter UTF-8 para no partir ninguno; como los dos
+        bordes se mueven igual, las páginas se encadenan sin huecos ni solapes.
+        """
+        blob_id = parse_ref(value)
+        path = self._existing_path(blob_id)
+        info = self.info(blob_id)
+        if page < 1 or page > info["pages"]:
+            raise BlobError(f"página {page} fuera de rango (el blob tiene {info['pages']})")
+
+        with open(path, "rb") as source:
+            start = self._char_boundary(source, (page - 1) * self.page_bytes, info["bytes"])
+            end = self._char_boundary(source, page * self.page_bytes, info["bytes"])
+            source.seek(start)
+            text = source.read(end - start).decode("utf-8")
+        self.pages_served += 1
+        return {**info, "page": page, "text": text}
+
+    @staticmethod
+    def _char_boundary(source, offset: int, size: int) -> int:
+        if offset >= size:
+            return size
+        source.seek(offset)
+        # UTF-8 continuation bytes look like 0b10xxxxxx; a character is at most 4 bytes
+        for index, byte in enumerate(source.read(4)):
+            if byte & 0xC0 != 0x80:
+                return offset + index
+        return min(offset + 4, size)
+
+    def sweep(self, force: bool = False) -> None:
+        """Borra los blobs caducados y las subidas abandonadas, y los menos usados si se supera el total"""
+        now = time.time()
+        if not force and now - self.last_sweep < SWEEP_INTERVAL:
+            return
+        self.last_sweep = now
+        try:
+            entries = list(os.scandir(self.path))
+        except FileNotFoundError:
+            return
+
+        blobs = []
+        for entry in entries:
+            stat = entry.stat()
+            if now - stat.st_mtime > self.ttl:
+                os.remove(entry.path)
+                self.expired += 1
+            elif _BLOB_ID.match(entry.name):
+                blobs.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in blobs)
+        for _, size, path in sorted(blobs):
+            if total <= self.max_total_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self.expired += 1
+
+    def stats(self) -> Dict:
+        count = 0
+        total = 0
+        try:
+            for entry in os.scandir(self.path):
+                if _BLOB_ID.match(entry.name):
+                    count += 1
+                    total += entry.stat().st_size
+        except FileNotFoundError:
+            pass
+        return {
+            "path": self.path,
+            "blobs": count,
+            "bytes": total,
+            "max_total_bytes": self.max_total_bytes,
+            "ttl": self.ttl,
+            "writes": self.writes,
+            "deduplicated": self.deduplicated,
+            "pages_served": self.pages_served,
+            "expired": self.expired,
+        }
+
+def store_from_env() -> BlobStore:
+    """Crea el almacén de blobs a partir de las variables de entorno"""
+    return BlobStore(
+        path=os.environ.get("CLAUDE_BLOB_DIR", "blobs"),
+        max_bytes=int(os.environ.get("CLAUDE_BLOB_MAX_BYTES", 20 * 1024 * 1024)),
+        max_total_bytes=int(os.environ.get("CLAUDE_BLOB_MAX_TOTAL_BYTES", 1024 ** 3)),
+        ttl=float(os.environ.get("CLAUDE_BLOB_TTL", 86400)),
+        page_bytes=int(os.environ.get("CLAUDE_BLOB_PAGE_BYTES", 65536)),
+    )
@@ -0,0 +1,433 @@
+"""
+Cliente HTTP asíncrono para la API de Claude (Anthropic)
+Mantiene un único cliente con pool de conexiones que vive mientras vive el servidor.
+Las peticiones grandes se codifican a JSON a trozos y las respuestas largas se
+piden en streaming y se decodifican evento a evento, sin copias completas del cuerpo.
+"""
+
+import asyncio
+import importlib.util
+import json
+import os
+import sys
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterator, Optional
+
+import httpx
+from httpx_sse import aconnect_sse
+
+import tracing
+
+DEFAULT_API_URL = "https://api.anthropic.com/v1/messages"
+ANTHROPIC_VERSION = "2023-06-01"
+
+# Error types sent inside a streaming response, mapped to their HTTP status
+STREAM_ERROR_STATUS = {"overloaded_error": 529, "rate_limit_error": 429, "api_error": 500}
+
+# Size of the chunks a streamed request body is written in
+BODY_CHUNK_SIZE = 64 * 1024
+
+class AnthropicAPIError(Exception):
+    """Respuesta de error de la API de Anthropic, con su código HTTP y cabeceras"""
+
+    def __init__(self, status_code: int, body: str, headers: Optional[Dict] = None):
+        super().__init__(f"Anthropic API error: {body}")
+        self.status_code = status_code
+        self.body = body
+        self.headers = dict(headers or {})
+
+# Shared client, created lazily on the running event loop
+_async_client = None
+_async_client_loop = None
+_sync_session = None
+
+class PoolMetrics:
+    """Contadores del pool de conexiones hacia la API de Anthropic"""
+
+    def __init__(self):
+        self.requests = 0
+        self.hits = 0
+        self.new_connections = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.connect_time_total = 0.0
+
+    def snapshot(self) -> Dict:
+        """Retorna una copia de las métricas con promedios calculados"""
+        acquired = self.hits + self.new_connections
+        return {
+            "requests": self.requests,
+            "hits": self.hits,
+            "new_connections": self.new_connections,
+            "hit_ratio": self.hits / acquired if acquired else 0.0,
+            "wait_time_avg_ms": 1000 * self.wait_time_total / acquired if acquired else 0.0,
+            "wait_time_max_ms": 1000 * self.wait_time_max,
+            "connect_time_avg_ms": 1000 * self.connect_time_total / self.new_connections if self.new_connections else 0.0,
+        }
+
+class _RequestTrace:
+    """
+    Callback de trazas de httpcore para una petición.
+
+    Distingue si la petición reutilizó una conexión del pool (hit) o tuvo que
+    abrir una nueva, y mide cuánto esperó hasta obtenerla. Dentro de una traza
+    añade los spans de cada fase: obtener la conexión, enviar la petición,
+    esperar las cabeceras (TTFB) y recibir el cuerpo (la generación).
+    """
+
+    def __init__(self, metrics: PoolMetrics):
+        self.metrics = metrics
+        self.start = time.perf_counter()
+        self.acquired = False
+        self.connect_start = None
+        self.new_connection = False
+        self.sent = None
+        self.waiting = None
+        self.received = None
+        metrics.requests += 1
+
+    def _acquire(self, now: float) -> None:
+        wait = now - self.start
+        self.acquired = True
+        self.metrics.wait_time_total += wait
+        self.metrics.wait_time_max = max(self.metrics.wait_time_max, wait)
+
+    async def __call__(self, event_name: str, info: Dict) -> None:
+        now = time.perf_counter()
+        if event_name == "connection.connect_tcp.started" and not self.acquired:
+            self._acquire(now)
+            self.metrics.new_connections += 1
+            self.connect_start = now
+            self.new_connection = True
+        elif event_name.endswith(".send_request_headers.started"):
+            if not self.acquired:
+                self._acquire(now)
+                self.metrics.hits += 1
+            elif self.connect_start is not None:
+                self.metrics.connect_time_total += now - self.connect_start
+                self.connect_start = None
+            if self.sent is None:
+                self.sent = now
+                tracing.record("http.connection", self.start, now, **{"http.connection.new": self.new_connection})
+        elif event_name.endswith(".receive_response_headers.started") and self.sent is not None and self.waiting is None:
+            self.waiting = now
+            tracing.record("http.send", self.sent, now)
+        elif event_name.endswith(".receive_response_headers.complete") and self.waiting is not None and self.received is None:
+            self.received = now
+            tracing.record("upstream.ttfb", self.waiting, now)
+        elif event_name.endswith(".response_closed.started") and self.received is not None:
+            tracing.record("upstream.generate", self.received, now)
+            self.received = None
+
+pool_metrics = PoolMetrics()
+
+def get_api_url() -> str:
+    """Retorna la URL del endpoint de mensajes (configurable con ANTHROPIC_API_URL)"""
+    return os.environ.get("ANTHROPIC_API_URL", DEFAULT_API_URL)
+
+def get_timeout() -> httpx.Timeout:
+    """Construye los timeouts de conexión y lectura a partir del entorno"""
+    connect_timeout = float(os.environ.get("ANTHROPIC_CONNECT_TIMEOUT", 10))
+    read_timeout = float(os.environ.get("ANTHROPIC_READ_TIMEOUT", 600))
+    return httpx.Timeout(read_timeout, connect=connect_timeout)
+
+def get_limits() -> httpx.Limits:
+    """Límites del pool de conexiones a partir del entorno"""
+    return httpx.Limits(
+        max_connections=int(os.environ.get("ANTHROPIC_POOL_MAX_CONNECTIONS", 100)),
+        max_keepalive_connections=int(os.environ.get("ANTHROPIC_POOL_MAX_KEEPALIVE", 20)),
+        keepalive_expiry=float(os.environ.get("ANTHROPIC_POOL_KEEPALIVE_EXPIRY", 30)),
+    )
+
+_http2_warned = False
+
+def http2_enabled() -> bool:
+    """
+    Indica si se debe usar HTTP/2.
+
+    ANTHROPIC_HTTP2 acepta "auto" (default, se activa si el paquete h2 está
+    instalado), "true" o "false". Con "true" y sin h2 se avisa una vez por
+    stderr y se sigue con HTTP/1.1.
+    """
+    global _http2_warned
+
+    setting = os.environ.get("ANTHROPIC_HTTP2", "auto").lower()
+    available = importlib.util.find_spec("h2") is not None
+    if setting == "auto":
+        return available
+    if setting not in ("1", "true", "yes"):
+        return False
+    if not available and not _http2_warned:
+        _http2_warned = True
+        print("⚠️  ANTHROPIC_HTTP2=true pero el paquete h2 no está instalado (pip install 'httpx[http2]'); se usa HTTP/1.1", file=sys.stderr)
+    return available
+
+def get_stream_body_min_chars() -> int:
+    """Tamaño (caracteres de texto) a partir del que el cuerpo de la petición se codifica a trozos"""
+    return int(os.environ.get("CLAUDE_STREAM_BODY_MIN_CHARS", 256 * 1024))
+
+def get_stream_response_min_tokens() -> int:
+    """max_tokens a partir del que la respuesta se pide en streaming aunque el cliente no lo pida (0 = nunca)"""
+    return int(os.environ.get("CLAUDE_STREAM_RESPONSE_MIN_TOKENS", 8192))
+
+def _leaves(value) -> Iterator:
+    if isinstance(value, dict):
+        for item in value.values():
+            yield from _leaves(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _leaves(item)
+    else:
+        yield value
+
+def payload_chars(value) -> int:
+    """
+    Caracteres de texto de una petición (o de una parte, como `messages`) sin serializarla.
+    Los blobs por referencia (objetos con `iter_text`) cuentan por su `chars`: el tamaño
+    en bytes de un texto o una estimación equivalente para imágenes y PDF.
+    """
+    total = 0
+    for leaf in _leaves(value):
+        if isinstance(leaf, str):
+            total += len(leaf)
+        elif hasattr(leaf, "iter_text"):
+            total += leaf.chars
+    return total
+
+def iter_json(value) -> Iterator[str]:
+    """
+    Serializa `value` a JSON por fragmentos, igual que json.dumps(ensure_ascii=False).
+
+    Los textos por referencia (objetos con `iter_text`, como blobs.BlobRef) se
+    leen y escapan a trozos, así que nunca están enteros en memoria.
+    """
+    if isinstance(value, dict):
+        yield "{"
+        for index, (key, item) in enumerate(value.items()):
+            yield ("," if index else "") + json.encoder.encode_basestring(str(key)) + ":"
+            yield from iter_json(item)
+        yield "}"
+    elif isinstance(value, list):
+        yield "["
+        for index, item in enumerate(value):
+            if index:
+                yield ","
+            yield from iter_json(item)
+        yield "]"
+    elif isinstance(value, str):
+        yield json.encoder.encode_basestring(value)
+    elif hasattr(value, "iter_text"):
+        yield '"'
+        for text in value.iter_text():
+            yield text if value.json_safe else json.encoder.encode_basestring(text)[1:-1]
+        yield '"'
+    else:
+        yield json.dumps(value)
+
+async def aiter_body(payload: Dict) -> AsyncIterator[bytes]:
+    """Cuerpo JSON de la petición en trozos de ~BODY_CHUNK_SIZE bytes (se envía con chunked encoding)"""
+    pending = []
+    size = 0
+    for fragment in iter_json(payload):
+        pending.append(fragment)
+        size += len(fragment)
+        if size >= BODY_CHUNK_SIZE:
+            yield "".join(pending).encode("utf-8")
+            pending = []
+            size = 0
+    if pending:
+        yield "".join(pending).encode("utf-8")
+
+def request_body(payload: Dict) -> Dict:
+    """
+    Argumentos de httpx para enviar `payload`: `json=` para peticiones normales
+    y un cuerpo codificado a trozos si es grande o lleva textos por referencia
+    """
+    streamed = any(hasattr(leaf, "iter_text") for leaf in _leaves(payload))
+    if streamed or payload_chars(payload) >= get_stream_body_min_chars():
+        return {"content": aiter_body(payload)}
+    return {"json": payload}
+
+def build_headers(api_key: str) -> Dict[str, str]:
+    """Cabeceras comunes para todas las llamadas a la API de Anthropic"""
+    return {
+        "Content-Type": "application/json",
+        "x-api-key": api_key or "",
+        "anthropic-version": ANTHROPIC_VERSION,
+    }
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Retorna el cliente HTTP asíncrono compartido.
+
+    El cliente se crea la primera vez que se usa y se reutiliza en todas las
+    llamadas posteriores. Si el event loop cambia (por ejemplo en scripts que
+    llaman a asyncio.run varias veces) se crea uno nuevo.
+    """
+    global _async_client, _async_client_loop
+
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client.is_closed or _async_client_loop is not loop:
+        _async_client = httpx.AsyncClient(
+            timeout=get_timeout(),
+            limits=get_limits(),
+            http2=http2_enabled(),
+        )
+        _async_client_loop = loop
+
+    return _async_client
+
+def get_sync_session() -> "requests.Session":
+    """Retorna la sesión de requests compartida (keep-alive) para el cliente síncrono"""
+    global _sync_session
+
+    if _sync_session is None:
+        # Only scripts use the blocking client; importing requests here keeps it off the server's startup path
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        limits = get_limits()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=limits.max_keepalive_connections)
+        _sync_session = requests.Session()
+        _sync_session.mount("https://", adapter)
+        _sync_session.mount("http://", adapter)
+
+    return _sync_session
+
+def pool_stats() -> Dict:
+    """Configuración y métricas actuales del pool de conexiones"""
+    limits = get_limits()
+    stats = pool_metrics.snapshot()
+    stats.update({
+        "http2": http2_enabled(),
+        "max_connections": limits.max_connections,
+        "max_keepalive_connections": limits.max_keepalive_connections,
+        "keepalive_expiry": limits.keepalive_expiry,
+    })
+    return stats
+
+async def close_async_client() -> None:
+    """Cierra el cliente compartido y libera sus conexiones"""
+    global _async_client, _async_client_loop
+
+    if _async_client is not None and not _async_client.is_closed:
+        await _async_client.aclose()
+    _async_client = None
+    _async_client_loop = None
+
+def error_body(response: httpx.Response) -> str:
+    """Extrae el cuerpo de un error de la API (JSON si es posible)"""
+    try:
+        return json.dumps(response.json())
+    except ValueError:
+        return response.text
+
+async def create_message(api_key: str, payload: Dict, on_headers: Optional[Callable[[httpx.Headers], None]] = None) -> Dict:
+    """
+    Envía una petición a /v1/messages y retorna la respuesta decodificada.
+
+    Args:
+        api_key: API key de Anthropic
+        payload: Cuerpo de la petición (model, messages, max_tokens, ...)
+        on_headers: Callback opcional que recibe las cabeceras de la respuesta (p. ej. límites de uso)
+
+    Returns:
+        Diccionario con la respuesta de la API
+    """
+    client = get_async_client()
+    # Stream the body so on_headers runs as soon as the headers arrive (time to first byte)
+    async with client.stream(
+        "POST",
+        get_api_url(),
+        headers=build_headers(api_key),
+        extensions={"trace": _RequestTrace(pool_metrics)},
+        **request_body(payload),
+    ) as response:
+        if on_headers is not None:
+            on_headers(response.headers)
+        await response.aread()
+
+    if response.status_code != 200:
+        raise AnthropicAPIError(response.status_code, error_body(response), response.headers)
+
+    return response.json()
+
+async def stream_message(
+    api_key: str,
+    payload: Dict,
+    on_text: Optional[Callable[[str], Awaitable[None]]] = None,
+    on_headers: Optional[Callable[[httpx.Headers], None]] = None,
+) -> Dict:
+    """
+    Envía una petición a /v1/messages con `stream: true` y procesa los eventos SSE.
+
+    Args:
+        api_key: API key de Anthropic
+        payload: Cuerpo de la petición (model, messages, max_tokens, ...)
+        on_text: Callback asíncrono que recibe cada fragmento de texto generado
+        on_headers: Callback opcional que recibe las cabeceras de la respuesta
+
+    Returns:
+        Diccionario con la misma forma que la respuesta no streaming
+    """
+    client = get_async_client()
+    message = {}
+    blocks = []
+    # Text deltas are joined once per block; appending to a growing string would copy it on every event
+    texts: Dict[int, list] = {}
+
+    async with aconnect_sse(
+        client,
+        "POST",
+        get_api_url(),
+        headers=build_headers(api_key),
+        extensions={"trace": _RequestTrace(pool_metrics)},
+        **request_body({**payload, "stream": True}),
+    ) as event_source:
+        response = event_source.response
+        if on_headers is not None:
+            on_headers(response.headers)
+        if response.status_code != 200:
+            await response.aread()
+            raise AnthropicAPIError(response.status_code, error_body(response), response.headers)
+
+        async for event in event_source.aiter_sse():
+            if event.event == "message_start":
+                message = event.json()["message"]
+            elif event.event == "content_block_start":
+                blocks.append(event.json()["content_block"])
+            elif event.event == "content_block_delta":
+                data = event.json()
+                delta = data["delta"]
+                block = blocks[data["index"]]
+                if delta["type"] == "text_delta":
+                    texts.setdefault(data["index"], []).append(delta["text"])
+                    if on_text is not None:
+                        await on_text(delta["text"])
+                elif delta["type"] == "input_json_delta":
+                    block["partial_json"] = block.get("partial_json", "") + delta["partial_json"]
+                elif delta["type"] == "thinking_delta":
+                    block["thinking"] = block.get("thinking", "") + delta["thinking"]
+                elif delta["type"] == "signature_delta":
+                    block["signature"] = delta["signature"]
+                elif delta["type"] == "citations_delta":
+                    block.setdefault("citations", []).append(delta["citation"])
+            elif event.event == "content_block_stop":
+                index = event.json()["index"]
+                block = blocks[index]
+                if index in texts:
+                    block["text"] += "".join(texts.pop(index))
+                if "partial_json" in block:
+                    block["input"] = json.loads(block.pop("partial_json") or "{}")
+            elif event.event == "message_delta":
+                data = event.json()
+                message.update(data["delta"])
+                message.setdefault("usage", {}).update(data.get("usage", {}))
+            elif event.event == "error":
+                error_type = event.json().get("error", {}).get("type")
+                raise AnthropicAPIError(STREAM_ERROR_STATUS.get(error_type, 500), event.data)
+
+    for index, parts in texts.items():
+        blocks[index]["text"] += "".join(parts)
+    message["content"] = blocks
+    return message
@@ -0,0 +1,296 @@
+"""
+Conversaciones multi-turno guardadas en el servidor
+Cada conversación guarda su modelo, system prompt, contexto e historial. Las
+conversaciones viven en un LRU en memoria con límite de tamaño y TTL de
+inactividad; las que se desalojan pueden volcarse comprimidas a SQLite y
+recuperarse en el siguiente turno. Con un backend de estado compartido cada
+turno se publica también allí, y cualquier réplica puede continuar la
+conversación.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import state_backend
+
+# Key prefix of the conversations kept in the shared state backend
+SHARED_PREFIX = "conv:"
+
+class Conversation:
+    """Una conversación: parámetros fijos más el historial de turnos (role, texto)"""
+
+    def __init__(
+        self,
+        conversation_id: str,
+        model: str,
+        system: str = "",
+        context: Optional[List[str]] = None,
+        max_tokens: int = 1024,
+        messages: Optional[List[List[str]]] = None,
+        client: str = "",
+        created_at: Optional[float] = None,
+        updated_at: Optional[float] = None,
+    ):
+        self.id = conversation_id
+        self.model = model
+        self.system = system
+        self.context = context or []
+        self.max_tokens = max_tokens
+        self.messages = messages or []
+        self.client = client
+        self.created_at = created_at or time.time()
+        self.updated_at = updated_at or self.created_at
+        # Turns of the same conversation must not interleave
+        self.lock = asyncio.Lock()
+
+    @property
+    def chars(self) -> int:
+        return sum(len(text) for _, text in self.messages)
+
+    @property
+    def turns(self) -> int:
+        return sum(1 for role, _ in self.messages if role == "user")
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "model": self.model,
+            "system": self.system,
+            "context": self.context,
+            "max_tokens": self.max_tokens,
+            "messages": self.messages,
+            "client": self.client,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Conversation":
+        return cls(
+            data["id"],
+            data["model"],
+            data.get("system", ""),
+            data.get("context"),
+            data.get("max_tokens", 1024),
+            data.get("messages"),
+            data.get("client", ""),
+            data.get("created_at"),
+            data.get("updated_at"),
+        )
+
+    def info(self) -> Dict:
+        """Resumen de la conversación sin el historial"""
+        return {
+            "conversation_id": self.id,
+            "model": self.model,
+            "turns": self.turns,
+            "history_chars": self.chars,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+class SpillStore:
+    """Almacén SQLite donde se vuelcan (comprimidas) las conversaciones desalojadas de memoria"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Conexión SQLite, abierta la primera vez que se usa"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations (id TEXT PRIMARY KEY, data BLOB NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def put(self, conversation: Conversation) -> None:
+        data = zlib.compress(json.dumps(conversation.to_dict(), ensure_ascii=False).encode("utf-8"))
+        self.conn.execute(
+            "INSERT OR REPLACE INTO conversations (id, data, updated_at) VALUES (?, ?, ?)",
+            (conversation.id, data, conversation.updated_at),
+        )
+        self.conn.commit()
+
+    def take(self, conversation_id: str) -> Optional[Conversation]:
+        """Retorna la conversación y la borra del disco (vuelve a memoria)"""
+        row = self.conn.execute("SELECT data FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        if row is None:
+            return None
+        self.delete(conversation_id)
+        return Conversation.from_dict(json.loads(zlib.decompress(row[0])))
+
+    def delete(self, conversation_id: str) -> bool:
+        deleted = self.conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,)).rowcount
+        self.conn.commit()
+        return deleted > 0
+
+    def purge(self, older_than: float) -> int:
+        removed = self.conn.execute("DELETE FROM conversations WHERE updated_at < ?", (older_than,)).rowcount
+        self.conn.commit()
+        return removed
+
+    def count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+class ConversationStore:
+    """
+    Conversaciones activas con LRU, TTL de inactividad y volcado opcional a disco.
+
+    Args:
+        max_entries: Conversaciones máximas en memoria
+        ttl: Segundos de inactividad tras los que una conversación expira
+        max_chars: Tamaño máximo del historial; al superarlo se descartan los turnos más antiguos
+        disk_path: Fichero SQLite para volcar las conversaciones desalojadas (vacío = se descartan)
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 86400, max_chars: int = 200000, disk_path: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_chars = max_chars
+        self.entries: "OrderedDict[str, Conversation]" = OrderedDict()
+        self.disk = SpillStore(disk_path) if disk_path else None
+        self.shared: Optional[state_backend.StateBackend] = None
+
+        self.created = 0
+        self.shared_loads = 0
+        self.evictions = 0
+        self.spilled = 0
+        self.restored = 0
+        self.expirations = 0
+        self.trimmed_turns = 0
+
+    def create(self, model: str, system: str = "", context: Optional[List[str]] = None, max_tokens: int = 1024, client: str = "") -> Conversation:
+        conversation = Conversation(f"conv_{uuid.uuid4().hex}", model, system, context, max_tokens, client=client)
+        self.created += 1
+        self._remember(conversation)
+        self._publish(conversation)
+        return conversation
+
+    def get(self, conversation_id: str) -> Optional[Conversation]:
+        """Busca una conversación en memoria y después en disco; None si no existe o expiró"""
+        now = time.time()
+        conversation = self.entries.get(conversation_id)
+        if conversation is None and self.disk is not None:
+            conversation = self.disk.take(conversation_id)
+            if conversation is not None:
+                self.restored += 1
+                self._remember(conversation)
+        if conversation is None:
+            return None
+
+        if conversation.updated_at + self.ttl <= now:
+            self.entries.pop(conversation_id, None)
+            self.expirations += 1
+            return None
+        self.entries.move_to_end(conversation_id)
+        return conversation
+
+    async def fetch(self, conversation_id: str) -> Optional[Conversation]:
+        """Como get, pero usa la copia del estado compartido si otra réplica tiene turnos más recientes"""
+        conversation = self.get(conversation_id)
+        if self.shared is None:
+            return conversation
+        data = state_backend.unpack(await self.shared.get(SHARED_PREFIX + conversation_id))
+        if data is not None and data.get("deleted"):
+            # Ended in another replica
+            if conversation is not None:
+                self.entries.pop(conversation_id, None)
+                if self.disk is not None:
+                    self.disk.delete(conversation_id)
+            return None
+        if data is None or (conversation is not None and data["updated_at"] <= conversation.updated_at):
+            return conversation
+        if data["updated_at"] + self.ttl <= time.time():
+            return conversation
+        self.shared_loads += 1
+        if conversation is None:
+            conversation = Conversation.from_dict(data)
+            self._remember(conversation)
+        else:
+            # Update in place so a turn already waiting on this conversation's lock sees the new history
+            conversation.messages = data["messages"]
+            conversation.updated_at = data["updated_at"]
+        return conversation
+
+    def append(self, conversation: Conversation, user_text: str, assistant_text: str) -> None:
+        """Añade un turno y recorta los más antiguos si el historial supera max_chars"""
+        conversation.messages.append(["user", user_text])
+        conversation.messages.append(["assistant", assistant_text])
+        conversation.updated_at = time.time()
+        # Drop whole user/assistant pairs so the history keeps starting with a user turn
+        while conversation.chars > self.max_chars and len(conversation.messages) > 2:
+            del conversation.messages[:2]
+            self.trimmed_turns += 1
+        self._publish(conversation)
+
+    def delete(self, conversation_id: str) -> bool:
+        removed = self.entries.pop(conversation_id, None) is not None
+        if self.disk is not None:
+            removed = self.disk.delete(conversation_id) or removed
+        if self.shared is not None:
+            # Other replicas may still hold it in memory: leave a tombstone they see on their next fetch
+            self.shared.set(SHARED_PREFIX + conversation_id, state_backend.pack({"deleted": True}), self.ttl)
+        return removed
+
+    def spill_all(self) -> None:
+        """Vuelca a disco todas las conversaciones en memoria (al apagar el servidor)"""
+        if self.disk is None:
+            return
+        for conversation in self.entries.values():
+            self.disk.put(conversation)
+        self.entries.clear()
+
+    def _publish(self, conversation: Conversation) -> None:
+        if self.shared is not None:
+            self.shared.set(SHARED_PREFIX + conversation.id, state_backend.pack(conversation.to_dict()), self.ttl)
+
+    def _remember(self, conversation: Conversation) -> None:
+        self.entries[conversation.id] = conversation
+        self.entries.move_to_end(conversation.id)
+        while len(self.entries) > self.max_entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.evictions += 1
+            if self.disk is not None:
+                self.disk.put(evicted)
+                self.spilled += 1
+        if self.disk is not None and self.spilled and self.spilled % 100 == 0:
+            self.disk.purge(time.time() - self.ttl)
+
+    def stats(self) -> Dict:
+        return {
+            "active": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "max_chars": self.max_chars,
+            "disk": self.disk.path if self.disk is not None else None,
+            "disk_entries": self.disk.count() if self.disk is not None else 0,
+            "created": self.created,
+            "evictions": self.evictions,
+            "spilled": self.spilled,
+            "restored": self.restored,
+            "shared_loads": self.shared_loads,
+            "expirations": self.expirations,
+            "trimmed_turns": self.trimmed_turns,
+        }
+
+def store_from_env() -> ConversationStore:
+    """Crea el almacén de conversaciones a partir de las variables de entorno"""
+    return ConversationStore(
+        max_entries=int(os.environ.get("CLAUDE_CONVERSATION_MAX_ENTRIES", 1000)),
+        ttl=float(os.environ.get("CLAUDE_CONVERSATION_TTL", 86400)),
+        max_chars=int(os.environ.get("CLAUDE_CONVERSATION_MAX_CHARS", 200000)),
+        disk_path=os.environ.get("CLAUDE_CONVERSATION_DB", ""),
+    )
@@ -0,0 +1,186 @@
+"""
+Plazos por llamada y cancelación de extremo a extremo
+Cada llamada a Claude corre dentro de un cancel scope con su plazo (timeout_s o
+el default del servidor); si vence, si el cliente MCP cancela la petición o si
+se desconecta, la petición HTTP a Anthropic en curso (también en streaming) se
+aborta en lugar de seguir generando tokens que nadie va a leer
+"""
+
+import contextvars
+import math
+import os
+import time
+from typing import Awaitable, Callable, Optional
+
+import anyio
+
+import metrics
+
+# Key of the per-request anyio.Event set by DisconnectMiddleware when the client goes away
+DISCONNECT_KEY = "claude.disconnected"
+
+# Absolute deadline (time.monotonic()) of the call being served, seen by retries and the rate governor
+_deadline: contextvars.ContextVar = contextvars.ContextVar("claude_deadline", default=None)
+
+DEFAULT_TIMEOUT = float(os.environ.get("CLAUDE_REQUEST_TIMEOUT", 300))
+MAX_TIMEOUT = float(os.environ.get("CLAUDE_REQUEST_MAX_TIMEOUT", 0))
+
+class DeadlineExceeded(Exception):
+    """La llamada no terminó dentro de su plazo"""
+
+    def __init__(self, timeout: float):
+        super().__init__(f"la llamada superó su plazo de {timeout:g}s (timeout_s)")
+        self.timeout = timeout
+
+class ClientDisconnected(Exception):
+    """El cliente se desconectó antes de recibir la respuesta"""
+
+    def __init__(self):
+        super().__init__("el cliente se desconectó; la llamada a Claude se canceló")
+
+def timeout_for(timeout_s: Optional[float]) -> Optional[float]:
+    """
+    Plazo efectivo de una llamada: `timeout_s` si es positivo, si no el default
+    del servidor (CLAUDE_REQUEST_TIMEOUT), acotado por CLAUDE_REQUEST_MAX_TIMEOUT.
+    None significa sin plazo.
+    """
+    timeout = timeout_s if timeout_s and timeout_s > 0 else DEFAULT_TIMEOUT
+    if MAX_TIMEOUT > 0:
+        timeout = min(timeout, MAX_TIMEOUT) if timeout > 0 else MAX_TIMEOUT
+    return timeout if timeout > 0 else None
+
+def current() -> Optional[float]:
+    """Plazo absoluto (time.monotonic()) de la llamada en curso, o None"""
+    return _deadline.get()
+
+def remaining() -> Optional[float]:
+    """Segundos que le quedan a la llamada en curso, o None si no tiene plazo"""
+    deadline = _deadline.get()
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+def disconnect_event(ctx) -> Optional[anyio.Event]:
+    """Evento de desconexión de la petición HTTP que trajo la llamada MCP (None fuera de HTTP)"""
+    if ctx is None:
+        return None
+    try:
+        request = ctx.request_context.request
+    except ValueError:
+        return None
+    return request.scope.get(DISCONNECT_KEY) if request is not None else None
+
+async def run(fn: Callable[[], Awaitable], timeout: Optional[float] = None, disconnected: Optional[anyio.Event] = None):
+    """
+    Ejecuta `fn()` con plazo y la cancela si el cliente se desconecta.
+
+    Un plazo más corto ya en curso (llamadas anidadas) se respeta. La
+    cancelación llega a la petición upstream como CancelledError, que httpx
+    traduce en cerrar la conexión.
+
+    Raises:
+        DeadlineExceeded: si vence el plazo
+        ClientDisconnected: si el cliente se desconecta antes de terminar
+    """
+    start = time.monotonic()
+    deadline = start + timeout if timeout else None
+    parent = _deadline.get()
+    if parent is not None and (deadline is None or parent < deadline):
+        deadline = parent
+    token = _deadline.set(deadline)
+    gone = {"value": False}
+    result = None
+    error = None
+
+    try:
+        with anyio.CancelScope(deadline=deadline if deadline is not None else math.inf) as scope:
+            async with anyio.create_task_group() as tg:
+                if disconnected is not None:
+                    async def watch():
+                        await disconnected.wait()
+                        gone["value"] = True
+                        scope.cancel()
+
+                    tg.start_soon(watch)
+                # Caught here so the task group does not wrap the caller's error in an ExceptionGroup
+                try:
+                    result = await fn()
+                except Exception as e:
+                    error = e
+                tg.cancel_scope.cancel()
+    except anyio.get_cancelled_exc_class():
+        # Cancelled from outside: MCP notifications/cancelled or the SSE stream closing
+        metrics.calls_cancelled.inc(reason="cancelled")
+        raise
+    finally:
+        _deadline.reset(token)
+
+    if scope.cancelled_caught:
+        if gone["value"]:
+            metrics.calls_cancelled.inc(reason="disconnect")
+            raise ClientDisconnected()
+        metrics.calls_cancelled.inc(reason="deadline")
+        raise DeadlineExceeded(round(deadline - start, 3))
+    if error is not None:
+        raise error
+    return result
+
+class DisconnectMiddleware:
+    """
+    Middleware ASGI que detecta cuándo el cliente cierra la conexión HTTP.
+
+    Deja en el scope (DISCONNECT_KEY) un evento que se activa si el cliente se
+    desconecta antes de recibir la respuesta completa, para que las llamadas de
+    Streamable HTTP (cuyo handler no corre dentro de la petición) puedan
+    cancelarse. En `cancel_paths` (el GET /sse) la desconexión cancela
+    directamente la aplicación, y con ella las herramientas en curso de esa sesión.
+    """
+
+    def __init__(self, app, cancel_paths=()):
+        self.app = app
+        self.cancel_paths = set(cancel_paths)
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        disconnected = anyio.Event()
+        body_read = anyio.Event()
+        state = {"response_complete": False}
+        scope[DISCONNECT_KEY] = disconnected
+
+        def observe(message) -> None:
+            # After the response is complete the server reports every connection as disconnected
+            if message["type"] == "http.disconnect" and not state["response_complete"]:
+                disconnected.set()
+            elif message["type"] == "http.request" and not message.get("more_body", False):
+                body_read.set()
+
+        async def wrapped_receive():
+            message = await receive()
+            observe(message)
+            return message
+
+        async def wrapped_send(message):
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                state["response_complete"] = True
+            await send(message)
+
+        async def watch():
+            # Only listen once the body was consumed, so the watcher never steals request data
+            await body_read.wait()
+            while not disconnected.is_set() and not state["response_complete"]:
+                observe(await receive())
+
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(watch)
+            if scope["path"] in self.cancel_paths:
+                with anyio.CancelScope() as app_scope:
+                    async def cancel_on_disconnect():
+                        await disconnected.wait()
+                        app_scope.cancel()
+
+                    tg.start_soon(cancel_on_disconnect)
+                    await self.app(scope, wrapped_receive, wrapped_send)
+            else:
+                await self.app(scope, wrapped_receive, wrapped_send)
+            tg.cancel_scope.cancel()
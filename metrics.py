@@ -0,0 +1,250 @@
+"""
+Métricas del servidor en formato de exposición de Prometheus
+Contadores, gauges e histogramas con etiquetas, sin dependencias externas,
+más las métricas que usa el servidor (latencias, códigos de estado, tokens,
+sesiones SSE y peticiones en vuelo)
+"""
+
+import math
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds, from cache hits up to long generations
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{_escape(extra[1])}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class _Metric:
+    """Base de las métricas: nombre, ayuda, etiquetas y un valor por combinación de etiquetas"""
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        if not self.values and not self.labelnames:
+            # Unlabelled series exist from the start, even before the first update
+            return [f"{self.name} 0"]
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in self.values.items()]
+
+class Counter(_Metric):
+    """Valor que solo crece"""
+
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    """Valor que sube y baja"""
+
+    type_name = "gauge"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        self.values[self._key(labels)] = value
+
+    @contextmanager
+    def track(self, **labels) -> Iterator[None]:
+        """Incrementa el gauge mientras dura el bloque"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+class _HistogramValue:
+    def __init__(self, buckets: Sequence[float]):
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+class Histogram(_Metric):
+    """Distribución de valores en buckets acumulativos"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = _HistogramValue(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry.counts[i] += 1
+                break
+        entry.sum += value
+        entry.count += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observa la duración del bloque en segundos"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def quantile(self, key: Tuple[str, ...], q: float) -> Optional[float]:
+        """Estima el cuantil `q` interpolando dentro del bucket, como histogram_quantile()"""
+        entry = self.values.get(key)
+        if entry is None or entry.count == 0:
+            return None
+        rank = q * entry.count
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, entry.counts):
+            if count and cumulative + count >= rank:
+                if bound == math.inf:
+                    return lower
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound if bound != math.inf else lower
+        return lower
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, entry in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry.counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(entry.sum)}")
+            lines.append(f"{self.name}_count{labels} {entry.count}")
+        return lines
+
+class Registry:
+    """Conjunto de métricas que se exponen juntas"""
+
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Texto en formato de exposición de Prometheus (text/plain; version=0.0.4)"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REGISTRY = Registry()
+
+queue_wait = REGISTRY.register(Histogram(
+    "claude_queue_wait_seconds", "Tiempo en la cola del gobernador de uso antes de enviar la petición", ("tool", "model"),
+))
+upstream_ttfb = REGISTRY.register(Histogram(
+    "claude_upstream_ttfb_seconds", "Tiempo hasta recibir las cabeceras de respuesta de la API de Anthropic", ("tool", "model"),
+))
+request_duration = REGISTRY.register(Histogram(
+    "claude_request_duration_seconds", "Tiempo total de una llamada a Claude, incluida la caché y los reintentos", ("tool", "model"),
+))
+upstream_responses = REGISTRY.register(Counter(
+    "claude_upstream_responses_total", "Respuestas de la API de Anthropic por código de estado", ("model", "status"),
+))
+tokens = REGISTRY.register(Counter(
+    "claude_tokens_total", "Tokens reportados en el bloque usage de la API de mensajes", ("model", "type"),
+))
+requests_in_flight = REGISTRY.register(Gauge(
+    "claude_requests_in_flight", "Llamadas a Claude en curso", ("tool",),
+))
+sse_sessions = REGISTRY.register(Gauge(
+    "mcp_sse_sessions_active", "Sesiones SSE de MCP abiertas",
+))
+model_fallbacks = REGISTRY.register(Counter(
+    "claude_model_fallbacks_total", "Llamadas que pasaron a un modelo de respaldo", ("from_model", "to_model"),
+))
+calls_cancelled = REGISTRY.register(Counter(
+    "claude_calls_cancelled_total", "Llamadas a Claude abortadas antes de terminar: plazo vencido, desconexión o cancelación del cliente", ("reason",),
+))
+circuit_state = REGISTRY.register(Gauge(
+    "claude_model_circuit_state", "Estado del circuit breaker por modelo: 0 cerrado, 1 semiabierto, 2 abierto", ("model",),
+))
+slow_calls = REGISTRY.register(Counter(
+    "claude_slow_calls_total", "Llamadas a herramientas que superaron CLAUDE_SLOW_CALL_MS", ("tool",),
+))
+scheduler_queue_depth = REGISTRY.register(Gauge(
+    "claude_scheduler_queue_depth", "Llamadas esperando turno en el planificador por clase de prioridad", ("priority",),
+))
+scheduler_in_flight = REGISTRY.register(Gauge(
+    "claude_scheduler_in_flight", "Llamadas con turno del planificador en curso por clase de prioridad", ("priority",),
+))
+scheduler_wait = REGISTRY.register(Histogram(
+    "claude_scheduler_wait_seconds", "Espera en la cola del planificador antes de pasar al gobernador de uso", ("priority",),
+))
+state_ops = REGISTRY.register(Counter(
+    "claude_state_ops_total", "Operaciones enviadas al backend de estado compartido", ("backend",),
+))
+state_batch_duration = REGISTRY.register(Histogram(
+    "claude_state_batch_seconds", "Duración de cada lote (pipeline) de operaciones del backend de estado", ("backend",),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1),
+))
+state_errors = REGISTRY.register(Counter(
+    "claude_state_errors_total", "Lotes del backend de estado que fallaron (se siguió con el estado local)", ("backend",),
+))
+
+def record_usage(model: str, usage: Optional[Dict]) -> None:
+    """Suma al contador de tokens los campos *_tokens del bloque usage"""
+    for field, value in (usage or {}).items():
+        if field.endswith("_tokens") and isinstance(value, (int, float)):
+            tokens.inc(value, model=model, type=field[: -len("_tokens")])
+
+class SSESessionMiddleware:
+    """Middleware ASGI que cuenta las conexiones abiertas a `path` (GET /sse)"""
+
+    def __init__(self, app, path: str = "/sse"):
+        self.app = app
+        self.path = path
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "http" and scope["method"] == "GET" and scope["path"] == self.path:
+            with sse_sessions.track():
+                await self.app(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
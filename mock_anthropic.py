@@ -0,0 +1,354 @@
+"""
+Servidor mock de la API de Anthropic para pruebas y benchmarks locales
+Responde a POST /v1/messages con una latencia configurable, sin salir a internet
+Soporta respuestas en streaming (SSE) cuando la petición incluye "stream": true,
+la Message Batches API (/v1/messages/batches), que termina tras --batch-delay segundos,
+la lista de modelos (GET /v1/models, paginada como la API; los demás modelos dan 404)
+y simula la caché de prompts: el prefijo hasta el último cache_control se cobra
+como escritura la primera vez y como lectura en las siguientes.
+
+La latencia puede seguir una distribución (fixed, uniform, exponential,
+lognormal) con la media indicada, y una fracción de las peticiones puede
+fallar con 429 o 529 (con Retry-After) para probar reintentos y límites.
+Cada modelo puede tener su propia latencia (--model-latency) y algunos pueden
+responder siempre 529 (--overloaded-model) para probar el enrutado y el respaldo.
+Las imágenes y documentos en base64 se validan (400 si el base64 es
+inválido) y la respuesta indica cuántos recibió. Con --response-chars las respuestas se rellenan hasta ese número de caracteres
+para probar respuestas largas.
+GET /stats retorna los contadores de peticiones, errores inyectados y
+peticiones que el cliente abortó antes de recibir la respuesta.
+
+Uso:
+    python mock_anthropic.py --port 9090 --latency 0.5
+    python mock_anthropic.py --latency 0.8 --latency-dist lognormal --error-429 0.02 --error-529 0.01
+    python mock_anthropic.py --model-latency claude-3-5-haiku-20241022=0.1 --overloaded-model claude-opus-4-1-20250805
+    python mock_anthropic.py --response-chars 500000
+"""
+
+import argparse
+import asyncio
+import base64
+import binascii
+import hashlib
+import json
+import math
+import random
+import socket
+import threading
+import time
+import uuid
+from typing import Dict, List
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+# Models listed by GET /v1/models, newest first like the real API
+MODELS = [
+    {"type": "model", "id": "claude-sonnet-4-5-20250929", "display_name": "Claude Sonnet 4.5", "created_at": "2025-09-29T00:00:00Z"},
+    {"type": "model", "id": "claude-opus-4-1-20250805", "display_name": "Claude Opus 4.1", "created_at": "2025-08-05T00:00:00Z"},
+    {"type": "model", "id": "claude-sonnet-4-20250514", "display_name": "Claude Sonnet 4", "created_at": "2025-05-22T00:00:00Z"},
+    {"type": "model", "id": "claude-3-5-haiku-20241022", "display_name": "Claude Haiku 3.5", "created_at": "2024-10-22T00:00:00Z"},
+    {"type": "model", "id": "claude-3-5-sonnet-20241022", "display_name": "Claude Sonnet 3.5 (New)", "created_at": "2024-10-22T00:00:00Z"},
+]
+
+def prompt_text(content) -> str:
+    """Texto del último bloque de un mensaje (string o lista de bloques)"""
+    if isinstance(content, str):
+        return content
+    texts = [block.get("text", "") for block in content if block.get("type") == "text"]
+    return texts[-1] if texts else ""
+
+def simulate_usage(body: Dict, text: str, prompt_cache: set) -> Dict:
+    """Calcula el usage como la API: el prefijo hasta el último cache_control se escribe o se lee de la caché"""
+    blocks = body.get("system") or []
+    if isinstance(blocks, str):
+        blocks = [{"type": "text", "text": blocks}]
+    blocks = list(blocks)
+    for message in body["messages"]:
+        content = message["content"]
+        blocks += [{"type": "text", "text": content}] if isinstance(content, str) else content
+
+    breakpoints = [i for i, block in enumerate(blocks) if block.get("cache_control")]
+    last = breakpoints[-1] if breakpoints else -1
+    usage = {
+        "input_tokens": len(json.dumps(blocks[last + 1:])) // 4 + 1,
+        "output_tokens": len(text) // 4 + 1,
+        "cache_creation_input_tokens": 0,
+        "cache_read_input_tokens": 0,
+    }
+
+    # The longest cached prefix is read, everything up to the last breakpoint beyond it is written
+    # Markers are not part of the cached content: the same prefix matches wherever the breakpoints move
+    plain = [{k: v for k, v in block.items() if k != "cache_control"} for block in blocks]
+    prefix_tokens = 0
+    for i in breakpoints:
+        prefix = json.dumps(plain[: i + 1], sort_keys=True)
+        key = hashlib.sha256(f"{body.get('model')}:{prefix}".encode()).hexdigest()
+        if key in prompt_cache:
+            usage["cache_read_input_tokens"] = len(prefix) // 4
+        prompt_cache.add(key)
+        prefix_tokens = len(prefix) // 4
+    usage["cache_creation_input_tokens"] = prefix_tokens - usage["cache_read_input_tokens"]
+    return usage
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+def sample_latency(mean: float, distribution: str = "fixed", rng: random.Random = random) -> float:
+    """Latencia aleatoria con media `mean` según la distribución indicada"""
+    if mean <= 0 or distribution == "fixed":
+        return max(mean, 0.0)
+    if distribution == "uniform":
+        return rng.uniform(0, 2 * mean)
+    if distribution == "exponential":
+        return rng.expovariate(1 / mean)
+    if distribution == "lognormal":
+        # Long right tail like real generation times; mu chosen so the mean stays `mean`
+        sigma = 0.75
+        return rng.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma)
+    raise ValueError(f"distribución de latencia desconocida: {distribution}")
+
+def create_app(
+    latency: float = 0.5,
+    batch_delay: float = 1.0,
+    latency_dist: str = "fixed",
+    error_429: float = 0.0,
+    error_529: float = 0.0,
+    retry_after: float = 1.0,
+    seed: int = None,
+    model_latency: Dict[str, float] = None,
+    overloaded_models: List[str] = (),
+    response_chars: int = 0,
+) -> Starlette:
+    """
+    Crea la aplicación mock.
+
+    Args:
+        latency: Latencia media en segundos
+        batch_delay: Segundos hasta que un batch termina
+        latency_dist: Distribución de la latencia (fixed, uniform, exponential, lognormal)
+        error_429: Fracción de peticiones que responden 429 (rate_limit_error)
+        error_529: Fracción de peticiones que responden 529 (overloaded_error)
+        retry_after: Valor de la cabecera Retry-After de los errores inyectados
+        seed: Semilla para reproducir la misma secuencia de latencias y errores
+        model_latency: Latencia media por modelo, en lugar de `latency`
+        overloaded_models: Modelos que responden siempre 529
+        response_chars: Si es mayor que 0, longitud a la que se rellena el texto de cada respuesta
+    """
+    if latency_dist not in LATENCY_DISTRIBUTIONS:
+        raise ValueError(f"distribución de latencia desconocida: {latency_dist}")
+    batches = {}
+    prompt_cache = set()
+    rng = random.Random(seed)
+    stats = {"requests": 0, "streamed": 0, "429": 0, "529": 0, "models": 0, "aborted": 0}
+    model_ids = {model["id"] for model in MODELS}
+
+    def injected_error(model: str):
+        """Retorna una respuesta de error si toca inyectarla en esta petición"""
+        roll = rng.random()
+        if model in overloaded_models:
+            status, error_type = 529, "overloaded_error"
+        elif roll < error_429:
+            status, error_type = 429, "rate_limit_error"
+        elif roll < error_429 + error_529:
+            status, error_type = 529, "overloaded_error"
+        else:
+            return None
+        stats[str(status)] += 1
+        return JSONResponse(
+            {"type": "error", "error": {"type": error_type, "message": f"simulated {error_type}"}},
+            status_code=status,
+            headers={"retry-after": f"{retry_after:g}"},
+        )
+
+    async def messages(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        if body.get("model") not in model_ids:
+            return JSONResponse(
+                {"type": "error", "error": {"type": "not_found_error", "message": f"model: {body.get('model')}"}},
+                status_code=404,
+            )
+        error = injected_error(body["model"])
+        if error is not None:
+            await asyncio.sleep(min(latency, 0.05))
+            return error
+
+        content = body["messages"][-1]["content"]
+        prompt = prompt_text(content)
+        text = f"Respuesta simulada para: {prompt[:50]}"
+        attached = [block for block in content if block.get("type") in ("image", "document")] if isinstance(content, list) else []
+        if attached:
+            try:
+                for block in attached:
+                    if block["source"]["type"] == "base64":
+                        base64.b64decode(block["source"]["data"], validate=True)
+            except (binascii.Error, KeyError) as e:
+                return JSONResponse(
+                    {"type": "error", "error": {"type": "invalid_request_error", "message": f"invalid attachment: {e}"}},
+                    status_code=400,
+                )
+            text += f" ({len(attached)} adjuntos: {', '.join(block['source'].get('media_type', '') for block in attached)})"
+        if response_chars > len(text):
+            filler = " Línea de relleno número {:06d} con acentos (áéíóú ñ).\n"
+            text += "".join(filler.format(i) for i in range(response_chars // len(filler) + 1))
+            text = text[:response_chars]
+        message = {
+            "id": f"msg_{uuid.uuid4().hex[:24]}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model"),
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": simulate_usage(body, text, prompt_cache),
+        }
+
+        delay = sample_latency((model_latency or {}).get(body["model"], latency), latency_dist, rng)
+        if body.get("stream"):
+            stats["streamed"] += 1
+            return StreamingResponse(stream_events(message, delay), media_type="text/event-stream")
+
+        # Generation stops as soon as the client goes away, like the real API
+        deadline = time.monotonic() + delay
+        while time.monotonic() < deadline:
+            if await request.is_disconnected():
+                stats["aborted"] += 1
+                return JSONResponse({}, status_code=499)
+            await asyncio.sleep(min(0.05, max(0.0, deadline - time.monotonic())))
+        return JSONResponse(message)
+
+    async def stream_events(message, total_delay: float):
+        """Emite la respuesta palabra a palabra (o en ~200 trozos si es larga) repartiendo la latencia entre los fragmentos"""
+        text = message["content"][0]["text"]
+        words = text.split(" ")
+        separator = " "
+        if len(words) > 200:
+            step = -(-len(text) // 200)
+            words = [text[i:i + step] for i in range(0, len(text), step)]
+            separator = ""
+        delay = total_delay / (len(words) + 1)
+
+        def event(name, data):
+            return f"event: {name}\ndata: {json.dumps({'type': name, **data})}\n\n"
+
+        yield event("message_start", {"message": {**message, "content": [], "stop_reason": None}})
+        yield event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}})
+        for i, word in enumerate(words):
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                # Starlette cancels the generator when the client disconnects
+                stats["aborted"] += 1
+                raise
+            chunk = word if i == 0 else separator + word
+            yield event("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": chunk}})
+        yield event("content_block_stop", {"index": 0})
+        yield event("message_delta", {"delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": message["usage"]["output_tokens"]}})
+        yield event("message_stop", {})
+
+    def batch_status(request: Request, batch: Dict) -> Dict:
+        ended = time.time() - batch["created"] >= batch_delay
+        count = len(batch["requests"])
+        return {
+            "id": batch["id"],
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {
+                "processing": 0 if ended else count,
+                "succeeded": count if ended else 0,
+                "errored": 0,
+                "canceled": 0,
+                "expired": 0,
+            },
+            "results_url": f"{str(request.base_url).rstrip('/')}/v1/messages/batches/{batch['id']}/results" if ended else None,
+        }
+
+    async def create_batch(request: Request) -> JSONResponse:
+        body = await request.json()
+        batch = {"id": f"msgbatch_{uuid.uuid4().hex[:24]}", "created": time.time(), "requests": body["requests"]}
+        batches[batch["id"]] = batch
+        return JSONResponse(batch_status(request, batch))
+
+    async def get_batch(request: Request) -> JSONResponse:
+        batch = batches.get(request.path_params["batch_id"])
+        if batch is None:
+            return JSONResponse({"type": "error", "error": {"type": "not_found_error", "message": "batch not found"}}, status_code=404)
+        return JSONResponse(batch_status(request, batch))
+
+    async def batch_results(request: Request) -> PlainTextResponse:
+        batch = batches[request.path_params["batch_id"]]
+        lines = []
+        for item in batch["requests"]:
+            prompt = prompt_text(item["params"]["messages"][-1]["content"])
+            message = {"type": "message", "role": "assistant", "content": [{"type": "text", "text": f"Respuesta simulada para: {prompt[:50]}"}]}
+            lines.append(json.dumps({"custom_id": item["custom_id"], "result": {"type": "succeeded", "message": message}}))
+        return PlainTextResponse("\n".join(lines) + "\n", media_type="application/x-jsonl")
+
+    async def list_models(request: Request) -> JSONResponse:
+        stats["models"] += 1
+        limit = int(request.query_params.get("limit", 20))
+        after_id = request.query_params.get("after_id")
+        start = next((i + 1 for i, model in enumerate(MODELS) if model["id"] == after_id), 0)
+        page = MODELS[start:start + limit]
+        return JSONResponse({
+            "data": page,
+            "has_more": start + limit < len(MODELS),
+            "first_id": page[0]["id"] if page else None,
+            "last_id": page[-1]["id"] if page else None,
+        })
+
+    async def get_stats(request: Request) -> JSONResponse:
+        return JSONResponse(stats)
+
+    return Starlette(routes=[
+        Route("/stats", get_stats, methods=["GET"]),
+        Route("/v1/models", list_models, methods=["GET"]),
+        Route("/v1/messages", messages, methods=["POST"]),
+        Route("/v1/messages/batches", create_batch, methods=["POST"]),
+        Route("/v1/messages/batches/{batch_id}", get_batch, methods=["GET"]),
+        Route("/v1/messages/batches/{batch_id}/results", batch_results, methods=["GET"]),
+    ])
+
+def find_free_port() -> int:
+    """Busca un puerto TCP libre en localhost"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_in_thread(port: int, latency: float = 0.5, batch_delay: float = 1.0, **options) -> uvicorn.Server:
+    """Arranca el mock en un hilo en segundo plano y espera a que esté escuchando (options: ver create_app)"""
+    config = uvicorn.Config(create_app(latency, batch_delay, **options), host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    while not server.started:
+        time.sleep(0.05)
+
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock local de la API de Anthropic")
+    parser.add_argument("--port", type=int, default=9090)
+    parser.add_argument("--latency", type=float, default=0.5, help="Latencia simulada en segundos")
+    parser.add_argument("--batch-delay", type=float, default=1.0, help="Segundos hasta que un batch termina")
+    parser.add_argument("--latency-dist", choices=LATENCY_DISTRIBUTIONS, default="fixed", help="Distribución de la latencia")
+    parser.add_argument("--error-429", type=float, default=0.0, help="Fracción de peticiones que responden 429")
+    parser.add_argument("--error-529", type=float, default=0.0, help="Fracción de peticiones que responden 529")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After de los errores inyectados (segundos)")
+    parser.add_argument("--seed", type=int, default=None, help="Semilla para reproducir latencias y errores")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODELO=SEGUNDOS", help="Latencia media de un modelo concreto")
+    parser.add_argument("--overloaded-model", action="append", default=[], metavar="MODELO", help="Modelo que responde siempre 529")
+    parser.add_argument("--response-chars", type=int, default=0, help="Rellena cada respuesta hasta este número de caracteres")
+    args = parser.parse_args()
+    model_latency = {name: float(value) for name, _, value in (item.partition("=") for item in args.model_latency)}
+
+    print(f"🧪 Mock de Anthropic en http://127.0.0.1:{args.port}/v1/messages (latencia {args.latency}s, {args.latency_dist})")
+    app = create_app(
+        args.latency, args.batch_delay, args.latency_dist, args.error_429, args.error_529, args.retry_after, args.seed,
+        model_latency, args.overloaded_model, args.response_chars,
+    )
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,175 @@
+"""
+Servidor mock del protocolo de Redis para pruebas y benchmarks locales
+Implementa en memoria los comandos que usa state_backend.RedisBackend (PING,
+AUTH, SELECT, GET, SET con EX/PX, DEL, INCRBYFLOAT, PEXPIRE, MGET, FLUSHALL y
+un INFO mínimo), con caducidad de claves, para probar varias réplicas de
+app.py compartiendo estado sin instalar Redis.
+Cuenta los comandos y los pipelines recibidos (comandos que llegaron juntos en
+una misma lectura del socket): `INFO` los retorna, y `stats()` desde Python.
+
+Uso:
+    python mock_redis.py --port 6379
+    python mock_redis.py --port 6380 --password secreto --latency 0.0005
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+class MockRedis:
+    """Estado y comandos del mock; `serve` atiende conexiones asyncio"""
+
+    def __init__(self, password: Optional[str] = None, latency: float = 0.0):
+        self.password = password
+        self.latency = latency
+        self.databases: Dict[int, Dict[bytes, Tuple[bytes, float]]] = {}
+        self.commands = 0
+        self.pipelines = 0
+        self.connections = 0
+
+    def stats(self) -> Dict:
+        keys = sum(len(db) for db in self.databases.values())
+        return {"commands": self.commands, "pipelines": self.pipelines, "connections": self.connections, "keys": keys}
+
+    def _get(self, db: Dict, key: bytes) -> Optional[bytes]:
+        entry = db.get(key)
+        if entry is None:
+            return None
+        if entry[1] and entry[1] <= time.time():
+            del db[key]
+            return None
+        return entry[0]
+
+    def execute(self, session: Dict, args: List[bytes]) -> bytes:
+        """Ejecuta un comando y retorna la respuesta RESP"""
+        self.commands += 1
+        command = args[0].upper().decode()
+        if command == "AUTH":
+            if self.password is None or args[-1].decode() == self.password:
+                session["authenticated"] = True
+                return b"+OK\r\n"
+            return b"-WRONGPASS invalid username-password pair\r\n"
+        if self.password is not None and not session["authenticated"]:
+            return b"-NOAUTH Authentication required.\r\n"
+        db = self.databases.setdefault(session["db"], {})
+
+        if command == "PING":
+            return b"+PONG\r\n"
+        if command == "SELECT":
+            session["db"] = int(args[1])
+            return b"+OK\r\n"
+        if command == "GET":
+            return bulk(self._get(db, args[1]))
+        if command == "MGET":
+            return b"*%d\r\n" % (len(args) - 1) + b"".join(bulk(self._get(db, key)) for key in args[1:])
+        if command == "SET":
+            expires_at = 0.0
+            options = [arg.upper() for arg in args[3:]]
+            if b"EX" in options:
+                expires_at = time.time() + float(args[3 + options.index(b"EX") + 1])
+            elif b"PX" in options:
+                expires_at = time.time() + float(args[3 + options.index(b"PX") + 1]) / 1000
+            db[args[1]] = (args[2], expires_at)
+            return b"+OK\r\n"
+        if command == "DEL":
+            deleted = sum(1 for key in args[1:] if self._get(db, key) is not None and db.pop(key, None) is not None)
+            return b":%d\r\n" % deleted
+        if command == "INCRBYFLOAT":
+            current = self._get(db, args[1])
+            try:
+                total = float(current or 0) + float(args[2])
+            except ValueError:
+                return b"-ERR value is not a valid float\r\n"
+            expires_at = db[args[1]][1] if current is not None else 0.0
+            value = repr(total).encode()
+            db[args[1]] = (value, expires_at)
+            return bulk(value)
+        if command == "PEXPIRE":
+            current = self._get(db, args[1])
+            if current is None:
+                return b":0\r\n"
+            db[args[1]] = (current, time.time() + int(args[2]) / 1000)
+            return b":1\r\n"
+        if command == "FLUSHALL":
+            self.databases.clear()
+            return b"+OK\r\n"
+        if command == "INFO":
+            text = "".join(f"{name}:{value}\r\n" for name, value in self.stats().items())
+            return bulk(("# Mock\r\n" + text).encode())
+        return b"-ERR unknown command '%s'\r\n" % args[0]
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        session = {"db": 0, "authenticated": False}
+        try:
+            while True:
+                args = await read_command(reader)
+                if args is None:
+                    break
+                replies = [self.execute(session, args)]
+                # Commands already buffered arrived in the same pipeline and are answered in one write
+                while reader._buffer:
+                    args = await read_command(reader)
+                    if args is None:
+                        break
+                    replies.append(self.execute(session, args))
+                self.pipelines += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                writer.write(b"".join(replies))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+def bulk(value: Optional[bytes]) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+async def read_command(reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+    """Lee un comando RESP (array de bulk strings); None si el cliente cerró"""
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        # Inline command (redis-cli / telnet)
+        return line.split() or [b"PING"]
+    args = []
+    for _ in range(int(line[1:-2])):
+        size = int((await reader.readline())[1:-2])
+        args.append((await reader.readexactly(size + 2))[:-2])
+    return args
+
+def start_in_thread(port: int, password: Optional[str] = None, latency: float = 0.0) -> MockRedis:
+    """Arranca el mock en un hilo en segundo plano y espera a que esté escuchando"""
+    mock = MockRedis(password, latency)
+    ready = threading.Event()
+
+    async def run() -> None:
+        await asyncio.start_server(mock.serve, "127.0.0.1", port)
+        ready.set()
+        await asyncio.Event().wait()
+
+    threading.Thread(target=asyncio.run, args=(run(),), daemon=True).start()
+    ready.wait()
+    return mock
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock local del protocolo de Redis")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--password", default=None, help="Exige AUTH con esta contraseña")
+    parser.add_argument("--latency", type=float, default=0.0, help="Latencia simulada por pipeline en segundos")
+    args = parser.parse_args()
+
+    async def main() -> None:
+        mock = MockRedis(args.password, args.latency)
+        server = await asyncio.start_server(mock.serve, "127.0.0.1", args.port)
+        print(f"🧪 Mock de Redis en redis://127.0.0.1:{args.port}")
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
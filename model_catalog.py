@@ -0,0 +1,337 @@
+"""
+Catálogo dinámico de modelos de Claude
+Descarga la lista de modelos de la API (/v1/models) una vez, la guarda en
+memoria con un TTL y la refresca en segundo plano. Resuelve alias como
+"latest sonnet" o "opus 4" al modelo más reciente de esa familia y rechaza
+localmente los modelos que la API no conoce, sin gastar una petición
+"""
+
+import asyncio
+import difflib
+import json
+import logging
+import os
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+
+import claude_client
+
+logger = logging.getLogger(__name__)
+
+FAMILIES = ("opus", "sonnet", "haiku")
+
+# Words that carry no meaning in an alias: "the latest claude sonnet" is just "sonnet"
+ALIAS_FILLER = {"claude", "latest", "newest", "the", "last", "model"}
+
+# Used only until the first successful download (or without an API key); never used to reject models
+FALLBACK_MODELS = [
+    {"id": "claude-opus-4-1-20250805", "display_name": "Claude Opus 4.1", "created_at": "2025-08-05T00:00:00Z"},
+    {"id": "claude-opus-4-20250514", "display_name": "Claude Opus 4", "created_at": "2025-05-22T00:00:00Z"},
+    {"id": "claude-sonnet-4-5-20250929", "display_name": "Claude Sonnet 4.5", "created_at": "2025-09-29T00:00:00Z"},
+    {"id": "claude-sonnet-4-20250514", "display_name": "Claude Sonnet 4", "created_at": "2025-05-22T00:00:00Z"},
+    {"id": "claude-3-7-sonnet-20250219", "display_name": "Claude Sonnet 3.7", "created_at": "2025-02-24T00:00:00Z"},
+    {"id": "claude-haiku-4-5-20251001", "display_name": "Claude Haiku 4.5", "created_at": "2025-10-15T00:00:00Z"},
+    {"id": "claude-3-5-haiku-20241022", "display_name": "Claude Haiku 3.5", "created_at": "2024-10-22T00:00:00Z"},
+]
+
+class UnknownModel(ValueError):
+    """El modelo pedido no existe en el catálogo de la API"""
+
+    def __init__(self, name: str, suggestions: List[str]):
+        message = f"modelo desconocido: '{name}'"
+        if suggestions:
+            message += f". ¿Quisiste decir {', '.join(suggestions)}?"
+        message += " (usa get_claude_models para ver la lista)"
+        super().__init__(message)
+        self.name = name
+        self.suggestions = suggestions
+
+def get_models_url() -> str:
+    """URL de /v1/models, derivada del endpoint de mensajes salvo que se indique ANTHROPIC_MODELS_URL"""
+    url = os.environ.get("ANTHROPIC_MODELS_URL")
+    if url:
+        return url
+    return re.sub(r"/messages/?$", "", claude_client.get_api_url().rstrip("/")) + "/models"
+
+def parse_model_id(model_id: str) -> Tuple[Optional[str], Tuple[int, ...]]:
+    """
+    Familia y versión de un id de modelo.
+
+    claude-3-5-sonnet-20241022 -> ("sonnet", (3, 5)); claude-opus-4-1-20250805 -> ("opus", (4, 1)).
+    Los números de 8 cifras son la fecha del snapshot y no forman parte de la versión.
+    """
+    family = None
+    version = []
+    for part in model_id.lower().split("-"):
+        if part in FAMILIES:
+            family = part
+        elif part.isdigit() and len(part) < 8:
+            version.append(int(part))
+    return family, tuple(version)
+
+def parse_alias(name: str) -> Tuple[Optional[str], Tuple[int, ...]]:
+    """Familia y versión pedidas en un alias libre: "latest sonnet", "Opus 4.1", "claude-3-5-haiku-latest" """
+    family = None
+    version = []
+    for word in re.split(r"[\s_\-.:/]+", name.lower()):
+        if not word or word in ALIAS_FILLER:
+            continue
+        if word in FAMILIES:
+            family = word
+        elif word.isdigit() and len(word) < 8:
+            version.append(int(word))
+        else:
+            return None, ()
+    return family, tuple(version)
+
+class ModelCatalog:
+    """
+    Lista de modelos en memoria con TTL y refresco en segundo plano.
+
+    Args:
+        api_key: API key de Anthropic (sin ella solo se usa la lista de respaldo)
+        ttl: Segundos tras los que la lista se vuelve a descargar
+        retry_interval: Segundos antes de reintentar una descarga fallida
+        aliases: Alias fijos adicionales {alias: modelo o alias}
+        validate: Si es false, los modelos desconocidos se envían igualmente a la API
+        load_timeout: Segundos que una llamada espera a la primera descarga antes de seguir sin ella
+    """
+
+    def __init__(
+        self,
+        api_key: Optional[str],
+        ttl: float = 3600,
+        retry_interval: float = 60,
+        aliases: Optional[Dict[str, str]] = None,
+        validate: bool = True,
+        load_timeout: float = 5,
+    ):
+        self.api_key = api_key
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.aliases = {name.lower(): target for name, target in (aliases or {}).items()}
+        self.validate = validate
+        self.load_timeout = load_timeout
+
+        self.models: List[Dict] = [dict(model) for model in FALLBACK_MODELS]
+        self.source = "fallback"
+        self.loaded_at = 0.0
+        self.attempted_at = 0.0
+        self.last_error: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+        self._runner: Optional[asyncio.Task] = None
+
+        self.refreshes = 0
+        self.failures = 0
+        self.resolved_aliases = 0
+        self.rejected = 0
+
+    @property
+    def authoritative(self) -> bool:
+        """Solo una lista descargada de la API permite rechazar modelos"""
+        return self.source == "api"
+
+    def is_stale(self, now: Optional[float] = None) -> bool:
+        now = now if now is not None else time.time()
+        if self.authoritative and self.loaded_at + self.ttl > now:
+            return False
+        # A failed download is retried after retry_interval, not on every lookup
+        return self.attempted_at + self.retry_interval <= now
+
+    async def fetch(self) -> List[Dict]:
+        """Descarga todas las páginas de /v1/models"""
+        client = claude_client.get_async_client()
+        models = []
+        params = {"limit": 1000}
+        while True:
+            response = await client.get(get_models_url(), headers=claude_client.build_headers(self.api_key), params=params)
+            if response.status_code != 200:
+                raise claude_client.AnthropicAPIError(response.status_code, claude_client.error_body(response), response.headers)
+            page = response.json()
+            models.extend(page.get("data", []))
+            if not page.get("has_more") or not page.get("last_id"):
+                return models
+            params = {"limit": 1000, "after_id": page["last_id"]}
+
+    async def _refresh(self) -> None:
+        self.attempted_at = time.time()
+        try:
+            models = await self.fetch()
+        except Exception as e:
+            # Keep serving the previous list; an outage upstream must not take the tools down
+            self.failures += 1
+            self.last_error = str(e)
+            logger.warning("No se pudo descargar la lista de modelos: %s", e)
+            return
+        if not models:
+            self.failures += 1
+            self.last_error = "la API retornó una lista vacía"
+            return
+        self.models = [
+            {"id": model["id"], "display_name": model.get("display_name", model["id"]), "created_at": model.get("created_at", "")}
+            for model in models
+        ]
+        self.source = "api"
+        self.loaded_at = time.time()
+        self.last_error = None
+        self.refreshes += 1
+
+    def refresh(self) -> Optional[asyncio.Task]:
+        """Lanza una descarga en segundo plano (o retorna la que ya está en curso)"""
+        if not self.api_key:
+            return None
+        if self._task is None or self._task.done():
+            try:
+                self._task = asyncio.get_running_loop().create_task(self._refresh())
+            except RuntimeError:
+                # Outside an event loop (sync scripts) the fallback list is all we have
+                return None
+        return self._task
+
+    def maybe_refresh(self) -> None:
+        """Refresca en segundo plano si la lista caducó; quien consulta sigue usando la actual"""
+        if self.is_stale():
+            self.refresh()
+
+    async def ensure_loaded(self) -> None:
+        """
+        Espera a la primera descarga (hasta load_timeout segundos) si aún no se intentó;
+        después solo lanza refrescos en segundo plano
+        """
+        first = not self.attempted_at
+        task = self.refresh() if self.is_stale() else None
+        if first and task is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(task), self.load_timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self) -> None:
+        """Bucle de refresco periódico (se arranca desde el lifespan del servidor)"""
+        while True:
+            task = self.refresh()
+            if task is None:
+                return
+            await task
+            await asyncio.sleep(self.ttl if self.authoritative and self.last_error is None else self.retry_interval)
+
+    def start(self) -> None:
+        if self.api_key and self._runner is None:
+            self._runner = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        for task in (self._runner, self._task):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._runner = None
+
+    def newest(self, family: Optional[str] = None, version: Tuple[int, ...] = ()) -> Optional[Dict]:
+        """Modelo más reciente de una familia cuya versión empieza por `version`"""
+        candidates = []
+        for model in self.models:
+            model_family, model_version = parse_model_id(model["id"])
+            if family is not None and model_family != family:
+                continue
+            if model_version[: len(version)] != version:
+                continue
+            candidates.append(model)
+        if not candidates:
+            return None
+        return max(candidates, key=lambda model: (model.get("created_at") or "", parse_model_id(model["id"])[1], model["id"]))
+
+    def resolve(self, name: str) -> str:
+        """
+        Retorna el id del modelo para un nombre o alias.
+
+        Acepta ids exactos, nombres visibles ("Claude Sonnet 4"), alias fijos
+        (CLAUDE_MODEL_ALIASES) y alias libres ("latest sonnet", "opus 4",
+        "claude-3-5-haiku-latest"), que se resuelven al modelo más reciente
+        que encaja.
+
+        Raises:
+            UnknownModel: si el catálogo viene de la API y el modelo no está en él
+        """
+        name = (name or "").strip()
+        self.maybe_refresh()
+        ids = {model["id"] for model in self.models}
+        if name in ids:
+            return name
+
+        # Fixed aliases point at an id or at another free-form alias ("fast" -> "latest haiku")
+        name = self.aliases.get(name.lower(), name)
+        if name in ids:
+            return name
+        lowered = name.lower()
+        for model in self.models:
+            if model.get("display_name", "").lower() == lowered:
+                return model["id"]
+
+        family, version = parse_alias(name)
+        if family is not None:
+            model = self.newest(family, version)
+            if model is not None:
+                self.resolved_aliases += 1
+                return model["id"]
+
+        if not self.authoritative or not self.validate:
+            # Without the real list we cannot tell; let the API decide
+            return name
+        self.rejected += 1
+        raise UnknownModel(name, difflib.get_close_matches(name, sorted(ids), n=3, cutoff=0.5))
+
+    def describe(self) -> List[Dict]:
+        """Modelos del más reciente al más antiguo, con su familia y los alias que los seleccionan"""
+        latest = {}
+        for family in FAMILIES:
+            model = self.newest(family)
+            if model is not None:
+                latest[model["id"]] = family
+        recommended = self.newest("sonnet")
+
+        models = []
+        for model in sorted(self.models, key=lambda model: (model.get("created_at") or "", model["id"]), reverse=True):
+            family, version = parse_model_id(model["id"])
+            aliases = [alias for alias, target in self.aliases.items() if target == model["id"]]
+            if model["id"] in latest:
+                aliases.append(f"latest {latest[model['id']]}")
+            models.append({
+                "name": model["id"],
+                "description": model.get("display_name", model["id"]),
+                "family": family,
+                "version": ".".join(str(part) for part in version),
+                "created_at": model.get("created_at", ""),
+                "aliases": aliases,
+                "recommended": recommended is not None and model["id"] == recommended["id"],
+            })
+        return models
+
+    def stats(self) -> Dict:
+        return {
+            "source": self.source,
+            "models": len(self.models),
+            "loaded_at": self.loaded_at,
+            "age": time.time() - self.loaded_at if self.loaded_at else None,
+            "ttl": self.ttl,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "resolved_aliases": self.resolved_aliases,
+            "rejected": self.rejected,
+            "validate": self.validate,
+        }
+
+def catalog_from_env(api_key: Optional[str]) -> ModelCatalog:
+    """Crea el catálogo de modelos a partir de las variables de entorno"""
+    return ModelCatalog(
+        api_key,
+        ttl=float(os.environ.get("CLAUDE_MODELS_TTL", 3600)),
+        retry_interval=float(os.environ.get("CLAUDE_MODELS_RETRY_INTERVAL", 60)),
+        aliases=json.loads(os.environ.get("CLAUDE_MODEL_ALIASES", "{}")),
+        validate=os.environ.get("CLAUDE_MODELS_VALIDATE", "true").lower() not in ("0", "false", "no"),
+        load_timeout=float(os.environ.get("CLAUDE_MODELS_LOAD_TIMEOUT", 5)),
+    )
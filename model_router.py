@@ -0,0 +1,335 @@
+"""
+Enrutado de modelos según latencia y errores
+Mantiene estadísticas deslizantes (latencia y tasa de error) y un circuit
+breaker por modelo. Los valores `auto:fast` y `auto:quality` eligen un modelo
+concreto con esas estadísticas, y ante un 529, un error 5xx o un timeout la
+llamada pasa a un modelo hermano en vez de fallar
+"""
+
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+import httpx
+
+import metrics
+import model_catalog
+
+# Upstream failures that say the model is unhealthy right now (not that the request is wrong)
+FALLBACK_STATUS = {500, 502, 503, 504, 529}
+
+# Routing classes: "latency" orders the models by measured latency, "preference" keeps the
+# configured order and only skips unhealthy models
+DEFAULT_ROUTES = {
+    "auto:fast": {"strategy": "latency", "models": ["latest haiku", "latest sonnet"]},
+    "auto:quality": {"strategy": "preference", "models": ["latest opus", "latest sonnet"]},
+}
+
+CIRCUIT_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+class CircuitOpen(Exception):
+    """Todos los modelos candidatos tienen el circuito abierto"""
+
+    def __init__(self, model: str, retry_in: float):
+        super().__init__(f"el modelo {model} está degradado (circuito abierto); reintenta en {retry_in:.0f}s")
+        self.model = model
+        self.retry_in = retry_in
+
+def is_failure(exc: BaseException) -> bool:
+    """Indica si un error cuenta contra la salud del modelo: sobrecarga, 5xx, timeouts y errores de red"""
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return status in FALLBACK_STATUS or status >= 500
+    return isinstance(exc, (httpx.TimeoutException, httpx.TransportError, asyncio.TimeoutError))
+
+class ModelStats:
+    """Resultados recientes de un modelo dentro de una ventana de tiempo y tamaño"""
+
+    def __init__(self, window: int = 100, horizon: float = 300):
+        self.horizon = horizon
+        self.samples: deque = deque(maxlen=window)
+
+    def record(self, seconds: Optional[float], now: Optional[float] = None) -> None:
+        """Anota un resultado: la latencia si fue bien, None si falló"""
+        self.samples.append((now if now is not None else time.time(), seconds))
+
+    def recent(self, now: Optional[float] = None) -> List[Optional[float]]:
+        cutoff = (now if now is not None else time.time()) - self.horizon
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+        return [seconds for _, seconds in self.samples]
+
+    def summary(self, now: Optional[float] = None) -> Dict:
+        recent = self.recent(now)
+        latencies = sorted(seconds for seconds in recent if seconds is not None)
+        return {
+            "samples": len(recent),
+            "error_rate": (len(recent) - len(latencies)) / len(recent) if recent else 0.0,
+            "p50": latencies[len(latencies) // 2] if latencies else None,
+            "p95": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] if latencies else None,
+        }
+
+class CircuitBreaker:
+    """
+    Circuit breaker de un modelo.
+
+    Se abre tras `failure_threshold` fallos seguidos o cuando la tasa de error
+    reciente supera `error_rate`; mientras está abierto el modelo no recibe
+    peticiones. Pasado el enfriamiento deja pasar una petición de prueba
+    (semiabierto): si va bien se cierra y si falla se vuelve a abrir con el
+    doble de enfriamiento, hasta `max_cooldown`.
+    """
+
+    def __init__(self, failure_threshold: int = 5, error_rate: float = 0.5, min_samples: int = 10, cooldown: float = 30, max_cooldown: float = 300):
+        self.failure_threshold = failure_threshold
+        self.error_rate = error_rate
+        self.min_samples = min_samples
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+        self.state = "closed"
+        self.cooldown = cooldown
+        self.opened_at = 0.0
+        self.probe_at = 0.0
+        self.consecutive_failures = 0
+        self.opens = 0
+
+    def retry_in(self, now: Optional[float] = None) -> float:
+        now = now if now is not None else time.time()
+        if self.state == "open":
+            return max(0.0, self.opened_at + self.cooldown - now)
+        if self.state == "half_open":
+            return max(0.0, self.probe_at + self.cooldown - now)
+        return 0.0
+
+    def available(self, now: Optional[float] = None) -> bool:
+        """Si el modelo puede recibir una petición ahora (sin reservar la prueba)"""
+        return self.retry_in(now) == 0.0
+
+    def allow(self, now: Optional[float] = None) -> bool:
+        """Reserva el paso de una petición; en semiabierto solo una prueba por enfriamiento"""
+        now = now if now is not None else time.time()
+        if not self.available(now):
+            return False
+        if self.state != "closed":
+            # A probe that never reports back frees the slot again after one cooldown
+            self.state = "half_open"
+            self.probe_at = now
+        return True
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        if self.state != "closed":
+            self.state = "closed"
+            self.cooldown = self.base_cooldown
+
+    def record_failure(self, stats: Dict, now: Optional[float] = None) -> None:
+        now = now if now is not None else time.time()
+        self.consecutive_failures += 1
+        if self.state == "half_open":
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            self._open(now)
+        elif self.state == "closed" and (
+            self.consecutive_failures >= self.failure_threshold
+            or (stats["samples"] >= self.min_samples and stats["error_rate"] >= self.error_rate)
+        ):
+            self._open(now)
+
+    def _open(self, now: float) -> None:
+        self.state = "open"
+        self.opened_at = now
+        self.opens += 1
+
+class ModelRouter:
+    """
+    Elige el modelo de cada llamada y la cadena de modelos de respaldo.
+
+    Args:
+        catalog: Catálogo de modelos para resolver ids y alias
+        routes: Clases de enrutado {"auto:fast": {"strategy": "latency"|"preference", "models": [...]}}
+        fallbacks: Modelos de respaldo por modelo o alias {"claude-opus-4-1-20250805": ["latest sonnet"]}
+        fallback_enabled: Si las llamadas a un modelo concreto pasan a un modelo hermano cuando falla
+        max_error_rate: Tasa de error a partir de la que un modelo se considera degradado al elegir
+        min_samples: Muestras mínimas para fiarse de las estadísticas de un modelo
+        window, horizon: Tamaño y antigüedad máxima (segundos) de la ventana de estadísticas
+        breaker: Parámetros de los circuit breakers (ver CircuitBreaker)
+    """
+
+    def __init__(
+        self,
+        catalog: model_catalog.ModelCatalog,
+        routes: Optional[Dict[str, Dict]] = None,
+        fallbacks: Optional[Dict[str, List[str]]] = None,
+        fallback_enabled: bool = True,
+        max_error_rate: float = 0.2,
+        min_samples: int = 5,
+        window: int = 100,
+        horizon: float = 300,
+        breaker: Optional[Dict] = None,
+    ):
+        self.catalog = catalog
+        self.routes = {**DEFAULT_ROUTES, **(routes or {})}
+        self.fallbacks = {name.lower(): targets for name, targets in (fallbacks or {}).items()}
+        self.fallback_enabled = fallback_enabled
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.window = window
+        self.horizon = horizon
+        self.breaker_options = breaker or {}
+        self.models: Dict[str, ModelStats] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+        self.routed = 0
+        self.fallback_count = 0
+        self.short_circuited = 0
+
+    def stats_for(self, model: str) -> ModelStats:
+        if model not in self.models:
+            self.models[model] = ModelStats(self.window, self.horizon)
+        return self.models[model]
+
+    def breaker_for(self, model: str) -> CircuitBreaker:
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker(**self.breaker_options)
+        return self.breakers[model]
+
+    def _resolve_all(self, names: List[str]) -> List[str]:
+        """Resuelve una lista de modelos o alias, sin duplicados ni modelos desconocidos"""
+        models = []
+        for name in names:
+            try:
+                model = self.catalog.resolve(name)
+            except model_catalog.UnknownModel:
+                continue
+            if model not in models:
+                models.append(model)
+        return models
+
+    def healthy(self, model: str, now: Optional[float] = None) -> bool:
+        summary = self.stats_for(model).summary(now)
+        degraded = summary["samples"] >= self.min_samples and summary["error_rate"] > self.max_error_rate
+        return self.breaker_for(model).available(now) and not degraded
+
+    def score(self, model: str) -> float:
+        """Latencia esperada: p50 inflada por la tasa de error (cada fallo cuesta otro intento)"""
+        summary = self.stats_for(model).summary()
+        if summary["samples"] < self.min_samples or summary["p50"] is None:
+            # Unmeasured models go first so they get measured
+            return 0.0
+        return summary["p50"] / max(1.0 - summary["error_rate"], 0.05)
+
+    def plan(self, name: str) -> List[str]:
+        """
+        Modelos a intentar, en orden, para el valor `model` de una llamada.
+
+        Para una clase auto:* los modelos sanos van primero (por latencia o por
+        preferencia) y los degradados al final; para un modelo concreto, el
+        propio modelo seguido de sus respaldos.
+
+        Raises:
+            model_catalog.UnknownModel: si el modelo o la clase no existen
+        """
+        route = self.routes.get(name.strip().lower())
+        if route is not None:
+            self.routed += 1
+            models = self._resolve_all(route["models"])
+            if not models:
+                raise model_catalog.UnknownModel(name, [])
+            if route.get("strategy", "preference") == "latency":
+                models.sort(key=self.score)
+            return [model for model in models if self.healthy(model)] + [model for model in models if not self.healthy(model)]
+        if name.strip().lower().startswith("auto:"):
+            raise model_catalog.UnknownModel(name, sorted(self.routes))
+
+        model = self.catalog.resolve(name)
+        if not self.fallback_enabled:
+            return [model]
+        return [model] + [fallback for fallback in self._resolve_all(self.fallbacks_for(model, name)) if fallback != model]
+
+    def fallbacks_for(self, model: str, requested: str = "") -> List[str]:
+        """Respaldos configurados para el modelo (o el alias pedido); por defecto, el modelo más reciente de la misma familia"""
+        for key in (model.lower(), requested.strip().lower()):
+            if key in self.fallbacks:
+                return self.fallbacks[key]
+        family, _ = model_catalog.parse_model_id(model)
+        if family is None:
+            return []
+        siblings = [candidate for candidate in self.catalog.models if candidate["id"] != model and model_catalog.parse_model_id(candidate["id"])[0] == family]
+        if not siblings:
+            return []
+        return [max(siblings, key=lambda candidate: (candidate.get("created_at") or "", candidate["id"]))["id"]]
+
+    def choose(self, name: str) -> str:
+        """Primer modelo del plan (para conversaciones y batches, que fijan un modelo concreto)"""
+        return self.plan(name)[0]
+
+    def allow(self, model: str) -> bool:
+        allowed = self.breaker_for(model).allow()
+        if not allowed:
+            self.short_circuited += 1
+        self._publish(model)
+        return allowed
+
+    def record(self, model: str, seconds: float, error: Optional[BaseException] = None) -> None:
+        """Anota el resultado de un intento contra el modelo (los errores del cliente, como 400, no cuentan)"""
+        stats = self.stats_for(model)
+        breaker = self.breaker_for(model)
+        if error is None:
+            stats.record(seconds)
+            breaker.record_success()
+        elif is_failure(error):
+            stats.record(None)
+            breaker.record_failure(stats.summary())
+        self._publish(model)
+
+    def record_fallback(self, from_model: str, to_model: str) -> None:
+        self.fallback_count += 1
+        metrics.model_fallbacks.inc(from_model=from_model, to_model=to_model)
+
+    def retry_in(self, model: str) -> float:
+        return self.breaker_for(model).retry_in()
+
+    def _publish(self, model: str) -> None:
+        metrics.circuit_state.set(CIRCUIT_STATE_VALUES[self.breaker_for(model).state], model=model)
+
+    def stats(self) -> Dict:
+        models = {}
+        for model, stats in self.models.items():
+            breaker = self.breaker_for(model)
+            models[model] = {
+                **stats.summary(),
+                "circuit": breaker.state,
+                "retry_in": breaker.retry_in(),
+                "opens": breaker.opens,
+            }
+        return {
+            "routes": {name: route["models"] for name, route in self.routes.items()},
+            "fallback_enabled": self.fallback_enabled,
+            "routed": self.routed,
+            "fallbacks": self.fallback_count,
+            "short_circuited": self.short_circuited,
+            "models": models,
+        }
+
+def router_from_env(catalog: model_catalog.ModelCatalog) -> ModelRouter:
+    """Crea el enrutador de modelos a partir de las variables de entorno"""
+    return ModelRouter(
+        catalog,
+        routes=json.loads(os.environ.get("CLAUDE_ROUTES", "{}")),
+        fallbacks=json.loads(os.environ.get("CLAUDE_MODEL_FALLBACKS", "{}")),
+        fallback_enabled=os.environ.get("CLAUDE_FALLBACK_ENABLED", "true").lower() not in ("0", "false", "no"),
+        max_error_rate=float(os.environ.get("CLAUDE_ROUTER_MAX_ERROR_RATE", 0.2)),
+        min_samples=int(os.environ.get("CLAUDE_ROUTER_MIN_SAMPLES", 5)),
+        window=int(os.environ.get("CLAUDE_ROUTER_WINDOW", 100)),
+        horizon=float(os.environ.get("CLAUDE_ROUTER_HORIZON", 300)),
+        breaker={
+            "failure_threshold": int(os.environ.get("CLAUDE_CIRCUIT_FAILURES", 5)),
+            "error_rate": float(os.environ.get("CLAUDE_CIRCUIT_ERROR_RATE", 0.5)),
+            "min_samples": int(os.environ.get("CLAUDE_CIRCUIT_MIN_SAMPLES", 10)),
+            "cooldown": float(os.environ.get("CLAUDE_CIRCUIT_COOLDOWN", 30)),
+            "max_cooldown": float(os.environ.get("CLAUDE_CIRCUIT_MAX_COOLDOWN", 300)),
+        },
+    )
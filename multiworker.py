@@ -0,0 +1,442 @@
+"""
+Modo de despliegue multi-proceso para el servidor MCP
+Arranca WEB_CONCURRENCY procesos worker (cada uno con la app ASGI de app.py,
+cargada a través de startup.py) en puertos internos y un router en PORT que
+reparte las conexiones.
+
+Las sesiones SSE son "sticky": el router lee el evento `endpoint` que envía el
+worker al abrir /sse, guarda a qué worker pertenece el session_id y envía allí
+todos los POST a /messages/ de esa sesión. Con Streamable HTTP sin estado
+(MCP_STATELESS_HTTP=true) cada petición a /mcp es independiente y se reparte
+en round robin; con estado, la cabecera mcp-session-id fija el worker.
+
+El router es un solo proceso Python que copia cada byte entre clientes y
+workers, así que con mucho tráfico es el techo de throughput. Cuando no hace
+falta afinidad de sesión (solo Streamable HTTP sin estado) no se usa: cada
+worker abre PORT con SO_REUSEPORT y el kernel reparte las conexiones entre
+ellos directamente (MCP_WORKER_BALANCE, ver balance_mode).
+
+Uso:
+    WEB_CONCURRENCY=4 python startup.py
+    python multiworker.py --workers 4
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs
+
+import anyio
+import httpx
+import uvicorn
+
+SSE_PATH = "/sse"
+MESSAGE_PATH = "/messages/"
+STREAMABLE_HTTP_PATH = "/mcp"
+METRICS_PATH = "/metrics"
+MCP_SESSION_HEADER = b"mcp-session-id"
+SESSION_ID_PATTERN = re.compile(rb"session_id=([0-9a-fA-F]+)")
+
+METRICS_CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
+
+ROUTER = "router"
+REUSEPORT = "reuseport"
+
+# Headers that describe a single hop and must not be forwarded
+HOP_HEADERS = {b"connection", b"keep-alive", b"transfer-encoding", b"upgrade", b"host", b"content-length"}
+# The request body is streamed through unchanged, so its Content-Length still holds
+REQUEST_HOP_HEADERS = HOP_HEADERS - {b"content-length"}
+
+def reuseport_supported() -> bool:
+    return hasattr(socket, "SO_REUSEPORT")
+
+def balance_mode() -> str:
+    """
+    Cómo se reparten las conexiones entre workers según MCP_WORKER_BALANCE.
+
+    "auto" (default) usa SO_REUSEPORT cuando el transporte es solo Streamable
+    HTTP sin estado y el sistema lo soporta, y el router en los demás casos;
+    "router" fuerza el router. SSE y las sesiones con estado necesitan el
+    router para llevar cada petición al worker dueño de la sesión, así que
+    "reuseport" solo se aplica cuando no las hay.
+    """
+    setting = os.environ.get("MCP_WORKER_BALANCE", "auto").lower()
+    stateless = (
+        os.environ.get("MCP_TRANSPORT", "sse").lower() == "streamable-http"
+        and os.environ.get("MCP_STATELESS_HTTP", "true").lower() in ("1", "true", "yes")
+    )
+    if setting == ROUTER or not stateless or not reuseport_supported():
+        if setting == REUSEPORT:
+            print("⚠️  MCP_WORKER_BALANCE=reuseport necesita MCP_TRANSPORT=streamable-http sin estado y SO_REUSEPORT; se usa el router")
+        return ROUTER
+    return REUSEPORT
+
+class Worker:
+    """
+    Un proceso worker y sus sesiones SSE activas.
+
+    Escucha siempre en un puerto interno (salud y métricas); con `public`
+    (host, puerto) abre además ese puerto con SO_REUSEPORT y atiende a los
+    clientes directamente.
+    """
+
+    def __init__(self, index: int, port: int, public: Optional[tuple] = None, peers: str = ""):
+        self.index = index
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.public = public
+        self.peers = peers
+        self.process: Optional[subprocess.Popen] = None
+        self.sessions = 0
+
+    def start(self) -> None:
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        if self.public is not None:
+            host, port = self.public
+            env = dict(os.environ, MCP_WORKER_INDEX=str(self.index), MCP_WORKER_PEERS=self.peers)
+            self.process = subprocess.Popen([
+                sys.executable, os.path.join(cwd, "multiworker.py"), "--serve-worker",
+                "--host", host, "--port", str(port), "--internal-port", str(self.port),
+            ], cwd=cwd, env=env)
+            return
+        self.process = subprocess.Popen([
+            # startup.py listens right away and imports app.py in the background
+            sys.executable, "-m", "uvicorn", "startup:create_app", "--factory",
+            "--host", "127.0.0.1", "--port", str(self.port),
+            # uvicorn's CLI would otherwise read WEB_CONCURRENCY and fork its own workers
+            "--workers", "1",
+            "--log-level", os.environ.get("MCP_WORKER_LOG_LEVEL", "warning"),
+        ], cwd=cwd)
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+class Router:
+    """
+    Aplicación ASGI que reparte las peticiones entre los workers.
+
+    - GET /sse: se asigna al worker con menos sesiones abiertas
+    - POST /messages/?session_id=...: va al worker dueño de la sesión
+    - /mcp con cabecera mcp-session-id: va al worker dueño de la sesión
+    - GET /metrics: une las métricas de todos los workers con la etiqueta `worker`
+    - Resto de rutas (incluido /mcp sin sesión): round robin
+    """
+
+    def __init__(self, workers: List[Worker]):
+        self.workers = workers
+        self.sessions: Dict[str, Worker] = {}
+        self.round_robin = itertools.cycle(workers)
+        self.client: Optional[httpx.AsyncClient] = None
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        path = scope["path"]
+        if scope["method"] == "GET" and path == SSE_PATH:
+            worker = min(self.workers, key=lambda w: w.sessions)
+            await self.forward_sse(scope, receive, send, worker)
+        elif path.startswith(MESSAGE_PATH):
+            query = parse_qs(scope.get("query_string", b"").decode())
+            worker = self.sessions.get(query.get("session_id", [""])[0])
+            if worker is None:
+                await self.respond(send, 404, b"Could not find session")
+                return
+            await self.forward(scope, receive, send, worker)
+        elif scope["method"] == "GET" and path == METRICS_PATH:
+            await self.respond(send, 200, await self.collect_metrics(), METRICS_CONTENT_TYPE)
+        elif path.startswith(STREAMABLE_HTTP_PATH):
+            await self.forward_streamable_http(scope, receive, send)
+        else:
+            await self.forward(scope, receive, send, next(self.round_robin))
+
+    async def lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.client = httpx.AsyncClient(
+                    timeout=httpx.Timeout(None, connect=5),
+                    limits=httpx.Limits(max_connections=None, max_keepalive_connections=100),
+                )
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.client.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def respond(self, send, status: int, body: bytes, content_type: bytes = b"text/plain") -> None:
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", content_type)]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def iter_body(self, receive):
+        """Cuerpo de la petición a medida que llega, para reenviarlo sin acumularlo en el router"""
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise anyio.EndOfStream
+            yield message.get("body", b"")
+            if not message.get("more_body"):
+                return
+
+    def build_request(self, scope, worker: Worker, receive) -> httpx.Request:
+        url = worker.url + scope["path"]
+        if scope.get("query_string"):
+            url += "?" + scope["query_string"].decode()
+        headers = [(k, v) for k, v in scope["headers"] if k.lower() not in REQUEST_HOP_HEADERS]
+        has_body = any(k.lower() in (b"content-length", b"transfer-encoding") for k, _ in scope["headers"])
+        content = self.iter_body(receive) if has_body else b""
+        return self.client.build_request(scope["method"], url, headers=headers, content=content)
+
+    async def forward(self, scope, receive, send, worker: Worker, on_chunk=None, on_headers=None) -> None:
+        """Reenvía la petición al worker (el cuerpo a trozos) y transmite la respuesta a medida que llega"""
+        try:
+            response = await self.client.send(self.build_request(scope, worker, receive), stream=True)
+        except anyio.EndOfStream:
+            return
+        except httpx.TransportError:
+            await self.respond(send, 502, b"Worker unavailable")
+            return
+
+        try:
+            if on_headers is not None:
+                on_headers(response)
+            headers = [(k, v) for k, v in response.headers.raw if k.lower() not in HOP_HEADERS]
+            await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+
+            async def relay():
+                async for chunk in response.aiter_raw():
+                    if on_chunk is not None:
+                        on_chunk(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                await send({"type": "http.response.body", "body": b""})
+
+            async def watch_disconnect():
+                while (await receive())["type"] != "http.disconnect":
+                    pass
+
+            # Whichever finishes first (worker ends the stream or client leaves) stops the other
+            async with anyio.create_task_group() as tg:
+                async def run_and_cancel(fn):
+                    await fn()
+                    tg.cancel_scope.cancel()
+
+                tg.start_soon(run_and_cancel, relay)
+                tg.start_soon(run_and_cancel, watch_disconnect)
+        finally:
+            await response.aclose()
+
+    async def forward_sse(self, scope, receive, send, worker: Worker) -> None:
+        """Abre un stream SSE en el worker y registra el session_id que anuncia"""
+        session = {"id": None}
+
+        def sniff(chunk: bytes) -> None:
+            if session["id"] is None:
+                match = SESSION_ID_PATTERN.search(chunk)
+                if match:
+                    session["id"] = match.group(1).decode()
+                    self.sessions[session["id"]] = worker
+
+        worker.sessions += 1
+        try:
+            await self.forward(scope, receive, send, worker, on_chunk=sniff)
+        finally:
+            worker.sessions -= 1
+            if session["id"] is not None:
+                self.sessions.pop(session["id"], None)
+
+    async def forward_streamable_http(self, scope, receive, send) -> None:
+        """Reenvía /mcp; las sesiones con estado quedan fijadas al worker que las creó"""
+        session_id = dict(scope["headers"]).get(MCP_SESSION_HEADER)
+        if session_id is None:
+            worker = next(self.round_robin)
+        else:
+            worker = self.sessions.get(session_id.decode())
+            if worker is None:
+                await self.respond(send, 404, b"Could not find session")
+                return
+
+        def register(response: httpx.Response) -> None:
+            created = response.headers.get(MCP_SESSION_HEADER.decode())
+            if created and response.is_success:
+                self.sessions[created] = worker
+
+        await self.forward(scope, receive, send, worker, on_headers=register)
+        if session_id is not None and scope["method"] == "DELETE":
+            self.sessions.pop(session_id.decode(), None)
+
+    async def collect_metrics(self) -> bytes:
+        """Pide /metrics a cada worker y une las series añadiendo la etiqueta worker"""
+
+        async def fetch(worker: Worker) -> str:
+            try:
+                response = await self.client.get(worker.url + METRICS_PATH, timeout=5)
+                return response.text if response.status_code == 200 else ""
+            except httpx.TransportError:
+                return ""
+
+        texts = await asyncio.gather(*[fetch(worker) for worker in self.workers])
+        return merge_metrics({str(worker.index): text for worker, text in zip(self.workers, texts)}).encode()
+
+def merge_metrics(texts: Dict[str, str]) -> str:
+    """
+    Une varias exposiciones de Prometheus en una sola.
+
+    Las líneas HELP/TYPE de cada familia se emiten una vez y sus muestras
+    quedan juntas, cada una con la etiqueta worker del proceso de origen.
+    """
+    headers: Dict[str, List[str]] = {}
+    samples: Dict[str, List[str]] = {}
+    for worker, text in texts.items():
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# "):
+                family = line.split(" ", 3)[2]
+                if line not in headers.setdefault(family, []):
+                    headers[family].append(line)
+                samples.setdefault(family, [])
+            elif line.strip() and family is not None:
+                name, _, value = line.rpartition(" ")
+                label = f'worker="{worker}"'
+                name = f"{name[:-1]},{label}}}" if name.endswith("}") else f"{name}{{{label}}}"
+                samples[family].append(f"{name} {value}")
+    return "\n".join(line for family in headers for line in headers[family] + samples[family]) + "\n"
+
+async def merge_peer_metrics(index: str, text: str, peers: str) -> str:
+    """
+    Métricas de todos los workers en modo SO_REUSEPORT: el worker que recibe
+    el scrape une las suyas (`text`) con las que pide a los demás por su
+    puerto interno (`peers`: "índice=url,...", con ?local=1 para no recursar)
+    """
+    urls = dict(peer.split("=", 1) for peer in peers.split(",") if peer)
+    urls.pop(index, None)
+
+    async with httpx.AsyncClient(timeout=5) as client:
+        async def fetch(url: str) -> str:
+            try:
+                response = await client.get(url + METRICS_PATH, params={"local": "1"})
+                return response.text if response.status_code == 200 else ""
+            except httpx.TransportError:
+                return ""
+
+        texts = await asyncio.gather(*[fetch(url) for url in urls.values()])
+    return merge_metrics({index: text, **dict(zip(urls, texts))})
+
+def bind_reuseport(host: str, port: int) -> socket.socket:
+    """Socket de escucha en `port` compartido con los demás workers (el kernel reparte las conexiones)"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    return sock
+
+def serve_worker(host: str, port: int, internal_port: int) -> None:
+    """Proceso worker en modo SO_REUSEPORT: atiende PORT directamente y el puerto interno"""
+    import startup
+
+    sockets = [bind_reuseport(host, port), startup.bind_socket("127.0.0.1", internal_port)]
+    boot = startup.BootApp()
+    server = uvicorn.Server(uvicorn.Config(boot, log_level=os.environ.get("MCP_WORKER_LOG_LEVEL", "warning")))
+    # A worker that cannot load the app exits and the supervisor starts it again
+    boot.on_failure = lambda: setattr(server, "should_exit", True)
+    server.run(sockets=sockets)
+    if boot.error is not None:
+        sys.exit(1)
+
+def find_free_port() -> int:
+    """Busca un puerto TCP libre en localhost"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_until_listening(worker: Worker, timeout: float = 30) -> None:
+    """Espera a que el worker acepte conexiones"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not worker.alive():
+            raise RuntimeError(f"el worker {worker.index} terminó al arrancar")
+        try:
+            with socket.create_connection(("127.0.0.1", worker.port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"el worker {worker.index} no respondió en {timeout:g}s")
+
+async def supervise(workers: List[Worker], router: Optional[Router] = None) -> None:
+    """Reinicia los workers que terminan inesperadamente"""
+    while True:
+        await asyncio.sleep(1)
+        for worker in workers:
+            if not worker.alive():
+                print(f"⚠️  Worker {worker.index} terminó, reiniciando")
+                if router is not None:
+                    for session_id, owner in list(router.sessions.items()):
+                        if owner is worker:
+                            del router.sessions[session_id]
+                worker.start()
+
+async def serve(host: str, port: int, workers: List[Worker]) -> None:
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    router = Router(workers)
+    server = uvicorn.Server(uvicorn.Config(router, host=host, port=port, log_level="info"))
+    supervisor = asyncio.ensure_future(supervise(workers, router))
+    try:
+        await server.serve()
+    finally:
+        supervisor.cancel()
+
+def main(workers: int, host: str = "0.0.0.0", port: int = 8080) -> None:
+    """Arranca los workers y, si hace falta afinidad de sesión, el router, en primer plano"""
+    # Turn SIGTERM into SystemExit so the workers are always stopped with the router
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    mode = balance_mode()
+    ports = [find_free_port() for _ in range(workers)]
+    if mode == REUSEPORT:
+        peers = ",".join(f"{i}=http://127.0.0.1:{internal}" for i, internal in enumerate(ports))
+        pool = [Worker(i, internal, (host, port), peers) for i, internal in enumerate(ports)]
+    else:
+        pool = [Worker(i, internal) for i, internal in enumerate(ports)]
+    for worker in pool:
+        worker.start()
+    try:
+        for worker in pool:
+            wait_until_listening(worker)
+        if mode == REUSEPORT:
+            print(f"🧩 {workers} workers escuchando en {host}:{port} con SO_REUSEPORT (sin router)")
+            asyncio.run(supervise(pool))
+        else:
+            print(f"🧩 {workers} workers escuchando, router en {host}:{port}")
+            asyncio.run(serve(host, port, pool))
+    finally:
+        for worker in pool:
+            if worker.alive():
+                worker.process.terminate()
+        for worker in pool:
+            if worker.process is not None:
+                worker.process.wait(timeout=10)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor MCP multi-proceso con sesiones SSE sticky")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8080)))
+    parser.add_argument("--serve-worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--internal-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_worker:
+        serve_worker(args.host, args.port, args.internal_port)
+    else:
+        main(args.workers, args.host, args.port)
@@ -0,0 +1,103 @@
+"""
+Profiler por muestreo para analizar en producción dónde se va la CPU
+Un hilo toma cada pocos milisegundos la pila del hilo del event loop (con
+sys._current_frames, sin instrumentar el código) y cuenta cuántas veces
+aparece cada pila. El resultado sale en formato "folded" (una línea por pila,
+`a;b;c N`), el que leen flamegraph.pl, speedscope o inferno, o como una tabla
+de funciones con sus muestras propias y acumuladas.
+
+Las muestras en `select`/`epoll` del event loop son tiempo ocioso esperando
+red; el resto es CPU del servidor.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+class ProfilerBusy(Exception):
+    """Ya hay un perfil en curso"""
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f"{module}.{code.co_name}:{frame.f_lineno}"
+
+def fold(frame, max_depth: int = 128) -> str:
+    """Pila de un frame como `raíz;...;hoja`"""
+    names = []
+    while frame is not None and len(names) < max_depth:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class SamplingProfiler:
+    """
+    Muestrea la pila de un hilo durante un tiempo; un perfil a la vez.
+
+    Args:
+        max_seconds: Duración máxima de un perfil
+    """
+
+    def __init__(self, max_seconds: float = 60):
+        self.max_seconds = max_seconds
+        self._lock = threading.Lock()
+        self.profiles = 0
+
+    def sample(self, thread_id: int, seconds: float, interval: float) -> Dict:
+        """
+        Muestrea `thread_id` durante `seconds` segundos cada `interval` segundos (bloquea; llamar desde otro hilo).
+
+        Raises:
+            ProfilerBusy: si ya hay otro perfil en curso
+        """
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusy("ya hay un perfil en curso")
+        try:
+            self.profiles += 1
+            seconds = min(max(seconds, interval), self.max_seconds)
+            stacks: Counter = Counter()
+            samples = 0
+            start = time.perf_counter()
+            deadline = start + seconds
+            while time.perf_counter() < deadline:
+                frame = sys._current_frames().get(thread_id)
+                if frame is not None:
+                    stacks[fold(frame)] += 1
+                    samples += 1
+                del frame
+                time.sleep(interval)
+            return {"samples": samples, "seconds": round(time.perf_counter() - start, 3), "interval": interval, "stacks": stacks}
+        finally:
+            self._lock.release()
+
+def folded(profile: Dict) -> str:
+    """Perfil en formato folded, las pilas más frecuentes primero"""
+    return "".join(f"{stack} {count}\n" for stack, count in profile["stacks"].most_common())
+
+def top(profile: Dict, limit: int = 30) -> List[Dict]:
+    """Funciones con más muestras propias (en la hoja) y acumuladas (en cualquier punto de la pila)"""
+    own: Counter = Counter()
+    total: Counter = Counter()
+    for stack, count in profile["stacks"].items():
+        frames = [name.rsplit(":", 1)[0] for name in stack.split(";")]
+        own[frames[-1]] += count
+        for name in set(frames):
+            total[name] += count
+    samples = profile["samples"] or 1
+    return [
+        {"function": name, "own": own[name], "own_ratio": round(own[name] / samples, 4), "total": total[name], "total_ratio": round(total[name] / samples, 4)}
+        for name, _ in own.most_common(limit)
+    ]
+
+def profiler_from_env() -> Optional[SamplingProfiler]:
+    """
+    Crea el profiler a partir de las variables de entorno.
+
+    Retorna None (endpoint desactivado) salvo que CLAUDE_PROFILER_ENABLED sea "true".
+    """
+    if os.environ.get("CLAUDE_PROFILER_ENABLED", "false").lower() not in ("1", "true", "yes"):
+        return None
+    return SamplingProfiler(max_seconds=float(os.environ.get("CLAUDE_PROFILER_MAX_SECONDS", 60)))
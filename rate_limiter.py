@@ -0,0 +1,368 @@
+"""
+Gobernador de uso por modelo para la API de Anthropic
+Token buckets de peticiones y tokens por minuto (sembrados con las cabeceras
+anthropic-ratelimit-*) más un límite de concurrencia adaptativo (AIMD) que se
+reduce cuando el upstream responde 429/529.
+Con un backend de estado compartido, cada réplica suma su consumo a contadores
+comunes en segundo plano y descuenta de sus buckets lo que consumieron las
+demás, y las pausas tras un 429/529 se propagan a todas las réplicas.
+"""
+
+import asyncio
+import os
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+import claude_client
+import deadlines
+import state_backend
+
+# Status codes that mean the upstream is pushing back
+OVERLOAD_STATUS = (429, 529)
+
+# Shared counters expire after this long without updates (a new baseline is taken then)
+SHARED_COUNTER_TTL = 3600
+
+class RateLimitExceeded(Exception):
+    """La petición tendría que esperar más de lo permitido en la cola"""
+
+class TokenBucket:
+    """Bucket que se rellena de forma continua hasta `capacity` cada minuto"""
+
+    def __init__(self, per_minute: float = 0):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        # Own consumption not yet added to the shared counter, and the counter's value after the last sync
+        self.unsynced = 0.0
+        self.synced_total: Optional[float] = None
+
+    @property
+    def limited(self) -> bool:
+        return self.capacity > 0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Segundos hasta que haya `amount` disponibles (0 si no hay límite)"""
+        if not self.limited:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60 / self.capacity
+
+    def consume(self, amount: float) -> None:
+        if self.limited:
+            self.tokens -= amount
+            self.unsynced += amount
+
+    def refund(self, amount: float) -> None:
+        if self.limited:
+            self.tokens = min(self.capacity, self.tokens + amount)
+            self.unsynced -= amount
+
+    async def sync(self, backend: state_backend.StateBackend, key: str) -> None:
+        """Suma el consumo propio al contador compartido y descuenta del bucket el de las demás réplicas"""
+        if not self.limited:
+            return
+        delta, self.unsynced = self.unsynced, 0.0
+        total = await backend.incr(key, delta, SHARED_COUNTER_TTL)
+        if total is None:
+            self.unsynced += delta
+            return
+        # A counter that went backwards expired or was reset: take it as the new baseline
+        if self.synced_total is not None and total >= self.synced_total + delta:
+            self.tokens -= total - self.synced_total - delta
+        self.synced_total = total
+
+    def seed(self, limit: float, remaining: float) -> None:
+        """Ajusta el bucket al límite y al saldo que reporta el upstream"""
+        self._refill(time.monotonic())
+        seeded = self.limited
+        self.capacity = limit
+        self.tokens = min(self.tokens, remaining) if seeded else remaining
+
+def _parse_reset(value: Optional[str]) -> Optional[float]:
+    """Convierte una fecha RFC 3339 de las cabeceras en segundos desde ahora"""
+    if not value:
+        return None
+    try:
+        reset = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return max(0.0, reset.timestamp() - time.time())
+
+def retry_after_seconds(headers: Dict) -> Optional[float]:
+    """Lee la cabecera Retry-After (en segundos) si existe"""
+    for name, value in headers.items():
+        if name.lower() == "retry-after":
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                return None
+    return None
+
+def estimate_tokens(payload: Dict) -> int:
+    """Estimación barata de tokens de una petición: ~4 caracteres por token más max_tokens"""
+    size = claude_client.payload_chars(payload.get("messages", [])) + claude_client.payload_chars(payload.get("system", ""))
+    return size // 4 + int(payload.get("max_tokens", 0))
+
+class ModelLimiter:
+    """Estado de limitación de un modelo: buckets, concurrencia AIMD y cola"""
+
+    def __init__(self, rpm: float, tpm: float, max_concurrency: int, min_concurrency: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency_limit = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.changed = asyncio.Event()
+
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.overloads = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def wait_time(self, estimate: int, now: float) -> float:
+        """Segundos que hay que esperar por tiempo (pausa o buckets); 0 si se puede pasar"""
+        return max(
+            self.paused_until - now,
+            self.requests.wait_time(1, now),
+            self.tokens.wait_time(estimate, now),
+            0.0,
+        )
+
+    def has_slot(self) -> bool:
+        return self.in_flight < max(int(self.concurrency_limit), self.min_concurrency)
+
+    def notify(self) -> None:
+        """Despierta a las peticiones en cola para que reevalúen si pueden pasar"""
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def on_success(self) -> None:
+        # Additive increase: roughly +1 slot per window of successful requests
+        self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1 / self.concurrency_limit)
+
+    def on_overload(self, retry_after: Optional[float]) -> None:
+        # Multiplicative decrease and a pause before the next request is sent
+        self.overloads += 1
+        self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit / 2)
+        pause = retry_after if retry_after is not None else 1.0
+        self.paused_until = max(self.paused_until, time.monotonic() + pause)
+
+    async def sync(self, backend: state_backend.StateBackend, key: str) -> None:
+        """Sincroniza los buckets y la pausa por 429/529 con las demás réplicas (claves `key`:*)"""
+        _, _, paused = await asyncio.gather(
+            self.requests.sync(backend, key + ":requests"),
+            self.tokens.sync(backend, key + ":tokens"),
+            backend.get(key + ":paused"),
+        )
+        now, wall = time.monotonic(), time.time()
+        shared_pause = float(paused) - wall if paused is not None else 0.0
+        local_pause = self.paused_until - now
+        if shared_pause > local_pause:
+            self.paused_until = now + shared_pause
+        elif local_pause > shared_pause + 0.05:
+            backend.set(key + ":paused", repr(wall + local_pause).encode(), local_pause)
+
+    def observe_headers(self, headers) -> None:
+        """Siembra los buckets con las cabeceras anthropic-ratelimit-* de una respuesta"""
+        for kind, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+            limit = headers.get(f"anthropic-ratelimit-{kind}-limit")
+            remaining = headers.get(f"anthropic-ratelimit-{kind}-remaining")
+            if limit is None or remaining is None:
+                continue
+            try:
+                bucket.seed(float(limit), float(remaining))
+            except ValueError:
+                continue
+            if float(remaining) <= 0:
+                reset = _parse_reset(headers.get(f"anthropic-ratelimit-{kind}-reset"))
+                if reset is not None:
+                    self.paused_until = max(self.paused_until, time.monotonic() + reset)
+
+    def stats(self) -> Dict:
+        return {
+            "concurrency_limit": round(self.concurrency_limit, 2),
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "overloads": self.overloads,
+            "rpm_limit": self.requests.capacity or None,
+            "tpm_limit": self.tokens.capacity or None,
+            "paused_for_s": round(max(0.0, self.paused_until - time.monotonic()), 2),
+            "wait_time_avg_ms": 1000 * self.wait_time_total / self.admitted if self.admitted else 0.0,
+            "wait_time_max_ms": 1000 * self.wait_time_max,
+        }
+
+class Permit:
+    """
+    Permiso para enviar una petición upstream.
+
+    Se usa como context manager asíncrono: al entrar espera en la cola hasta
+    que el modelo tenga capacidad; al salir libera el slot de concurrencia y
+    actualiza el estado AIMD según si la petición fue aceptada o rechazada.
+    """
+
+    def __init__(self, governor: "RateGovernor", model: str, estimate: int):
+        self.governor = governor
+        self.model = model
+        self.limiter = governor.limiter(model)
+        self.estimate = estimate
+
+    def observe_headers(self, headers) -> None:
+        self.limiter.observe_headers(headers)
+
+    def record_usage(self, usage: Optional[Dict]) -> None:
+        """Corrige el bucket de tokens con el uso real reportado por la API"""
+        if not usage:
+            return
+        used = usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+        self.limiter.tokens.refund(self.estimate - used)
+
+    async def __aenter__(self) -> "Permit":
+        await self.governor.wait_for_capacity(self.limiter, self.model, self.estimate)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        limiter = self.limiter
+        limiter.in_flight -= 1
+        status = getattr(exc, "status_code", None)
+        if status in OVERLOAD_STATUS:
+            limiter.on_overload(retry_after_seconds(getattr(exc, "headers", {})))
+        elif exc is None:
+            limiter.on_success()
+        limiter.notify()
+
+class RateGovernor:
+    """Limitadores por modelo con espera acotada en cola"""
+
+    def __init__(self, rpm: float = 0, tpm: float = 0, max_concurrency: int = 16, min_concurrency: int = 1, max_wait: float = 30):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_wait = max_wait
+        self.limiters: Dict[str, ModelLimiter] = {}
+        self.shared: Optional[state_backend.StateBackend] = None
+        self.sync_interval = 0.25
+        self._sync_task: Optional[asyncio.Task] = None
+        self.syncs = 0
+
+    def attach(self, backend: state_backend.StateBackend, interval: float) -> None:
+        """Comparte los límites con las demás réplicas a través de `backend`, sincronizando cada `interval` segundos"""
+        self.shared = backend
+        self.sync_interval = interval
+
+    def start(self) -> None:
+        """Arranca la sincronización en segundo plano (si hay backend compartido)"""
+        if self.shared is not None and self._sync_task is None:
+            self._sync_task = asyncio.create_task(self._sync_loop())
+
+    async def stop(self) -> None:
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            try:
+                await self._sync_task
+            except asyncio.CancelledError:
+                pass
+            self._sync_task = None
+        if self.shared is not None:
+            # Hand the consumption since the last sync to the other replicas before exiting
+            await self.sync()
+
+    async def sync(self) -> None:
+        """Sincroniza todos los modelos en un mismo lote del backend"""
+        await asyncio.gather(*(limiter.sync(self.shared, f"rate:{model}") for model, limiter in list(self.limiters.items())))
+        self.syncs += 1
+
+    async def _sync_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            await self.sync()
+
+    def limiter(self, model: str) -> ModelLimiter:
+        if model not in self.limiters:
+            self.limiters[model] = ModelLimiter(self.rpm, self.tpm, self.max_concurrency, self.min_concurrency)
+        return self.limiters[model]
+
+    def capacity(self, model: str) -> int:
+        """Peticiones simultáneas que admite ahora el modelo (límite adaptativo actual)"""
+        limiter = self.limiter(model)
+        return max(int(limiter.concurrency_limit), limiter.min_concurrency)
+
+    def permit(self, payload: Dict) -> Permit:
+        """Retorna el permiso (context manager) para enviar `payload` upstream"""
+        return Permit(self, payload.get("model", ""), estimate_tokens(payload))
+
+    def paused_for(self, model: str) -> float:
+        """Segundos que le quedan a la pausa del modelo tras un 429/529 (0 si no está pausado)"""
+        limiter = self.limiters.get(model)
+        return max(0.0, limiter.paused_until - time.monotonic()) if limiter is not None else 0.0
+
+    async def wait_for_capacity(self, limiter: ModelLimiter, model: str, estimate: int) -> None:
+        """
+        Espera hasta que el modelo tenga capacidad y reserva un slot.
+
+        Raises:
+            RateLimitExceeded: si la espera superaría CLAUDE_RATE_MAX_WAIT segundos o el plazo de la llamada
+        """
+        start = time.monotonic()
+        deadline = start + self.max_wait
+        call_deadline = deadlines.current()
+        if call_deadline is not None:
+            # Fail now rather than queue past the caller's own timeout_s
+            deadline = min(deadline, call_deadline)
+
+        limiter.queued += 1
+        try:
+            while True:
+                now = time.monotonic()
+                wait = limiter.wait_time(estimate, now)
+                if wait == 0 and limiter.has_slot():
+                    break
+                if now + wait > deadline:
+                    limiter.rejected += 1
+                    raise RateLimitExceeded(
+                        f"límite de uso alcanzado para {model}: "
+                        f"la espera estimada supera {deadline - start:.3g}s, reintenta más tarde"
+                    )
+                changed = limiter.changed
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=wait or (deadline - now))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            limiter.queued -= 1
+
+        waited = time.monotonic() - start
+        limiter.admitted += 1
+        limiter.wait_time_total += waited
+        limiter.wait_time_max = max(limiter.wait_time_max, waited)
+        limiter.in_flight += 1
+        limiter.requests.consume(1)
+        limiter.tokens.consume(estimate)
+
+    def stats(self) -> Dict:
+        return {model: limiter.stats() for model, limiter in self.limiters.items()}
+
+def governor_from_env() -> RateGovernor:
+    """Crea el gobernador a partir de las variables de entorno"""
+    return RateGovernor(
+        rpm=float(os.environ.get("CLAUDE_RATE_RPM", 0)),
+        tpm=float(os.environ.get("CLAUDE_RATE_TPM", 0)),
+        max_concurrency=int(os.environ.get("CLAUDE_RATE_MAX_CONCURRENCY", 16)),
+        min_concurrency=int(os.environ.get("CLAUDE_RATE_MIN_CONCURRENCY", 1)),
+        max_wait=float(os.environ.get("CLAUDE_RATE_MAX_WAIT", 30)),
+    )
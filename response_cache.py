@@ -0,0 +1,257 @@
+"""
+Caché de respuestas de Claude
+LRU en memoria con límite de tamaño y TTL, más un almacén opcional en SQLite
+que sobrevive a reinicios (por ejemplo redeploys en Railway) y, con varias
+réplicas, el backend de estado compartido
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional
+
+import state_backend
+
+# Key prefix of the responses kept in the shared state backend
+SHARED_PREFIX = "cache:"
+
+def make_key(payload: Dict) -> str:
+    """Genera una clave SHA-256 a partir del contenido canónico de la petición"""
+    request = {k: v for k, v in payload.items() if k != "stream"}
+    # Texts sent by reference (blobs.BlobRef) are keyed by their URI, which is the content's sha256
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=lambda value: value.ref)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class DiskStore:
+    """
+    Almacén persistente en SQLite para las entradas de la caché.
+
+    Los métodos son bloqueantes: la caché los ejecuta con `submit` en un hilo
+    propio, en orden. Las entradas expiradas y las que pasan de `max_entries`
+    se borran cada `prune_interval` segundos, no en cada escritura, así que el
+    disco puede pasar de `max_entries` durante un intervalo.
+    """
+
+    def __init__(self, path: str, max_entries: int, prune_interval: float = 60):
+        self.path = path
+        self.max_entries = max_entries
+        self.prune_interval = prune_interval
+        self.pruned_at = 0.0
+        self.evictions = 0
+        self.write_errors = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        # A single worker keeps writes in order and the connection on one thread at a time
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache")
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Conexión SQLite, abierta la primera vez que se usa"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, created_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_expires_at ON responses (expires_at)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str, now: float) -> Optional[tuple]:
+        """Retorna (valor, expires_at) o None si no existe o expiró"""
+        row = self.conn.execute(
+            "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[1] <= now:
+            self.delete(key)
+            return None
+        return json.loads(row[0]), row[1]
+
+    def submit(self, fn, *args) -> Future:
+        """Ejecuta `fn(*args)` en el hilo del almacén, después de las operaciones ya encoladas"""
+        return self._executor.submit(fn, *args)
+
+    def set(self, key: str, value: Dict, expires_at: float, now: float) -> None:
+        """Guarda una entrada y poda el almacén si pasó prune_interval desde la última vez"""
+        try:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at, created_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at, now),
+            )
+            self.conn.commit()
+            if now - self.pruned_at >= self.prune_interval:
+                self.prune(now)
+        except sqlite3.Error as e:
+            self.write_errors += 1
+            print(f"⚠️  No se pudo escribir la caché en {self.path}: {e}", file=sys.stderr)
+
+    def prune(self, now: float) -> None:
+        """Borra las entradas expiradas y las más antiguas por encima de max_entries"""
+        self.pruned_at = now
+        removed = self.conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,)).rowcount
+        removed += self.conn.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        ).rowcount
+        self.conn.commit()
+        self.evictions += removed
+
+    def delete(self, key: str) -> None:
+        self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+        self.conn.commit()
+
+    def count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+class ResponseCache:
+    """
+    Caché LRU con TTL para respuestas de la API de mensajes.
+
+    Las entradas se buscan primero en memoria y después en disco (si está
+    configurado). Un acierto en disco se promueve a memoria. Con un backend de
+    estado compartido (`shared`), `fetch` busca además las respuestas que
+    guardaron otras réplicas. El disco se lee y se escribe siempre en el hilo
+    del DiskStore; `get` y `stats` esperan a ese hilo y son para scripts, el
+    servidor usa `fetch` y `stats_async`.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        ttl: float = 3600,
+        disk_path: str = "",
+        disk_max_entries: int = 100000,
+        disk_prune_interval: float = 60,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.disk = DiskStore(disk_path, disk_max_entries, disk_prune_interval) if disk_path else None
+        self.shared: Optional[state_backend.StateBackend] = None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Busca una respuesta en la caché; retorna None si no existe o expiró"""
+        value = self._lookup(key)
+        if value is None and self.disk is not None:
+            value = self._disk_hit(key, self.disk.submit(self.disk.get, key, time.time()).result())
+        if value is None:
+            self.misses += 1
+        return value
+
+    async def fetch(self, key: str) -> Optional[Dict]:
+        """Como get, sin bloquear el bucle de eventos, y si la respuesta no está en este proceso la busca en el estado compartido"""
+        value = self._lookup(key)
+        if value is None and self.disk is not None:
+            stored = await asyncio.wrap_future(self.disk.submit(self.disk.get, key, time.time()))
+            value = self._disk_hit(key, stored)
+        if value is None and self.shared is not None:
+            value = state_backend.unpack(await self.shared.get(SHARED_PREFIX + key))
+            if value is not None:
+                self._remember(key, value, time.time() + self.ttl)
+                self.hits += 1
+                self.shared_hits += 1
+        if value is None:
+            self.misses += 1
+        return value
+
+    def _lookup(self, key: str) -> Optional[Dict]:
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.entries[key]
+            self.expirations += 1
+        return None
+
+    def _disk_hit(self, key: str, stored: Optional[tuple]) -> Optional[Dict]:
+        """Promueve a memoria una entrada leída del disco"""
+        if stored is None:
+            return None
+        self._remember(key, *stored)
+        self.hits += 1
+        self.disk_hits += 1
+        return stored[0]
+
+    def set(self, key: str, value: Dict) -> None:
+        """Guarda una respuesta en memoria y, si están configurados, en disco y en el estado compartido"""
+        now = time.time()
+        expires_at = now + self.ttl
+        self._remember(key, value, expires_at)
+        if self.disk is not None:
+            # Written in the store's thread without waiting; the entry is already served from memory meanwhile
+            self.disk.submit(self.disk.set, key, value, expires_at, now)
+        if self.shared is not None:
+            self.shared.set(SHARED_PREFIX + key, state_backend.pack(value), self.ttl)
+
+    def _remember(self, key: str, value: Dict, expires_at: float) -> None:
+        self.entries[key] = (value, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict:
+        """Contadores de la caché"""
+        return self._stats(self.disk.submit(self.disk.count).result() if self.disk is not None else 0)
+
+    async def stats_async(self) -> Dict:
+        """Como stats, sin bloquear el bucle de eventos"""
+        disk_entries = await asyncio.wrap_future(self.disk.submit(self.disk.count)) if self.disk is not None else 0
+        return self._stats(disk_entries)
+
+    def _stats(self, disk_entries: int) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "disk": self.disk.path if self.disk is not None else None,
+            "disk_entries": disk_entries,
+            "disk_write_errors": self.disk.write_errors if self.disk is not None else 0,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions + (self.disk.evictions if self.disk is not None else 0),
+            "expirations": self.expirations,
+        }
+
+def cache_from_env() -> Optional[ResponseCache]:
+    """
+    Crea la caché a partir de las variables de entorno.
+
+    Retorna None si CLAUDE_CACHE_ENABLED es "false".
+    """
+    if os.environ.get("CLAUDE_CACHE_ENABLED", "true").lower() in ("0", "false", "no"):
+        return None
+
+    return ResponseCache(
+        max_entries=int(os.environ.get("CLAUDE_CACHE_MAX_ENTRIES", 1000)),
+        ttl=float(os.environ.get("CLAUDE_CACHE_TTL", 3600)),
+        disk_path=os.environ.get("CLAUDE_CACHE_DB", ""),
+        disk_max_entries=int(os.environ.get("CLAUDE_CACHE_DISK_MAX_ENTRIES", 100000)),
+        disk_prune_interval=float(os.environ.get("CLAUDE_CACHE_DISK_PRUNE_INTERVAL", 60)),
+    )
@@ -0,0 +1,199 @@
+"""
+Reintentos para las llamadas a la API de Anthropic
+Clasifica los errores en reintentables o no, respeta Retry-After, aplica backoff
+exponencial con jitter dentro de un plazo total y, opcionalmente, lanza
+peticiones duplicadas (hedging) cuando la primera supera el p95 de latencia
+"""
+
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+
+import httpx
+
+import deadlines
+from rate_limiter import retry_after_seconds
+
+# HTTP status codes worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+def is_retryable(exc: BaseException) -> bool:
+    """Indica si un error es transitorio y la petición puede repetirse"""
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS or status >= 500
+    return isinstance(exc, (httpx.TimeoutException, httpx.TransportError))
+
+class LatencyTracker:
+    """Ventana deslizante de latencias de peticiones exitosas por modelo"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self.samples: Dict[str, deque] = {}
+
+    def record(self, model: str, seconds: float) -> None:
+        self.samples.setdefault(model, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, model: str, q: float) -> Optional[float]:
+        """Percentil `q` (0-1) de la latencia del modelo, o None si hay pocas muestras"""
+        samples = self.samples.get(model)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class RetryPolicy:
+    """
+    Ejecuta una petición con reintentos y hedging opcional.
+
+    Args:
+        max_attempts: Intentos totales, incluido el primero
+        base_delay: Retardo base del backoff exponencial en segundos
+        max_delay: Retardo máximo entre intentos en segundos
+        deadline: Plazo total en segundos para todos los intentos
+        hedge_enabled: Si se lanzan peticiones duplicadas para prompts cortos
+        hedge_max_prompt_chars: Tamaño máximo del prompt para hacer hedging
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 20,
+        deadline: float = 120,
+        hedge_enabled: bool = False,
+        hedge_max_prompt_chars: int = 2000,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.hedge_enabled = hedge_enabled
+        self.hedge_max_prompt_chars = hedge_max_prompt_chars
+        self.latencies = LatencyTracker()
+
+        self.retries = 0
+        self.gave_up = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def backoff(self, attempt: int, exc: BaseException) -> float:
+        """Retardo antes del siguiente intento: Retry-After si existe, si no backoff con jitter completo"""
+        retry_after = retry_after_seconds(getattr(exc, "headers", {}))
+        if retry_after is not None:
+            return min(retry_after, self.max_delay) + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def should_hedge(self, model: str, prompt_chars: int) -> Optional[float]:
+        """Retorna tras cuántos segundos lanzar la petición duplicada, o None si no aplica"""
+        if not self.hedge_enabled or prompt_chars > self.hedge_max_prompt_chars:
+            return None
+        return self.latencies.percentile(model, 0.95)
+
+    async def run(
+        self,
+        fn: Callable[[], Awaitable],
+        model: str,
+        prompt_chars: int = 0,
+        can_retry: Callable[[], bool] = lambda: True,
+        hedge: bool = True,
+        give_up: Optional[Callable[[BaseException], bool]] = None,
+    ):
+        """
+        Ejecuta `fn` reintentando los errores transitorios.
+
+        Args:
+            fn: Función asíncrona que hace un intento completo
+            model: Modelo de la petición (para las estadísticas de latencia)
+            prompt_chars: Tamaño del prompt, para decidir si se hace hedging
+            can_retry: Retorna False si ya no es seguro repetir (p. ej. streaming ya enviado)
+            hedge: Permite hedging para esta petición
+            give_up: Retorna True para los errores que no se reintentan aquí porque
+                     quien llama tiene otra salida (p. ej. pasar a un modelo de respaldo)
+
+        Returns:
+            El resultado del primer intento exitoso
+        """
+        deadline = time.monotonic() + self.deadline
+        call_deadline = deadlines.current()
+        if call_deadline is not None:
+            # No backoff that would outlive the caller's own timeout_s
+            deadline = min(deadline, call_deadline)
+        hedge_after = self.should_hedge(model, prompt_chars) if hedge else None
+        attempt = 0
+
+        while True:
+            start = time.monotonic()
+            try:
+                if hedge_after is not None:
+                    result = await self._hedged(fn, hedge_after)
+                else:
+                    result = await fn()
+                self.latencies.record(model, time.monotonic() - start)
+                return result
+            except Exception as exc:
+                attempt += 1
+                if give_up is not None and give_up(exc):
+                    raise
+                if not is_retryable(exc) or attempt >= self.max_attempts or not can_retry():
+                    if attempt > 1:
+                        self.gave_up += 1
+                    raise
+                delay = self.backoff(attempt, exc)
+                if time.monotonic() + delay >= deadline:
+                    self.gave_up += 1
+                    raise
+                self.retries += 1
+                await asyncio.sleep(delay)
+
+    async def _hedged(self, fn: Callable[[], Awaitable], hedge_after: float):
+        """Lanza un duplicado si el primer intento tarda más de `hedge_after` y retorna el primero que responda bien"""
+        tasks = [asyncio.ensure_future(fn())]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                self.hedges += 1
+                tasks.append(asyncio.ensure_future(fn()))
+
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # Never leave a losing attempt running in the background
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> Dict:
+        return {
+            "max_attempts": self.max_attempts,
+            "deadline": self.deadline,
+            "retries": self.retries,
+            "gave_up": self.gave_up,
+            "hedge_enabled": self.hedge_enabled,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
+
+def policy_from_env() -> RetryPolicy:
+    """Crea la política de reintentos a partir de las variables de entorno"""
+    return RetryPolicy(
+        max_attempts=int(os.environ.get("CLAUDE_RETRY_MAX_ATTEMPTS", 3)),
+        base_delay=float(os.environ.get("CLAUDE_RETRY_BASE_DELAY", 0.5)),
+        max_delay=float(os.environ.get("CLAUDE_RETRY_MAX_DELAY", 20)),
+        deadline=float(os.environ.get("CLAUDE_RETRY_DEADLINE", 120)),
+        hedge_enabled=os.environ.get("CLAUDE_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes"),
+        hedge_max_prompt_chars=int(os.environ.get("CLAUDE_HEDGE_MAX_PROMPT_CHARS", 2000)),
+    )
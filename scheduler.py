@@ -0,0 +1,288 @@
+"""
+Planificador de llamadas a Anthropic con prioridades y reparto justo
+Antes de pasar por el gobernador de uso, cada intento espera turno en la cola
+de su modelo. Hay dos clases: las llamadas `interactive` pasan siempre antes
+que las `bulk` en cola, y las `bulk` no pueden ocupar más que una parte de los
+slots del modelo, así que siempre queda sitio para una llamada interactiva.
+Dentro de cada clase las llamadas se reparten entre clientes (o sesiones) con
+weighted fair queuing: cada cliente avanza en proporción a su peso y al coste
+estimado (en tokens) de sus llamadas, y un agente que encola cientos de
+llamadas no retrasa a los demás más que su parte. Además cada cliente puede
+tener un máximo de llamadas en vuelo.
+Los slots de cada modelo siguen el límite de concurrencia adaptativo del
+gobernador, de modo que las llamadas esperan aquí, en orden, y no en la cola
+del gobernador.
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import time
+from typing import Callable, Dict, List, Optional
+
+import metrics
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+# In precedence order: a queued call of an earlier class is always dispatched first
+PRIORITIES = (INTERACTIVE, BULK)
+
+# Finish tags of idle flows are pruned once the table grows past this
+MAX_FLOWS = 1024
+
+def check_priority(priority: str) -> str:
+    """
+    Valida una clase de prioridad ("" es interactive).
+
+    Raises:
+        ValueError: si no es una de PRIORITIES
+    """
+    priority = (priority or INTERACTIVE).lower()
+    if priority not in PRIORITIES:
+        raise ValueError(f"prioridad desconocida: '{priority}' (usa {' o '.join(PRIORITIES)})")
+    return priority
+
+class _Waiter:
+    __slots__ = ("model", "priority", "client", "flow", "start", "finish", "queued_at", "future")
+
+    def __init__(self, model: str, priority: str, client: str, flow: str, start: float, finish: float, future: asyncio.Future):
+        self.model = model
+        self.priority = priority
+        self.client = client
+        self.flow = flow
+        self.start = start
+        self.finish = finish
+        self.queued_at = time.monotonic()
+        self.future = future
+
+class ClassQueue:
+    """Cola de una clase en un modelo, ordenada por etiqueta de fin virtual (WFQ)"""
+
+    def __init__(self):
+        self.heap: List = []
+        self.virtual_time = 0.0
+        self.finish: Dict[str, float] = {}
+        self.queued = 0
+
+    def tag(self, flow: str, cost: float):
+        """Etiquetas virtuales (inicio, fin) de una llamada nueva del flujo"""
+        start = max(self.virtual_time, self.finish.get(flow, 0.0))
+        finish = start + cost
+        self.finish[flow] = finish
+        if len(self.finish) > MAX_FLOWS:
+            # A flow whose last finish tag is behind the virtual clock starts from the clock anyway
+            self.finish = {key: value for key, value in self.finish.items() if value > self.virtual_time}
+        return start, finish
+
+class Slot:
+    """
+    Turno para enviar un intento upstream.
+
+    Se usa como context manager asíncrono: al entrar espera en la cola de su
+    modelo y clase; al salir libera el slot y despacha a los siguientes.
+    """
+
+    def __init__(self, scheduler: "Scheduler", model: str, priority: str, client: str, flow: str, cost: float):
+        self.scheduler = scheduler
+        self.model = model
+        self.priority = priority
+        self.client = client
+        self.flow = flow
+        self.cost = cost
+        self.waited = 0.0
+
+    async def __aenter__(self) -> "Slot":
+        self.waited = await self.scheduler.acquire(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.scheduler.release(self.model, self.priority, self.client)
+
+class Scheduler:
+    """
+    Colas por modelo y clase de prioridad delante del gobernador de uso.
+
+    Args:
+        capacity: Slots de un modelo (por defecto, el límite de concurrencia actual del gobernador)
+        max_concurrency: Si es mayor que 0, fija los slots de cada modelo en vez de seguir al gobernador
+        bulk_share: Fracción máxima de los slots de un modelo que pueden ocupar las llamadas bulk
+        client_concurrency: Llamadas en vuelo máximas por cliente (0 = sin límite)
+        fair_by: Flujo del reparto justo: "client" o "session" (las llamadas sin sesión cuentan por su cliente)
+        clients: Ajustes por cliente: {"cliente": {"priority": "bulk", "weight": 2, "max_concurrency": 4}}
+    """
+
+    def __init__(
+        self,
+        capacity: Callable[[str], int],
+        max_concurrency: int = 0,
+        bulk_share: float = 0.75,
+        client_concurrency: int = 0,
+        fair_by: str = "client",
+        clients: Optional[Dict[str, Dict]] = None,
+    ):
+        self.capacity = capacity if max_concurrency <= 0 else (lambda model: max_concurrency)
+        self.bulk_share = bulk_share
+        self.client_concurrency = client_concurrency
+        self.fair_by = fair_by
+        self.clients = clients or {}
+        self.queues: Dict[str, Dict[str, ClassQueue]] = {}
+        self.in_flight: Dict[str, int] = {}
+        self.client_in_flight: Dict[str, int] = {}
+        self.class_in_flight = {priority: 0 for priority in PRIORITIES}
+        self._seq = itertools.count()
+
+        self.admitted = {priority: 0 for priority in PRIORITIES}
+        self.demoted = 0
+        self.capped = 0
+        self.wait_time_total = {priority: 0.0 for priority in PRIORITIES}
+        self.wait_time_max = {priority: 0.0 for priority in PRIORITIES}
+
+    def policy(self, client: str) -> Dict:
+        """Clase máxima, peso y límite de concurrencia de un cliente"""
+        override = self.clients.get(client, {})
+        return {
+            "priority": check_priority(override.get("priority", INTERACTIVE)),
+            "weight": max(float(override.get("weight", 1)), 0.001),
+            "max_concurrency": int(override.get("max_concurrency", self.client_concurrency)),
+        }
+
+    def slot(self, model: str, priority: str, client: str, session: str = "", cost: float = 1) -> Slot:
+        """
+        Retorna el turno (context manager) para un intento de `client` contra `model`.
+
+        Un cliente no puede pedir una clase mejor que la de su política: se
+        baja a la suya. `cost` es el coste estimado de la llamada en tokens.
+        """
+        policy = self.policy(client)
+        priority = check_priority(priority)
+        if PRIORITIES.index(priority) < PRIORITIES.index(policy["priority"]):
+            self.demoted += 1
+            priority = policy["priority"]
+        flow = (session or client) if self.fair_by == "session" else client
+        return Slot(self, model, priority, client, flow, max(cost, 1) / policy["weight"])
+
+    def limit(self, model: str, priority: str) -> int:
+        """Slots del modelo que puede ocupar una clase"""
+        capacity = max(int(self.capacity(model)), 1)
+        if priority == INTERACTIVE:
+            return capacity
+        return max(int(capacity * self.bulk_share), 1)
+
+    async def acquire(self, slot: Slot) -> float:
+        """Espera turno y reserva el slot; retorna los segundos de espera"""
+        queue = self.queues.setdefault(slot.model, {priority: ClassQueue() for priority in PRIORITIES})[slot.priority]
+        start, finish = queue.tag(slot.flow, slot.cost)
+        waiter = _Waiter(slot.model, slot.priority, slot.client, slot.flow, start, finish, asyncio.get_running_loop().create_future())
+        heapq.heappush(queue.heap, (finish, next(self._seq), waiter))
+        queue.queued += 1
+        metrics.scheduler_queue_depth.inc(priority=slot.priority)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Granted and cancelled in the same loop iteration: hand the slot back
+                self.release(slot.model, slot.priority, slot.client)
+            else:
+                # Left in the heap and skipped when it reaches the top
+                waiter.future.cancel()
+                queue.queued -= 1
+                metrics.scheduler_queue_depth.dec(priority=slot.priority)
+            raise
+        return time.monotonic() - waiter.queued_at
+
+    def release(self, model: str, priority: str, client: str) -> None:
+        self.in_flight[model] -= 1
+        self.class_in_flight[priority] -= 1
+        self.client_in_flight[client] -= 1
+        if not self.client_in_flight[client]:
+            del self.client_in_flight[client]
+        metrics.scheduler_in_flight.dec(priority=priority)
+        self._dispatch()
+
+    def _client_full(self, client: str) -> bool:
+        cap = self.policy(client)["max_concurrency"]
+        return cap > 0 and self.client_in_flight.get(client, 0) >= cap
+
+    def _dispatch(self) -> None:
+        """Concede los slots libres: por modelo, clase a clase y en orden de etiqueta dentro de cada clase"""
+        for model, classes in self.queues.items():
+            for priority in PRIORITIES:
+                queue = classes[priority]
+                if not queue.queued:
+                    # Only cancelled waiters are left
+                    queue.heap.clear()
+                    continue
+                limit = self.limit(model, priority)
+                skipped = []
+                while queue.heap and self.in_flight.get(model, 0) < limit:
+                    entry = heapq.heappop(queue.heap)
+                    waiter = entry[-1]
+                    if waiter.future.done():
+                        continue
+                    if self._client_full(waiter.client):
+                        # Work-conserving: other clients (and lower classes) may use the slot meanwhile
+                        self.capped += 1
+                        skipped.append(entry)
+                        continue
+                    self._grant(queue, waiter)
+                for entry in skipped:
+                    heapq.heappush(queue.heap, entry)
+
+    def _grant(self, queue: ClassQueue, waiter: _Waiter) -> None:
+        queue.queued -= 1
+        queue.virtual_time = max(queue.virtual_time, waiter.start)
+        self.in_flight[waiter.model] = self.in_flight.get(waiter.model, 0) + 1
+        self.class_in_flight[waiter.priority] += 1
+        self.client_in_flight[waiter.client] = self.client_in_flight.get(waiter.client, 0) + 1
+        waited = time.monotonic() - waiter.queued_at
+        self.admitted[waiter.priority] += 1
+        self.wait_time_total[waiter.priority] += waited
+        self.wait_time_max[waiter.priority] = max(self.wait_time_max[waiter.priority], waited)
+        metrics.scheduler_queue_depth.dec(priority=waiter.priority)
+        metrics.scheduler_in_flight.inc(priority=waiter.priority)
+        metrics.scheduler_wait.observe(waited, priority=waiter.priority)
+        waiter.future.set_result(None)
+
+    def stats(self) -> Dict:
+        queued: Dict[str, int] = {}
+        for classes in self.queues.values():
+            for queue in classes.values():
+                for _, _, waiter in queue.heap:
+                    if not waiter.future.done():
+                        queued[waiter.client] = queued.get(waiter.client, 0) + 1
+        clients = set(queued) | set(self.client_in_flight)
+        return {
+            "fair_by": self.fair_by,
+            "bulk_share": self.bulk_share,
+            "client_concurrency": self.client_concurrency,
+            "classes": {
+                priority: {
+                    "queued": sum(classes[priority].queued for classes in self.queues.values()),
+                    "in_flight": self.class_in_flight[priority],
+                    "admitted": self.admitted[priority],
+                    "wait_time_avg_ms": 1000 * self.wait_time_total[priority] / self.admitted[priority] if self.admitted[priority] else 0.0,
+                    "wait_time_max_ms": 1000 * self.wait_time_max[priority],
+                }
+                for priority in PRIORITIES
+            },
+            "clients": {
+                client: {"in_flight": self.client_in_flight.get(client, 0), "queued": queued.get(client, 0)}
+                for client in sorted(clients, key=lambda client: -(queued.get(client, 0) + self.client_in_flight.get(client, 0)))
+            },
+            "demoted": self.demoted,
+            "capped": self.capped,
+        }
+
+def scheduler_from_env(capacity: Callable[[str], int]) -> Scheduler:
+    """Crea el planificador a partir de las variables de entorno; `capacity` da los slots de cada modelo"""
+    return Scheduler(
+        capacity,
+        max_concurrency=int(os.environ.get("CLAUDE_SCHED_MAX_CONCURRENCY", 0)),
+        bulk_share=float(os.environ.get("CLAUDE_SCHED_BULK_SHARE", 0.75)),
+        client_concurrency=int(os.environ.get("CLAUDE_SCHED_CLIENT_CONCURRENCY", 0)),
+        fair_by=os.environ.get("CLAUDE_SCHED_FAIR_BY", "client").lower(),
+        clients=json.loads(os.environ.get("CLAUDE_SCHED_CLIENTS", "{}")),
+    )
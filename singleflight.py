@@ -0,0 +1,98 @@
+"""
+Coalescencia de peticiones en vuelo (single-flight)
+Las llamadas concurrentes con la misma clave esperan a una única petición
+upstream y comparten su resultado o su error
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Dict
+
+class _Flight:
+    """Una petición upstream en curso y los clientes que esperan su resultado"""
+
+    def __init__(self):
+        self.task = None
+        self.cancelled = False
+        self.waiters = 0
+        self.listeners = []
+        # Chunks streamed so far, replayed to late joiners (joined only then, never concatenated per chunk)
+        self.chunks = []
+
+    async def publish(self, text: str) -> None:
+        """Reenvía un fragmento de texto a todos los que esperan en streaming"""
+        self.chunks.append(text)
+        for listener in list(self.listeners):
+            try:
+                await listener(text)
+            except Exception:
+                # A client that can no longer be notified must not break the shared call
+                self.listeners.remove(listener)
+
+class SingleFlight:
+    """
+    Agrupa llamadas concurrentes idénticas en una sola.
+
+    Si todos los que esperan una petición se cancelan, la petición upstream
+    también se cancela para no pagar tokens que nadie va a leer.
+    """
+
+    def __init__(self):
+        self.flights: Dict[str, _Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[Callable], Awaitable], on_text=None):
+        """
+        Ejecuta `fn(publish)` una sola vez por clave mientras esté en vuelo.
+
+        Args:
+            key: Clave que identifica peticiones equivalentes
+            fn: Función asíncrona que hace la petición; recibe un callback
+                `publish(text)` para reenviar texto parcial a los que esperan
+            on_text: Callback opcional para recibir el texto parcial de la petición
+
+        Returns:
+            El resultado de la petición compartida
+        """
+        flight = self.flights.get(key)
+        if flight is None or flight.cancelled:
+            flight = _Flight()
+            flight.task = asyncio.ensure_future(fn(flight.publish))
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self.flights[key] = flight
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+            if on_text is not None:
+                # Chunks published while the replay is sent are replayed too, so none is lost or reordered
+                sent = 0
+                while sent < len(flight.chunks):
+                    pending, sent = flight.chunks[sent:], len(flight.chunks)
+                    await on_text("".join(pending))
+
+        if on_text is not None:
+            flight.listeners.append(on_text)
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                flight.cancelled = True
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+            if on_text in flight.listeners:
+                flight.listeners.remove(on_text)
+
+    def _forget(self, key: str, flight: _Flight) -> None:
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def stats(self) -> Dict:
+        """Contadores de coalescencia"""
+        return {
+            "in_flight": len(self.flights),
+            "upstream_calls": self.leaders,
+            "coalesced": self.coalesced,
+        }
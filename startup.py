@@ -0,0 +1,188 @@
+"""
+Arranque rápido del servidor MCP
+Abre el puerto nada más arrancar el proceso y responde a GET /health mientras
+app.py (el SDK de MCP, pydantic y los esquemas de las herramientas) se importa
+en segundo plano. Las peticiones que llegan antes de que la app esté lista
+esperan a que lo esté en lugar de recibir "connection refused", así que un
+agente que se conecta durante un redeploy no tiene que reintentar.
+
+Uso (es el comando del Procfile):
+    python startup.py
+    uvicorn startup:create_app --factory
+"""
+
+import asyncio
+import importlib
+import json
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from typing import Callable, Optional
+
+# As close to process start as this module gets; reference for startup_s in /health
+STARTED_AT = time.monotonic()
+
+APP_MODULE = "app"
+HEALTH_PATH = "/health"
+
+class BootApp:
+    """
+    Aplicación ASGI que atiende mientras se carga la aplicación real.
+
+    - GET /health: 503 `starting` mientras carga, 200 `ready` cuando la app
+      arrancó su lifespan y 503 `failed` si la importación falló
+    - Resto de peticiones: esperan a que la app esté lista y se le pasan tal cual
+
+    La app se importa en un hilo, para que el event loop siga aceptando
+    conexiones, y su lifespan se ejecuta en una tarea propia que vive hasta que
+    el servidor se apaga.
+    """
+
+    def __init__(self, on_failure: Optional[Callable[[], None]] = None):
+        self.on_failure = on_failure
+        self.app = None
+        self.module = None
+        self.error: Optional[str] = None
+        self.startup_s: Optional[float] = None
+        self.settled = asyncio.Event()
+        self.loader: Optional[asyncio.Task] = None
+        self.lifespan_task: Optional[asyncio.Task] = None
+        self.lifespan_messages: asyncio.Queue = asyncio.Queue()
+        self.lifespan_started: Optional[asyncio.Future] = None
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            await self.lifespan(scope, receive, send)
+            return
+        if scope["type"] == "http" and scope["method"] == "GET" and scope["path"] == HEALTH_PATH:
+            await self.health(send)
+            return
+
+        await self.settled.wait()
+        if self.error is not None:
+            if scope["type"] == "http":
+                await self.respond(send, 503, {"status": "failed", "error": "el servidor no pudo arrancar"})
+            return
+        await self.app(scope, receive, send)
+
+    async def lifespan(self, scope, receive, send) -> None:
+        """Completa el arranque de uvicorn al momento y carga la app en segundo plano"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.loader = asyncio.ensure_future(self.load(scope.get("state", {})))
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.lifespan_task is not None and not self.lifespan_task.done():
+                    await self.lifespan_messages.put({"type": "lifespan.shutdown"})
+                    await asyncio.gather(self.lifespan_task, return_exceptions=True)
+                elif self.loader is not None:
+                    self.loader.cancel()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def load(self, state: dict) -> None:
+        """Importa la app, la crea y arranca su lifespan (cliente HTTP, catálogo, Streamable HTTP)"""
+        try:
+            self.module = await asyncio.to_thread(importlib.import_module, APP_MODULE)
+            self.app = self.module.create_app()
+
+            self.lifespan_started = asyncio.get_running_loop().create_future()
+            await self.lifespan_messages.put({"type": "lifespan.startup"})
+            self.lifespan_task = asyncio.ensure_future(self.app(
+                {"type": "lifespan", "asgi": {"version": "3.0", "spec_version": "2.0"}, "state": state},
+                self.lifespan_messages.get,
+                self.on_lifespan_message,
+            ))
+            await asyncio.wait({self.lifespan_started, self.lifespan_task}, return_when=asyncio.FIRST_COMPLETED)
+            if not self.lifespan_started.done():
+                self.lifespan_task.result()
+                raise RuntimeError("el lifespan de la app terminó sin completar el arranque")
+            self.lifespan_started.result()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.error = traceback.format_exc()
+            print(f"❌ Error arrancando la app:\n{self.error}", file=sys.stderr)
+            self.settled.set()
+            if self.on_failure is not None:
+                self.on_failure()
+            else:
+                # Under the uvicorn CLI (multiworker workers) there is no server handle; SIGTERM shuts it down
+                signal.raise_signal(signal.SIGTERM)
+            return
+
+        self.startup_s = time.monotonic() - STARTED_AT
+        print(f"✅ App lista en {self.startup_s:.2f}s (transporte {self.module.MCP_TRANSPORT})")
+        if not self.module.anthropic_api_key:
+            print("⚠️  ADVERTENCIA: ANTHROPIC_API_KEY no está configurada")
+        self.settled.set()
+
+    async def on_lifespan_message(self, message) -> None:
+        if message["type"] == "lifespan.startup.complete":
+            self.lifespan_started.set_result(None)
+        elif message["type"] == "lifespan.startup.failed":
+            self.lifespan_started.set_exception(RuntimeError(message.get("message", "")))
+
+    async def health(self, send) -> None:
+        if self.error is not None:
+            status = "failed"
+        elif self.settled.is_set():
+            status = "ready"
+        else:
+            status = "starting"
+        await self.respond(send, 200 if status == "ready" else 503, {
+            "status": status,
+            "uptime_s": round(time.monotonic() - STARTED_AT, 3),
+            "startup_s": round(self.startup_s, 3) if self.startup_s is not None else None,
+        })
+
+    async def respond(self, send, status: int, body: dict) -> None:
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": json.dumps(body).encode()})
+
+def create_app() -> BootApp:
+    """Fábrica ASGI: uvicorn startup:create_app --factory (la usan también los workers)"""
+    return BootApp()
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    """
+    Abre el puerto antes de importar nada más: desde este momento el kernel
+    acepta conexiones y las deja en la cola hasta que uvicorn las atiende
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    return sock
+
+def main() -> None:
+    port = int(os.environ.get("PORT", 8080))
+    host = "0.0.0.0"
+
+    # WEB_CONCURRENCY > 1: the router never needs the MCP stack, only the workers import it
+    workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+    if workers > 1:
+        import multiworker
+
+        print(f"🧩 Modo multi-proceso: {workers} workers")
+        multiworker.main(workers, host, port)
+        return
+
+    sock = bind_socket(host, port)
+    print(f"🚀 Iniciando Claude MCP Server en {host}:{port}")
+    import uvicorn
+
+    boot = BootApp()
+    server = uvicorn.Server(uvicorn.Config(boot, host=host, port=port, log_level="info"))
+    # If the app cannot start, exit so the platform restarts the process instead of serving 503s forever
+    boot.on_failure = lambda: setattr(server, "should_exit", True)
+    server.run(sockets=[sock])
+    if boot.error is not None:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,438 @@
+"""
+Estado compartido entre réplicas del servidor
+Con varias réplicas de app.py (o varios workers) la caché de respuestas, los
+límites de uso, los presupuestos y las conversaciones de cada proceso solo ven
+su parte del tráfico. Un backend de estado las comparte:
+
+- memory (default): nada compartido, cada proceso con su estado como hasta ahora
+- sqlite:///ruta.db: un fichero SQLite en modo WAL, para varios workers en un mismo host
+- redis://[:password@]host:port/db: cualquier servidor que hable el protocolo de Redis
+
+Las operaciones se agrupan en lotes: todo lo que se pide en la misma vuelta del
+event loop, y lo que llega mientras un lote está en vuelo, sale en el siguiente
+como un único pipeline (una sola ida y vuelta a Redis, una sola transacción en
+SQLite). Las escrituras no se esperan y las lecturas del camino caliente usan
+copias locales que se sincronizan en segundo plano, así que el estado
+compartido no añade una ida y vuelta por llamada. Si el backend falla, las
+lecturas retornan None y cada proceso sigue con su estado local (durante unos
+segundos ni siquiera se intenta, para no esperar a un servidor caído).
+"""
+
+import abc
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+import metrics
+
+# Operations per pipeline; the rest waits for the next batch
+MAX_BATCH = 512
+# Seconds between warnings while the backend keeps failing
+WARN_INTERVAL = 60
+# After a failed batch the backend is skipped (local state only) for this long, so calls never wait on a dead server
+RETRY_AFTER = 2.0
+
+def pack(value) -> bytes:
+    """Serializa un valor JSON para guardarlo en el backend (comprimido: respuestas e historiales son texto)"""
+    return zlib.compress(json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 1)
+
+def unpack(data: Optional[bytes]):
+    """Inverso de pack; None si no hay valor o está corrupto"""
+    if data is None:
+        return None
+    try:
+        return json.loads(zlib.decompress(data))
+    except (zlib.error, ValueError):
+        return None
+
+class Op:
+    """Una operación pendiente: get, set, delete o incr, con su futuro si alguien espera el resultado"""
+
+    __slots__ = ("kind", "key", "value", "ttl", "future")
+
+    def __init__(self, kind: str, key: str, value=None, ttl: float = 0, future: Optional[asyncio.Future] = None):
+        self.kind = kind
+        self.key = key
+        self.value = value
+        self.ttl = ttl
+        self.future = future
+
+class StateBackend(abc.ABC):
+    """
+    Almacén clave-valor compartido con operaciones agrupadas en lotes.
+
+    - `get(key)` y `incr(key, amount, ttl)` se esperan (retornan bytes / el total)
+    - `set`, `delete` y `add` (un incr sin esperar el total) no se esperan
+
+    Las subclases implementan `_execute(ops)`, que ejecuta un lote y retorna un
+    resultado por operación.
+    """
+
+    name = ""
+    # False for the in-process backend: there is nothing to share, callers keep their local state only
+    shared = True
+
+    def __init__(self, max_batch: int = MAX_BATCH):
+        self.max_batch = max_batch
+        self.pending: List[Op] = []
+        self._drainer: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.ops = 0
+        self.errors = 0
+        self.last_error: Optional[str] = None
+        self.last_warning = 0.0
+        self.retry_at = 0.0
+        self.skipped = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._submit(Op("get", key), wait=True)
+
+    async def incr(self, key: str, amount: float, ttl: float = 0) -> Optional[float]:
+        """Suma `amount` al contador y retorna el total de todas las réplicas (None si el backend falló)"""
+        return await self._submit(Op("incr", key, amount, ttl), wait=True)
+
+    def set(self, key: str, value: bytes, ttl: float = 0) -> None:
+        self._submit(Op("set", key, value, ttl))
+
+    def delete(self, key: str) -> None:
+        self._submit(Op("delete", key))
+
+    def add(self, key: str, amount: float, ttl: float = 0) -> None:
+        self._submit(Op("incr", key, amount, ttl))
+
+    def _submit(self, op: Op, wait: bool = False):
+        loop = asyncio.get_running_loop()
+        if wait:
+            op.future = loop.create_future()
+        self.pending.append(op)
+        if self._drainer is None or self._drainer.done():
+            self._drainer = loop.create_task(self._drain())
+        return op.future
+
+    async def _drain(self) -> None:
+        # Let everything queued in this loop iteration join the first batch
+        await asyncio.sleep(0)
+        while self.pending:
+            batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            start = time.monotonic()
+            if start < self.retry_at:
+                self.skipped += len(batch)
+                for op in batch:
+                    if op.future is not None and not op.future.done():
+                        op.future.set_result(None)
+                continue
+            try:
+                results = await self._execute(batch)
+            except Exception as e:
+                self._failed(e)
+                results = [None] * len(batch)
+            else:
+                metrics.state_batch_duration.observe(time.monotonic() - start, backend=self.name)
+            self.batches += 1
+            self.ops += len(batch)
+            metrics.state_ops.inc(len(batch), backend=self.name)
+            for op, result in zip(batch, results):
+                if op.future is not None and not op.future.done():
+                    op.future.set_result(result)
+
+    def _failed(self, error: Exception) -> None:
+        self.errors += 1
+        self.last_error = f"{type(error).__name__}: {error}"
+        metrics.state_errors.inc(backend=self.name)
+        now = time.monotonic()
+        self.retry_at = now + RETRY_AFTER
+        if now - self.last_warning >= WARN_INTERVAL:
+            self.last_warning = now
+            print(f"⚠️  Backend de estado {self.name} no disponible, se usa el estado local: {self.last_error}", file=sys.stderr)
+
+    async def flush(self) -> None:
+        """Espera a que se envíe todo lo pendiente"""
+        while self._drainer is not None and not self._drainer.done():
+            await asyncio.shield(self._drainer)
+
+    @abc.abstractmethod
+    async def _execute(self, ops: List[Op]) -> List:
+        """Ejecuta un lote y retorna un resultado por operación (bytes, total o None)"""
+
+    async def close(self) -> None:
+        await self.flush()
+
+    def stats(self) -> Dict:
+        return {
+            "backend": self.name,
+            "shared": self.shared,
+            "batches": self.batches,
+            "ops": self.ops,
+            "ops_per_batch": round(self.ops / self.batches, 2) if self.batches else 0.0,
+            "pending": len(self.pending),
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "last_error": self.last_error,
+        }
+
+class MemoryBackend(StateBackend):
+    """Backend en el propio proceso (default): no comparte nada, pero implementa la misma interfaz"""
+
+    name = "memory"
+    shared = False
+
+    def __init__(self, max_batch: int = MAX_BATCH):
+        super().__init__(max_batch)
+        self.data: Dict[str, Tuple[object, float]] = {}
+
+    def _live(self, key: str, now: float):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[1] and entry[1] <= now:
+            del self.data[key]
+            return None
+        return entry[0]
+
+    async def _execute(self, ops: List[Op]) -> List:
+        now = time.time()
+        results = []
+        for op in ops:
+            if op.kind == "get":
+                value = self._live(op.key, now)
+                results.append(repr(value).encode() if isinstance(value, float) else value)
+            elif op.kind == "set":
+                self.data[op.key] = (op.value, now + op.ttl if op.ttl else 0)
+                results.append(None)
+            elif op.kind == "delete":
+                self.data.pop(op.key, None)
+                results.append(None)
+            else:
+                total = float(self._live(op.key, now) or 0) + op.value
+                self.data[op.key] = (total, now + op.ttl if op.ttl else 0)
+                results.append(total)
+        return results
+
+class SQLiteBackend(StateBackend):
+    """
+    Estado en un fichero SQLite en modo WAL, compartido por los procesos de un host.
+
+    Cada lote es una transacción que se ejecuta en un hilo, sin bloquear el event loop.
+    """
+
+    name = "sqlite"
+    # Expired rows are deleted every this many batches
+    PURGE_EVERY = 1000
+
+    def __init__(self, path: str, max_batch: int = MAX_BATCH):
+        super().__init__(max_batch)
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Conexión SQLite, abierta la primera vez que se usa"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Shared state can be rebuilt; skipping the fsync per commit keeps batches well under a millisecond
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "key TEXT PRIMARY KEY, value BLOB, number REAL, expires_at REAL NOT NULL)"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    async def _execute(self, ops: List[Op]) -> List:
+        return await asyncio.to_thread(self._run, ops)
+
+    def _run(self, ops: List[Op]) -> List:
+        now = time.time()
+        results = []
+        conn = self.conn
+        with conn:
+            for op in ops:
+                expires_at = now + op.ttl if op.ttl else float("inf")
+                if op.kind == "get":
+                    row = conn.execute(
+                        "SELECT value, number FROM state WHERE key = ? AND expires_at > ?", (op.key, now)
+                    ).fetchone()
+                    if row is None:
+                        results.append(None)
+                    else:
+                        results.append(bytes(row[0]) if row[0] is not None else repr(row[1]).encode())
+                elif op.kind == "set":
+                    conn.execute(
+                        "INSERT OR REPLACE INTO state (key, value, number, expires_at) VALUES (?, ?, NULL, ?)",
+                        (op.key, op.value, expires_at),
+                    )
+                    results.append(None)
+                elif op.kind == "delete":
+                    conn.execute("DELETE FROM state WHERE key = ?", (op.key,))
+                    results.append(None)
+                else:
+                    row = conn.execute(
+                        "INSERT INTO state (key, value, number, expires_at) VALUES (?, NULL, ?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET "
+                        "number = CASE WHEN state.expires_at > ? THEN COALESCE(state.number, 0) + excluded.number ELSE excluded.number END, "
+                        "value = NULL, expires_at = excluded.expires_at RETURNING number",
+                        (op.key, op.value, expires_at, now),
+                    ).fetchone()
+                    results.append(row[0])
+            if self.batches % self.PURGE_EVERY == 0:
+                conn.execute("DELETE FROM state WHERE expires_at <= ?", (now,))
+        return results
+
+    async def close(self) -> None:
+        await self.flush()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+class RedisError(Exception):
+    """Respuesta de error (-ERR ...) del servidor Redis"""
+
+def encode_command(*args) -> bytes:
+    """Codifica un comando en el protocolo de Redis (RESP)"""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode("utf-8")
+        elif not isinstance(arg, bytes):
+            arg = repr(arg).encode() if isinstance(arg, float) else str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+async def read_reply(reader: asyncio.StreamReader):
+    """Lee una respuesta RESP; los errores se retornan como RedisError, no se lanzan"""
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("el servidor Redis cerró la conexión")
+    kind, body = line[:1], line[1:-2]
+    if kind == b"+":
+        return body
+    if kind == b"-":
+        return RedisError(body.decode("utf-8", "replace"))
+    if kind == b":":
+        return int(body)
+    if kind == b"$":
+        size = int(body)
+        if size < 0:
+            return None
+        data = await reader.readexactly(size + 2)
+        return data[:-2]
+    if kind == b"*":
+        size = int(body)
+        return None if size < 0 else [await read_reply(reader) for _ in range(size)]
+    raise ConnectionError(f"respuesta RESP inesperada: {line[:40]!r}")
+
+class RedisBackend(StateBackend):
+    """
+    Estado en un servidor con el protocolo de Redis (Redis, Valkey, KeyDB...).
+
+    Usa una sola conexión: cada lote se escribe de una vez y se leen todas las
+    respuestas seguidas (pipelining), sin dependencias externas.
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str, timeout: float = 1.0, max_batch: int = MAX_BATCH):
+        super().__init__(max_batch)
+        parsed = urlparse(url)
+        self.url = url
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def _connect(self) -> None:
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.username, self.password) if self.username else ("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            self.writer.write(b"".join(encode_command(*command) for command in setup))
+            for _ in setup:
+                reply = await read_reply(self.reader)
+                if isinstance(reply, RedisError):
+                    raise reply
+
+    def _disconnect(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def _execute(self, ops: List[Op]) -> List:
+        try:
+            return await asyncio.wait_for(self._pipeline(ops), self.timeout)
+        except BaseException:
+            # A half-read pipeline leaves the connection out of sync; start over on the next batch
+            self._disconnect()
+            raise
+
+    async def _pipeline(self, ops: List[Op]) -> List:
+        if self.writer is None:
+            await self._connect()
+        commands = []
+        for op in ops:
+            if op.kind == "get":
+                commands.append(encode_command("GET", op.key))
+            elif op.kind == "set":
+                if op.ttl:
+                    commands.append(encode_command("SET", op.key, op.value, "PX", max(1, int(op.ttl * 1000))))
+                else:
+                    commands.append(encode_command("SET", op.key, op.value))
+            elif op.kind == "delete":
+                commands.append(encode_command("DEL", op.key))
+            else:
+                commands.append(encode_command("INCRBYFLOAT", op.key, float(op.value)))
+                if op.ttl:
+                    commands.append(encode_command("PEXPIRE", op.key, max(1, int(op.ttl * 1000))))
+        self.writer.write(b"".join(commands))
+        await self.writer.drain()
+
+        results = []
+        for op in ops:
+            reply = await read_reply(self.reader)
+            if op.kind == "incr":
+                if op.ttl:
+                    await read_reply(self.reader)
+                reply = float(reply) if isinstance(reply, bytes) else None
+            elif isinstance(reply, RedisError) or not isinstance(reply, bytes):
+                reply = None
+            results.append(reply)
+        return results
+
+    async def close(self) -> None:
+        await self.flush()
+        self._disconnect()
+
+def backend_from_url(url: str) -> StateBackend:
+    """Crea el backend que indica la URL: memory, sqlite:///ruta.db o redis://[:password@]host:port/db"""
+    if not url or url == "memory":
+        return MemoryBackend()
+    if url.startswith("sqlite://"):
+        # Same convention as SQLAlchemy: sqlite:///relativa.db, sqlite:////ruta/absoluta.db
+        return SQLiteBackend(url[len("sqlite:///"):] if url.startswith("sqlite:///") else url[len("sqlite://"):])
+    if url.startswith(("redis://", "rediss://")):
+        if url.startswith("rediss://"):
+            raise ValueError("rediss:// (TLS) no está soportado; usa un túnel TLS local o redis://")
+        return RedisBackend(url, timeout=float(os.environ.get("CLAUDE_STATE_TIMEOUT", 1.0)))
+    raise ValueError(f"CLAUDE_STATE_BACKEND inválido: '{url}' (usa memory, sqlite:///ruta.db o redis://host:port/db)")
+
+def backend_from_env() -> StateBackend:
+    """Crea el backend de estado a partir de CLAUDE_STATE_BACKEND"""
+    return backend_from_url(os.environ.get("CLAUDE_STATE_BACKEND", "memory"))
+
+def sync_interval_from_env() -> float:
+    """Segundos entre sincronizaciones de los límites de uso y presupuestos con el backend"""
+    return float(os.environ.get("CLAUDE_STATE_SYNC_INTERVAL", 0.25))
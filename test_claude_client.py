@@ -0,0 +1,76 @@
+"""
+Pruebas del cliente asíncrono contra el mock de Anthropic: las llamadas
+concurrentes no se bloquean entre sí, las sucesivas reutilizan la conexión
+del pool compartido y cada event loop tiene su propio cliente
+"""
+
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import claude_client
+import mock_anthropic
+
+MODEL = "claude-3-5-haiku-20241022"
+
+def payload(prompt: str) -> dict:
+    return {"model": MODEL, "max_tokens": 16, "messages": [{"role": "user", "content": prompt}]}
+
+@pytest.fixture(scope="module")
+def mock_url():
+    port = mock_anthropic.find_free_port()
+    server = mock_anthropic.start_in_thread(port, latency=0.5)
+    yield f"http://127.0.0.1:{port}"
+    server.should_exit = True
+
+@pytest.fixture(autouse=True)
+def api_url(mock_url, monkeypatch):
+    monkeypatch.setenv("ANTHROPIC_API_URL", f"{mock_url}/v1/messages")
+
+def test_concurrent_calls_overlap(mock_url):
+    """20 llamadas simultáneas de 0.5s terminan en bastante menos que 20 × 0.5s"""
+    before = httpx.get(f"{mock_url}/stats").json()["requests"]
+
+    async def main():
+        try:
+            return await asyncio.gather(*(claude_client.create_message("test-key", payload(f"pregunta {i}")) for i in range(20)))
+        finally:
+            await claude_client.close_async_client()
+
+    start = time.monotonic()
+    results = asyncio.run(main())
+    assert time.monotonic() - start < 2
+    assert all(result["content"][0]["text"] for result in results)
+    assert httpx.get(f"{mock_url}/stats").json()["requests"] == before + 20
+
+def test_sequential_calls_reuse_connection(mock_url, monkeypatch):
+    """Las llamadas sucesivas del mismo loop van por el mismo cliente y reutilizan su conexión"""
+    monkeypatch.setattr(claude_client, "pool_metrics", claude_client.PoolMetrics())
+
+    async def main():
+        try:
+            client = claude_client.get_async_client()
+            for i in range(3):
+                await claude_client.create_message("test-key", payload(f"turno {i}"))
+            assert claude_client.get_async_client() is client
+            return client
+        finally:
+            await claude_client.close_async_client()
+
+    client = asyncio.run(main())
+    assert client.is_closed
+    stats = claude_client.pool_stats()
+    assert stats["new_connections"] == 1
+    assert stats["hits"] == 2
+
+def test_new_loop_gets_new_client():
+    """Un cliente creado en otro event loop (p. ej. otro asyncio.run) no se reutiliza"""
+    async def current():
+        return claude_client.get_async_client()
+
+    first = asyncio.run(current())
+    second = asyncio.run(current())
+    assert first is not second
+    asyncio.run(claude_client.close_async_client())
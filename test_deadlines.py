@@ -0,0 +1,113 @@
+"""
+Pruebas de deadlines.run contra el mock de Anthropic: los errores de la API
+salen tal cual (sin ExceptionGroup) y un plazo vencido o una desconexión
+abortan la petición upstream en curso
+"""
+
+import asyncio
+import os
+import time
+
+import anyio
+import httpx
+import pytest
+
+import claude_client
+import deadlines
+import mock_anthropic
+
+MODEL = "claude-3-5-haiku-20241022"
+
+@pytest.fixture(scope="module")
+def mock_url():
+    port = mock_anthropic.find_free_port()
+    server = mock_anthropic.start_in_thread(port, latency=5.0)
+    previous = os.environ.get("ANTHROPIC_API_URL")
+    os.environ["ANTHROPIC_API_URL"] = f"http://127.0.0.1:{port}/v1/messages"
+    yield f"http://127.0.0.1:{port}"
+    if previous is None:
+        del os.environ["ANTHROPIC_API_URL"]
+    else:
+        os.environ["ANTHROPIC_API_URL"] = previous
+    server.should_exit = True
+
+def payload(model: str = MODEL) -> dict:
+    return {"model": model, "max_tokens": 10, "messages": [{"role": "user", "content": "hola"}]}
+
+def aborted(mock_url: str) -> int:
+    return httpx.get(f"{mock_url}/stats").json()["aborted"]
+
+def wait_aborted(mock_url: str, expected: int) -> int:
+    """Espera (hasta 3s) a que el mock vea la petición abortada"""
+    limit = time.monotonic() + 3
+    while aborted(mock_url) < expected and time.monotonic() < limit:
+        time.sleep(0.05)
+    return aborted(mock_url)
+
+async def call(fn, **kwargs):
+    try:
+        return await deadlines.run(fn, **kwargs)
+    finally:
+        await claude_client.close_async_client()
+
+@pytest.mark.parametrize("watch_disconnect", [False, True])
+def test_api_error_is_not_wrapped(mock_url, watch_disconnect):
+    """Un error de la API dentro de run llega al llamador como AnthropicAPIError, no como ExceptionGroup"""
+    async def main():
+        disconnected = anyio.Event() if watch_disconnect else None
+        await call(lambda: claude_client.create_message("test-key", payload("claude-no-existe")), timeout=10, disconnected=disconnected)
+
+    with pytest.raises(claude_client.AnthropicAPIError) as info:
+        asyncio.run(main())
+    assert info.value.status_code == 404
+
+def test_result_is_returned(mock_url):
+    """Sin plazo ni desconexión, run retorna el resultado de la función"""
+    async def main():
+        return await call(lambda: asyncio.sleep(0, "ok"), timeout=1, disconnected=anyio.Event())
+
+    assert asyncio.run(main()) == "ok"
+
+def test_deadline_cancels_upstream_request(mock_url):
+    """Al vencer el plazo se lanza DeadlineExceeded y el mock ve la petición abortada"""
+    before = aborted(mock_url)
+
+    async def main():
+        await call(lambda: claude_client.create_message("test-key", payload()), timeout=0.3)
+
+    start = time.monotonic()
+    with pytest.raises(deadlines.DeadlineExceeded):
+        asyncio.run(main())
+    assert time.monotonic() - start < 2
+    assert wait_aborted(mock_url, before + 1) == before + 1
+
+def test_disconnect_cancels_upstream_request(mock_url):
+    """Si el cliente se desconecta se lanza ClientDisconnected y la petición upstream se aborta"""
+    before = aborted(mock_url)
+
+    async def main():
+        disconnected = anyio.Event()
+
+        async def go_away():
+            await asyncio.sleep(0.3)
+            disconnected.set()
+
+        task = asyncio.create_task(go_away())
+        try:
+            await call(lambda: claude_client.create_message("test-key", payload()), timeout=10, disconnected=disconnected)
+        finally:
+            await task
+
+    with pytest.raises(deadlines.ClientDisconnected):
+        asyncio.run(main())
+    assert wait_aborted(mock_url, before + 1) == before + 1
+
+def test_nested_deadline_keeps_shorter_parent():
+    """Una llamada anidada con un plazo más largo respeta el del llamador"""
+    async def inner():
+        return deadlines.remaining()
+
+    async def outer():
+        return await deadlines.run(lambda: deadlines.run(inner, timeout=60), timeout=1)
+
+    assert asyncio.run(outer()) <= 1
@@ -1,3 +1,4 @@
+import asyncio
 import requests
 import json
 import time
@@ -119,7 +120,7 @@ def test_resources():
         print(f"   ✅ Contenido: {len(models_content)} caracteres")
         
         print("🔍 Probando recurso claude://status:")
-        status_content = get_server_status()
+        status_content = asyncio.run(get_server_status())
         print(f"   ✅ Contenido: {len(status_content)} caracteres")
         
         return True
@@ -0,0 +1,108 @@
+"""
+Pruebas del circuit breaker del enrutador contra el mock de Anthropic: los 529
+seguidos abren el circuito, tras el enfriamiento pasa una sola petición de
+prueba, una prueba fallida lo reabre con el doble de enfriamiento y una
+correcta lo cierra
+"""
+
+import asyncio
+import time
+
+import pytest
+
+import claude_client
+import mock_anthropic
+import model_catalog
+import model_router
+
+MODEL = "claude-opus-4-1-20250805"
+PAYLOAD = {"model": MODEL, "max_tokens": 16, "messages": [{"role": "user", "content": "hola"}]}
+
+@pytest.fixture(scope="module")
+def mocks():
+    overloaded_port, healthy_port = mock_anthropic.find_free_port(), mock_anthropic.find_free_port()
+    servers = [
+        mock_anthropic.start_in_thread(overloaded_port, latency=0.01, overloaded_models=[MODEL]),
+        mock_anthropic.start_in_thread(healthy_port, latency=0.01),
+    ]
+    yield f"http://127.0.0.1:{overloaded_port}/v1/messages", f"http://127.0.0.1:{healthy_port}/v1/messages"
+    for server in servers:
+        server.should_exit = True
+
+async def attempt(router: model_router.ModelRouter) -> None:
+    """Un intento con el mismo protocolo que la app: allow, la petición y record del resultado"""
+    assert router.allow(MODEL)
+    start = time.monotonic()
+    try:
+        await claude_client.create_message("test-key", PAYLOAD)
+    except claude_client.AnthropicAPIError as exc:
+        router.record(MODEL, time.monotonic() - start, exc)
+    else:
+        router.record(MODEL, time.monotonic() - start)
+
+def test_circuit_open_half_open_closed(mocks, monkeypatch):
+    """closed → open tras 3 fallos → half_open con una prueba → open (x2) si falla → closed si va bien"""
+    overloaded, healthy = mocks
+    monkeypatch.setenv("ANTHROPIC_API_URL", overloaded)
+    router = model_router.ModelRouter(
+        model_catalog.ModelCatalog(None),
+        breaker={"failure_threshold": 3, "cooldown": 0.2, "max_cooldown": 1},
+    )
+    breaker = router.breaker_for(MODEL)
+
+    async def main():
+        try:
+            for _ in range(3):
+                await attempt(router)
+            assert breaker.state == "open"
+            assert not router.allow(MODEL)
+            assert 0 < router.retry_in(MODEL) <= 0.2
+
+            # After the cooldown a single probe goes through; it fails and the cooldown doubles
+            await asyncio.sleep(0.25)
+            assert router.allow(MODEL)
+            assert breaker.state == "half_open"
+            assert not router.allow(MODEL)
+            start = time.monotonic()
+            try:
+                await claude_client.create_message("test-key", PAYLOAD)
+            except claude_client.AnthropicAPIError as exc:
+                router.record(MODEL, time.monotonic() - start, exc)
+            assert breaker.state == "open"
+            assert breaker.cooldown == pytest.approx(0.4)
+
+            await asyncio.sleep(0.25)
+            assert not router.allow(MODEL)
+
+            # The model recovered: the next probe succeeds and closes the circuit
+            monkeypatch.setenv("ANTHROPIC_API_URL", healthy)
+            await asyncio.sleep(0.2)
+            await attempt(router)
+            assert breaker.state == "closed"
+            assert breaker.cooldown == pytest.approx(0.2)
+            assert router.allow(MODEL) and router.allow(MODEL)
+        finally:
+            await claude_client.close_async_client()
+
+    asyncio.run(main())
+    assert breaker.opens == 2
+    assert router.short_circuited == 3
+
+def test_client_errors_do_not_open_the_circuit(mocks, monkeypatch):
+    """Los errores del cliente (aquí un 404) no cuentan como fallos del modelo"""
+    _, healthy = mocks
+    monkeypatch.setenv("ANTHROPIC_API_URL", healthy)
+    router = model_router.ModelRouter(model_catalog.ModelCatalog(None), breaker={"failure_threshold": 2})
+
+    async def main():
+        try:
+            for _ in range(3):
+                with pytest.raises(claude_client.AnthropicAPIError) as info:
+                    await claude_client.create_message("test-key", {**PAYLOAD, "model": "claude-no-existe"})
+                router.record(MODEL, 0.01, info.value)
+        finally:
+            await claude_client.close_async_client()
+
+    asyncio.run(main())
+    assert router.breaker_for(MODEL).state == "closed"
+    assert router.allow(MODEL)
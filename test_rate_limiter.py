@@ -0,0 +1,109 @@
+"""
+Pruebas del gobernador de uso contra el mock de Anthropic: un 529 reduce a la
+mitad el límite de concurrencia del modelo y lo pausa lo que indique
+Retry-After, y las respuestas correctas lo vuelven a subir poco a poco (AIMD)
+"""
+
+import asyncio
+import time
+
+import pytest
+
+import claude_client
+import mock_anthropic
+import rate_limiter
+
+MODEL = "claude-3-5-haiku-20241022"
+PAYLOAD = {"model": MODEL, "max_tokens": 16, "messages": [{"role": "user", "content": "hola"}]}
+
+@pytest.fixture(scope="module")
+def mocks():
+    overloaded_port, healthy_port = mock_anthropic.find_free_port(), mock_anthropic.find_free_port()
+    servers = [
+        mock_anthropic.start_in_thread(overloaded_port, latency=0.05, overloaded_models=[MODEL], retry_after=0.3),
+        mock_anthropic.start_in_thread(healthy_port, latency=0.05),
+    ]
+    yield f"http://127.0.0.1:{overloaded_port}/v1/messages", f"http://127.0.0.1:{healthy_port}/v1/messages"
+    for server in servers:
+        server.should_exit = True
+
+async def send(governor: rate_limiter.RateGovernor) -> float:
+    """Envía PAYLOAD con permiso del gobernador y retorna los segundos que esperó el permiso"""
+    start = time.monotonic()
+    async with governor.permit(PAYLOAD) as permit:
+        waited = time.monotonic() - start
+        await claude_client.create_message("test-key", PAYLOAD, on_headers=permit.observe_headers)
+    return waited
+
+def test_overload_backs_off_and_recovers(mocks, monkeypatch):
+    """Cada 529 divide el límite y pausa el modelo Retry-After segundos; cada éxito suma ~1/límite"""
+    overloaded, healthy = mocks
+    monkeypatch.setenv("ANTHROPIC_API_URL", overloaded)
+
+    async def main():
+        governor = rate_limiter.RateGovernor(max_concurrency=8, max_wait=5)
+        limiter = governor.limiter(MODEL)
+        try:
+            with pytest.raises(claude_client.AnthropicAPIError):
+                await send(governor)
+            first = (limiter.concurrency_limit, governor.paused_for(MODEL))
+            # The next permit is held until the Retry-After pause is over
+            with pytest.raises(claude_client.AnthropicAPIError) as info:
+                await send(governor)
+            assert info.value.status_code == 529
+            second_limit = limiter.concurrency_limit
+            await asyncio.sleep(governor.paused_for(MODEL))
+
+            monkeypatch.setenv("ANTHROPIC_API_URL", healthy)
+            for _ in range(3):
+                await send(governor)
+        finally:
+            await claude_client.close_async_client()
+        return first, second_limit, limiter, governor.stats()[MODEL]
+
+    (first_limit, paused), second_limit, limiter, stats = asyncio.run(main())
+    assert first_limit == 4
+    assert 0.2 < paused <= 0.3
+    assert second_limit == 2
+    assert 2 < limiter.concurrency_limit < 4
+    assert stats["overloads"] == 2
+    assert stats["in_flight"] == 0
+
+def test_pause_delays_next_permit(mocks, monkeypatch):
+    """Tras un 529 el siguiente permiso espera a que acabe la pausa en vez de enviar la petición"""
+    overloaded, _ = mocks
+    monkeypatch.setenv("ANTHROPIC_API_URL", overloaded)
+
+    async def main():
+        governor = rate_limiter.RateGovernor(max_concurrency=8, max_wait=5)
+        try:
+            with pytest.raises(claude_client.AnthropicAPIError):
+                await send(governor)
+            start = time.monotonic()
+            async with governor.permit(PAYLOAD):
+                return time.monotonic() - start
+        finally:
+            await claude_client.close_async_client()
+
+    assert asyncio.run(main()) >= 0.2
+
+def test_wait_past_max_wait_is_rejected(mocks, monkeypatch):
+    """Si la pausa supera CLAUDE_RATE_MAX_WAIT el permiso falla enseguida con RateLimitExceeded"""
+    overloaded, _ = mocks
+    monkeypatch.setenv("ANTHROPIC_API_URL", overloaded)
+
+    async def main():
+        governor = rate_limiter.RateGovernor(max_wait=0.1)
+        try:
+            with pytest.raises(claude_client.AnthropicAPIError):
+                await send(governor)
+            start = time.monotonic()
+            with pytest.raises(rate_limiter.RateLimitExceeded):
+                await send(governor)
+            return time.monotonic() - start, governor.stats()[MODEL]["rejected"]
+        finally:
+            await claude_client.close_async_client()
+
+    elapsed, rejected = asyncio.run(main())
+    assert elapsed < 0.1
+    assert rejected == 1
@@ -0,0 +1,59 @@
+"""
+Pruebas de la caché de respuestas en disco: las lecturas y escrituras van por
+el hilo del almacén y la poda de entradas expiradas o sobrantes es periódica
+"""
+
+import asyncio
+import threading
+
+import response_cache
+
+def test_disk_roundtrip_off_the_loop(tmp_path, monkeypatch):
+    """Dentro del loop el disco se usa desde el hilo del almacén y otra instancia lee lo guardado"""
+    path = str(tmp_path / "cache.db")
+    threads = set()
+    original = response_cache.DiskStore.get
+
+    def get(self, key, now):
+        threads.add(threading.current_thread().name)
+        return original(self, key, now)
+
+    monkeypatch.setattr(response_cache.DiskStore, "get", get)
+
+    async def main():
+        cache = response_cache.ResponseCache(disk_path=path)
+        cache.set("clave", {"texto": "hola"})
+        restarted = response_cache.ResponseCache(disk_path=path)
+        # Same file, new process: the write above must be on disk before this read
+        await asyncio.wrap_future(cache.disk.submit(lambda: None))
+        return await restarted.fetch("clave"), await restarted.stats_async()
+
+    value, stats = asyncio.run(main())
+    assert value == {"texto": "hola"}
+    assert (stats["disk_hits"], stats["disk_entries"]) == (1, 1)
+    assert threads and all(name.startswith("response-cache") for name in threads)
+
+def test_prune_is_periodic(tmp_path):
+    """El exceso sobre disk_max_entries y lo expirado se borra al podar, no en cada escritura"""
+    cache = response_cache.ResponseCache(max_entries=1, ttl=60, disk_path=str(tmp_path / "cache.db"), disk_max_entries=3, disk_prune_interval=3600)
+    for index in range(6):
+        cache.set(f"clave{index}", {"n": index})
+    assert cache.stats()["disk_entries"] == 6
+
+    cache.disk.submit(cache.disk.prune, cache.disk.pruned_at + 3600).result()
+    stats = cache.stats()
+    # The TTL is 60s, so pruning an hour later drops every entry as expired
+    assert stats["disk_entries"] == 0
+    assert cache.get("clave5") == {"n": 5}
+
+def test_eviction_keeps_newest(tmp_path):
+    """Al podar se conservan las disk_max_entries entradas más recientes"""
+    cache = response_cache.ResponseCache(max_entries=1, disk_path=str(tmp_path / "cache.db"), disk_max_entries=3, disk_prune_interval=3600)
+    for index in range(6):
+        cache.set(f"clave{index}", {"n": index})
+    disk = cache.disk
+    disk.submit(disk.prune, disk.pruned_at + 1).result()
+    assert disk.submit(disk.count).result() == 3
+    assert cache.get("clave0") is None
+    assert cache.get("clave4") == {"n": 4}
+    assert disk.evictions == 3
@@ -0,0 +1,95 @@
+"""
+Pruebas de la política de reintentos contra el mock de Anthropic: los 429 se
+reintentan respetando Retry-After y el plazo total, los errores del cliente no
+se reintentan, y el hedging lanza un duplicado que gana a un intento lento
+"""
+
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import claude_client
+import mock_anthropic
+import retry
+
+FAST = "claude-3-5-haiku-20241022"
+SLOW = "claude-opus-4-1-20250805"
+
+def payload(model: str) -> dict:
+    return {"model": model, "max_tokens": 16, "messages": [{"role": "user", "content": "hola"}]}
+
+def start_mock(monkeypatch, **options) -> tuple:
+    port = mock_anthropic.find_free_port()
+    server = mock_anthropic.start_in_thread(port, **options)
+    monkeypatch.setenv("ANTHROPIC_API_URL", f"http://127.0.0.1:{port}/v1/messages")
+    return server, f"http://127.0.0.1:{port}"
+
+@pytest.fixture
+def rate_limited(monkeypatch):
+    server, url = start_mock(monkeypatch, latency=0.01, error_429=1.0, retry_after=0.3)
+    yield url
+    server.should_exit = True
+
+async def run(policy: retry.RetryPolicy, fn, model: str = FAST):
+    try:
+        return await policy.run(fn, model)
+    finally:
+        await claude_client.close_async_client()
+
+def test_retries_honor_retry_after(rate_limited):
+    """Cada reintento de un 429 espera Retry-After y tras max_attempts intentos el error llega al llamador"""
+    policy = retry.RetryPolicy(max_attempts=3, base_delay=0.01)
+    start = time.monotonic()
+    with pytest.raises(claude_client.AnthropicAPIError) as info:
+        asyncio.run(run(policy, lambda: claude_client.create_message("test-key", payload(FAST))))
+    assert info.value.status_code == 429
+    assert time.monotonic() - start >= 0.6
+    assert httpx.get(f"{rate_limited}/stats").json()["429"] == 3
+    assert (policy.retries, policy.gave_up) == (2, 1)
+
+def test_deadline_stops_retrying(rate_limited):
+    """Un reintento cuyo Retry-After pasaría del plazo total no se hace"""
+    policy = retry.RetryPolicy(max_attempts=5, base_delay=0.01, deadline=0.5)
+    start = time.monotonic()
+    with pytest.raises(claude_client.AnthropicAPIError):
+        asyncio.run(run(policy, lambda: claude_client.create_message("test-key", payload(FAST))))
+    assert time.monotonic() - start < 0.5
+    assert httpx.get(f"{rate_limited}/stats").json()["429"] == 2
+    assert (policy.retries, policy.gave_up) == (1, 1)
+
+def test_client_errors_are_not_retried(rate_limited):
+    """Un 404 (modelo desconocido) falla al primer intento"""
+    policy = retry.RetryPolicy(max_attempts=3, base_delay=0.01)
+    with pytest.raises(claude_client.AnthropicAPIError) as info:
+        asyncio.run(run(policy, lambda: claude_client.create_message("test-key", payload("claude-no-existe"))))
+    assert info.value.status_code == 404
+    assert httpx.get(f"{rate_limited}/stats").json()["requests"] == 1
+    assert (policy.retries, policy.gave_up) == (0, 0)
+
+def test_hedge_wins_over_slow_attempt(monkeypatch):
+    """Si el primer intento pasa del p95 se lanza un duplicado; gana el rápido y el lento se aborta"""
+    server, url = start_mock(monkeypatch, latency=0.05, model_latency={SLOW: 2.0})
+    policy = retry.RetryPolicy(hedge_enabled=True)
+    for _ in range(policy.latencies.min_samples):
+        policy.latencies.record(FAST, 0.05)
+    # The first attempt lands on a slow replica (modelled as the slow model), the hedge on a fast one
+    models = iter([SLOW, FAST])
+
+    try:
+        start = time.monotonic()
+        result = asyncio.run(run(policy, lambda: claude_client.create_message("test-key", payload(next(models)))))
+        elapsed = time.monotonic() - start
+        limit = time.monotonic() + 3
+        while httpx.get(f"{url}/stats").json()["aborted"] == 0 and time.monotonic() < limit:
+            time.sleep(0.05)
+        stats = httpx.get(f"{url}/stats").json()
+    finally:
+        server.should_exit = True
+
+    assert result["model"] == FAST
+    assert elapsed < 1
+    assert (policy.hedges, policy.hedge_wins) == (1, 1)
+    assert stats["requests"] == 2
+    assert stats["aborted"] == 1
@@ -0,0 +1,131 @@
+"""
+Pruebas del planificador: reparto justo (WFQ) entre clientes, parte máxima de
+las llamadas bulk y límite de llamadas en vuelo por cliente
+"""
+
+import asyncio
+
+import scheduler
+
+MODEL = "claude-3-5-haiku-20241022"
+
+async def hold(sched: scheduler.Scheduler, order: list, client: str, priority: str = "interactive", release: asyncio.Event = None, seconds: float = 0.01):
+    """Ocupa un slot de `client` hasta que se activa `release` (o durante `seconds`) y anota el orden de entrada"""
+    async with sched.slot(MODEL, priority, client):
+        order.append(client)
+        if release is not None:
+            await release.wait()
+        else:
+            await asyncio.sleep(seconds)
+
+def test_wfq_does_not_let_a_busy_client_starve_others():
+    """Las 2 llamadas de b no esperan detrás de las 6 que a encoló antes"""
+    async def main():
+        sched = scheduler.Scheduler(lambda model: 1)
+        order = []
+        tasks = [asyncio.create_task(hold(sched, order, "a")) for _ in range(6)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(hold(sched, order, "b")) for _ in range(2)]
+        await asyncio.gather(*tasks)
+        return order
+
+    order = asyncio.run(main())
+    assert order[:4].count("b") == 2
+    assert order.count("a") == 6
+
+def test_weight_gives_a_larger_share():
+    """Un cliente con peso 3 recibe unas tres llamadas por cada una del de peso 1"""
+    async def main():
+        sched = scheduler.Scheduler(lambda model: 1, clients={"pesado": {"weight": 3}})
+        order = []
+        tasks = [asyncio.create_task(hold(sched, order, "ligero")) for _ in range(8)]
+        tasks += [asyncio.create_task(hold(sched, order, "pesado")) for _ in range(8)]
+        await asyncio.gather(*tasks)
+        return order
+
+    order = asyncio.run(main())
+    assert order[:8].count("pesado") >= 5
+
+def test_bulk_share_leaves_room_for_interactive():
+    """Las bulk no pasan de su parte de los slots y una interactiva entra aunque haya bulk en cola"""
+    async def main():
+        sched = scheduler.Scheduler(lambda model: 4, bulk_share=0.5)
+        order = []
+        release = asyncio.Event()
+        bulk = [asyncio.create_task(hold(sched, order, f"lote{i}", "bulk", release)) for i in range(5)]
+        await asyncio.sleep(0.05)
+        in_flight = sched.stats()["classes"]["bulk"]["in_flight"]
+        interactive = asyncio.create_task(hold(sched, order, "agente", "interactive", seconds=0))
+        await asyncio.wait_for(interactive, 1)
+        queued = sched.stats()["classes"]["bulk"]["queued"]
+        release.set()
+        await asyncio.gather(*bulk)
+        return in_flight, queued, order
+
+    in_flight, queued, order = asyncio.run(main())
+    assert in_flight == 2
+    assert queued == 3
+    assert order.index("agente") == 2
+
+def test_interactive_dispatched_before_queued_bulk():
+    """Con los slots llenos, al liberarse uno pasa antes la interactiva que las bulk que esperaban"""
+    async def main():
+        sched = scheduler.Scheduler(lambda model: 1)
+        order = []
+        release = asyncio.Event()
+        first = asyncio.create_task(hold(sched, order, "primero", "interactive", release))
+        await asyncio.sleep(0)
+        bulk = [asyncio.create_task(hold(sched, order, "lote", "bulk")) for _ in range(3)]
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(hold(sched, order, "agente"))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, interactive, *bulk)
+        return order
+
+    assert asyncio.run(main()) == ["primero", "agente", "lote", "lote", "lote"]
+
+def test_client_cap_and_priority_policy():
+    """Un cliente no pasa de su máximo en vuelo (los demás usan los slots libres) ni de su clase"""
+    async def main():
+        sched = scheduler.Scheduler(lambda model: 4, client_concurrency=1, clients={"lotes": {"priority": "bulk"}})
+        order = []
+        release = asyncio.Event()
+        capped = [asyncio.create_task(hold(sched, order, "voraz", "interactive", release)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        other = asyncio.create_task(hold(sched, order, "otro", seconds=0))
+        await asyncio.wait_for(other, 1)
+        stats = sched.stats()
+        demoted = sched.slot(MODEL, "interactive", "lotes").priority
+        release.set()
+        await asyncio.gather(*capped)
+        return stats, sched.demoted, demoted
+
+    stats, demoted_count, demoted = asyncio.run(main())
+    assert stats["clients"]["voraz"] == {"in_flight": 1, "queued": 2}
+    assert stats["capped"] > 0
+    assert demoted == "bulk"
+    assert demoted_count == 1
+
+def test_cancelled_waiter_leaves_the_queue():
+    """Una llamada cancelada mientras espera no ocupa slot ni cuenta como encolada"""
+    async def main():
+        sched = scheduler.Scheduler(lambda model: 1)
+        order = []
+        release = asyncio.Event()
+        first = asyncio.create_task(hold(sched, order, "a", release=release))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(hold(sched, order, "b"))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        queued = sched.stats()["classes"]["interactive"]["queued"]
+        release.set()
+        await first
+        await hold(sched, order, "c")
+        return queued, order, sched.stats()
+
+    queued, order, stats = asyncio.run(main())
+    assert queued == 0
+    assert order == ["a", "c"]
+    assert stats["classes"]["interactive"]["in_flight"] == 0
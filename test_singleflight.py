@@ -0,0 +1,114 @@
+"""
+Pruebas de la coalescencia de peticiones contra el mock de Anthropic: los que
+se suman a una petición en streaming reciben también el texto ya emitido, y
+la petición upstream solo se cancela cuando se cancelan todos los que esperan
+"""
+
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import claude_client
+import mock_anthropic
+import singleflight
+
+MODEL = "claude-3-5-haiku-20241022"
+PAYLOAD = {"model": MODEL, "max_tokens": 32, "messages": [{"role": "user", "content": "una pregunta repetida"}]}
+
+@pytest.fixture(scope="module")
+def mock_url():
+    port = mock_anthropic.find_free_port()
+    server = mock_anthropic.start_in_thread(port, latency=1.0)
+    yield f"http://127.0.0.1:{port}"
+    server.should_exit = True
+
+@pytest.fixture(autouse=True)
+def api_url(mock_url, monkeypatch):
+    monkeypatch.setenv("ANTHROPIC_API_URL", f"{mock_url}/v1/messages")
+
+def mock_stats(mock_url: str) -> dict:
+    return httpx.get(f"{mock_url}/stats").json()
+
+def test_followers_replay_streamed_text(mock_url):
+    """Quien se suma a mitad del streaming recibe primero el texto ya emitido y después el resto"""
+    before = mock_stats(mock_url)["requests"]
+
+    async def main():
+        flights = singleflight.SingleFlight()
+        received = ["", "", ""]
+
+        async def caller(index: int, delay: float):
+            await asyncio.sleep(delay)
+
+            async def on_text(text: str):
+                received[index] += text
+
+            return await flights.do("clave", lambda publish: claude_client.stream_message("test-key", {**PAYLOAD, "stream": True}, publish), on_text)
+
+        try:
+            results = await asyncio.gather(caller(0, 0), caller(1, 0.4), caller(2, 0.7))
+        finally:
+            await claude_client.close_async_client()
+        return flights, received, results
+
+    flights, received, results = asyncio.run(main())
+    text = results[0]["content"][0]["text"]
+    assert all(result is results[0] for result in results)
+    assert received == [text, text, text]
+    assert flights.stats() == {"in_flight": 0, "upstream_calls": 1, "coalesced": 2}
+    assert mock_stats(mock_url)["requests"] == before + 1
+
+def test_cancelling_one_waiter_keeps_the_call(mock_url):
+    """Si se cancela uno de dos clientes, el otro recibe la respuesta y la petición upstream sigue"""
+    before = mock_stats(mock_url)
+
+    async def main():
+        flights = singleflight.SingleFlight()
+        call = lambda publish: claude_client.create_message("test-key", PAYLOAD)
+        try:
+            leaving = asyncio.create_task(flights.do("clave", call))
+            staying = asyncio.create_task(flights.do("clave", call))
+            await asyncio.sleep(0.2)
+            leaving.cancel()
+            result = await staying
+        finally:
+            await claude_client.close_async_client()
+        return leaving, result
+
+    leaving, result = asyncio.run(main())
+    assert leaving.cancelled()
+    assert result["content"][0]["text"]
+    after = mock_stats(mock_url)
+    assert after["requests"] == before["requests"] + 1
+    assert after["aborted"] == before["aborted"]
+
+def test_cancelling_every_waiter_cancels_upstream(mock_url):
+    """Si se cancelan todos los que esperan, la petición upstream se aborta y la siguiente empieza de cero"""
+    before = mock_stats(mock_url)
+
+    async def main():
+        flights = singleflight.SingleFlight()
+        call = lambda publish: claude_client.create_message("test-key", PAYLOAD)
+        try:
+            waiters = [asyncio.create_task(flights.do("clave", call)) for _ in range(3)]
+            await asyncio.sleep(0.2)
+            for waiter in waiters:
+                waiter.cancel()
+            await asyncio.gather(*waiters, return_exceptions=True)
+            # A new caller does not join the cancelled flight
+            result = await flights.do("clave", call)
+        finally:
+            await claude_client.close_async_client()
+        return flights, result
+
+    flights, result = asyncio.run(main())
+    assert result["content"][0]["text"]
+    assert flights.leaders == 2
+    limit = time.monotonic() + 3
+    while mock_stats(mock_url)["aborted"] == before["aborted"] and time.monotonic() < limit:
+        time.sleep(0.05)
+    after = mock_stats(mock_url)
+    assert after["aborted"] == before["aborted"] + 1
+    assert after["requests"] == before["requests"] + 2
@@ -0,0 +1,213 @@
+"""
+Pruebas del estado compartido: las operaciones de cada backend (memory, SQLite
+y el mock de Redis) y que dos instancias de la app comparten la caché, los
+buckets del gobernador, los contadores de presupuesto y las conversaciones
+"""
+
+import asyncio
+import json
+
+import httpx
+import pytest
+from mcp import ClientSession
+
+import benchmark_load
+import mock_anthropic
+import mock_redis
+import rate_limiter
+import state_backend
+
+MODEL = benchmark_load.MODEL
+
+@pytest.fixture(scope="module")
+def redis_port():
+    port = mock_anthropic.find_free_port()
+    mock_redis.start_in_thread(port, password="secreto")
+    return port
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def backend_url(request, tmp_path):
+    if request.param == "memory":
+        return "memory"
+    if request.param == "sqlite":
+        return f"sqlite:///{tmp_path}/state.db"
+    return f"redis://:secreto@127.0.0.1:{request.getfixturevalue('redis_port')}/1"
+
+def test_abstract_backend():
+    """StateBackend no se puede instanciar sin _execute"""
+    with pytest.raises(TypeError):
+        state_backend.StateBackend()
+
+def test_operations(backend_url):
+    """get/set/delete/incr con TTL, y las operaciones de una misma vuelta del loop salen en un lote"""
+    async def main():
+        backend = state_backend.backend_from_url(backend_url)
+        try:
+            assert await backend.get("clave") is None
+            backend.set("clave", state_backend.pack({"texto": "hola"}), 10)
+            assert state_backend.unpack(await backend.get("clave")) == {"texto": "hola"}
+            backend.set("efimera", b"x", 0.05)
+            totals = await asyncio.gather(*(backend.incr("contador", 1.5, 10) for _ in range(100)))
+            assert max(totals) == 150.0
+            assert backend.stats()["ops_per_batch"] > 10
+            await asyncio.sleep(0.1)
+            assert await backend.get("efimera") is None
+            backend.delete("clave")
+            assert await backend.get("clave") is None
+            assert float(await backend.get("contador")) == 150.0
+            assert backend.stats()["errors"] == 0
+        finally:
+            await backend.close()
+
+    asyncio.run(main())
+
+def test_shared_between_instances(backend_url):
+    """Dos objetos backend con la misma URL (como dos procesos) ven los mismos datos, salvo memory"""
+    async def main():
+        first = state_backend.backend_from_url(backend_url)
+        second = state_backend.backend_from_url(backend_url)
+        try:
+            first.set("compartida", b"valor", 10)
+            await first.incr("usos", 2)
+            await first.flush()
+            return await second.get("compartida"), await second.incr("usos", 3)
+        finally:
+            await first.close()
+            await second.close()
+
+    value, total = asyncio.run(main())
+    if backend_url == "memory":
+        assert (value, total) == (None, 3)
+    else:
+        assert (value, total) == (b"valor", 5)
+
+def test_unreachable_backend_falls_back():
+    """Con el servidor caído las lecturas retornan None y durante RETRY_AFTER ni se intenta"""
+    async def main():
+        backend = state_backend.backend_from_url(f"redis://127.0.0.1:{mock_anthropic.find_free_port()}")
+        assert await backend.get("x") is None
+        assert await backend.incr("x", 1) is None
+        return backend.stats()
+
+    stats = asyncio.run(main())
+    assert stats["errors"] == 1
+    assert stats["skipped"] == 1
+
+def test_governor_buckets_shared(backend_url):
+    """Las peticiones admitidas por un gobernador gastan el bucket del otro, y una pausa por 529 se propaga"""
+    class Overloaded(Exception):
+        status_code = 529
+        headers = {"retry-after": "3"}
+
+    async def main():
+        first_backend = state_backend.backend_from_url(backend_url)
+        second_backend = state_backend.backend_from_url(backend_url)
+        first = rate_limiter.RateGovernor(rpm=60, tpm=0, max_wait=0.01)
+        second = rate_limiter.RateGovernor(rpm=60, tpm=0, max_wait=0.01)
+        first.attach(first_backend, 0.05)
+        second.attach(second_backend, 0.05)
+        payload = {"model": MODEL, "messages": [{"role": "user", "content": "x"}], "max_tokens": 1}
+        try:
+            # The first sync of a model only joins the shared bucket
+            for governor in (first, second):
+                governor.limiter(MODEL)
+                await governor.sync()
+            for _ in range(30):
+                async with first.permit(payload):
+                    pass
+            for _ in range(25):
+                async with second.permit(payload):
+                    pass
+            await first.sync()
+            await second.sync()
+            admitted = 0
+            for _ in range(10):
+                try:
+                    async with second.permit(payload):
+                        admitted += 1
+                except rate_limiter.RateLimitExceeded:
+                    pass
+            first.limiters[MODEL].requests.tokens = 60
+            with pytest.raises(Overloaded):
+                async with first.permit(payload):
+                    raise Overloaded()
+            await first.sync()
+            await second.sync()
+            return admitted, second.paused_for(MODEL)
+        finally:
+            await first_backend.close()
+            await second_backend.close()
+
+    admitted, paused = asyncio.run(main())
+    if backend_url == "memory":
+        # Nothing shared: the second governor only counts its own 25 requests
+        assert admitted == 10
+        assert paused == 0
+    else:
+        assert admitted <= 6
+        assert paused > 2
+
+async def call_tool(base_url: str, tool: str, arguments: dict) -> str:
+    async with benchmark_load.open_session(base_url, "sse", "replicas") as streams:
+        async with ClientSession(streams[0], streams[1]) as session:
+            await session.initialize()
+            result = await session.call_tool(tool, arguments)
+            return result.content[0].text
+
+@pytest.mark.parametrize("kind", ["sqlite", "redis"])
+def test_two_app_instances(kind, tmp_path, redis_port):
+    """Dos procesos de app.py con el mismo backend comparten caché, conversaciones y presupuestos"""
+    mock_port = mock_anthropic.find_free_port()
+    mock = mock_anthropic.start_in_thread(mock_port, 0.05)
+    url = f"sqlite:///{tmp_path}/state.db" if kind == "sqlite" else f"redis://:secreto@127.0.0.1:{redis_port}/2"
+    env = {
+        "CLAUDE_STATE_BACKEND": url,
+        "CLAUDE_STATE_SYNC_INTERVAL": "0.1",
+        "CLAUDE_CACHE_ENABLED": "true",
+        "CLAUDE_BUDGET_CLIENT_TOKENS": "400",
+    }
+    ports = [mock_anthropic.find_free_port() for _ in range(2)]
+    processes = []
+    for index, port in enumerate(ports):
+        state_dir = tmp_path / f"app{index}"
+        state_dir.mkdir()
+        processes.append(benchmark_load.start_server(port, mock_port, "sse", 1, env, str(state_dir)))
+    first, second = (f"http://127.0.0.1:{port}" for port in ports)
+
+    def upstream_requests() -> int:
+        return httpx.get(f"http://127.0.0.1:{mock_port}/stats").json()["requests"]
+
+    async def main():
+        # Response cache: the second instance answers from the entry the first one stored
+        prompt = {"model": MODEL, "prompt": "pregunta compartida", "max_tokens": 16}
+        answer = await call_tool(first, "call_claude", prompt)
+        before = upstream_requests()
+        assert await call_tool(second, "call_claude", prompt) == answer
+        assert upstream_requests() == before
+
+        # Conversations: turns alternate between instances and ending it on one ends it everywhere
+        conversation = json.loads(await call_tool(first, "start_claude_conversation", {"model": MODEL}))["conversation_id"]
+        for base_url in (second, first):
+            reply = await call_tool(base_url, "continue_claude_conversation", {"conversation_id": conversation, "prompt": "turno"})
+            assert not reply.startswith("Error"), reply
+        assert "terminada" in await call_tool(second, "end_claude_conversation", {"conversation_id": conversation})
+        reply = await call_tool(first, "continue_claude_conversation", {"conversation_id": conversation, "prompt": "otra"})
+        assert reply.startswith("Error")
+
+        # Budget counters: once the client spent its budget on the first instance, the second rejects it too
+        for index in range(20):
+            reply = await call_tool(first, "call_claude", {"model": MODEL, "prompt": f"gasto {index}", "max_tokens": 64})
+            if reply.startswith("Error"):
+                break
+        assert "presupuesto" in reply
+        await asyncio.sleep(0.3)
+        reply = await call_tool(second, "call_claude", {"model": MODEL, "prompt": "en la otra", "max_tokens": 16})
+        assert reply.startswith("Error") and "presupuesto" in reply
+
+    try:
+        asyncio.run(main())
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(10)
+        mock.should_exit = True
@@ -0,0 +1,543 @@
+"""
+Trazas por petición y registro de llamadas lentas
+Cada llamada a una herramienta MCP es una traza con spans compatibles con
+OpenTelemetry (ids W3C, tiempos en nanosegundos, atributos y estado) que
+separan sus fases: despacho MCP (desde que llega la petición HTTP hasta que
+empieza la herramienta, con la validación de argumentos) y la propia
+herramienta (presupuesto, caché, cola del gobernador, conexión, envío, espera
+y generación upstream). Las herramientas se trazan con el decorador
+`Tracer.tool`, que se aplica al registrarlas.
+
+Las trazas se exportan en formato OTLP/JSON a un fichero local (una línea por
+lote, legible por el receptor `otlpjsonfile` del OpenTelemetry Collector o
+cualquier herramienta offline) y, opcionalmente, por OTLP/HTTP a un collector.
+Las llamadas que superan un umbral se anotan en un registro de llamadas lentas
+con el desglose por fase y el tamaño de los argumentos.
+
+Los spans se crean con `span()` / `record()` desde cualquier módulo; fuera de
+una traza no hacen nada.
+"""
+
+import asyncio
+import functools
+import inspect
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+import httpx
+from mcp import types
+from mcp.server.fastmcp import Context
+from mcp.server.lowlevel.server import request_ctx
+
+import metrics
+
+# OTLP span kinds
+INTERNAL = 1
+SERVER = 2
+CLIENT = 3
+
+# perf_counter() is monotonic and precise; this offset turns it into Unix time for export
+EPOCH_OFFSET = time.time() - time.perf_counter()
+
+# Key the ASGI middleware leaves in the request scope with the arrival time
+RECEIVED_KEY = "claude.received_at"
+
+# Spans kept per trace; a huge batch call stops recording beyond this
+MAX_SPANS = 2000
+# Seconds between exports, and traces kept waiting for export before dropping the oldest
+EXPORT_INTERVAL = 2.0
+MAX_QUEUED = 1000
+
+_current: ContextVar[Optional["Span"]] = ContextVar("claude_span", default=None)
+
+def _random_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+class Span:
+    """Un tramo de la traza; `start` y `end` en segundos de perf_counter()"""
+
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start", "end", "attributes", "error")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: str, kind: int, start: float, attributes: Dict):
+        self.trace = trace
+        self.span_id = _random_id(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = start
+        self.end: Optional[float] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def set_error(self, error: BaseException) -> None:
+        self.error = f"{type(error).__name__}: {error}"
+
+    def to_otlp(self) -> Dict:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(int((self.start + EPOCH_OFFSET) * 1e9)),
+            "endTimeUnixNano": str(int(((self.end or self.start) + EPOCH_OFFSET) * 1e9)),
+            "attributes": otlp_attributes(self.attributes),
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 0},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+class _NoopSpan:
+    """Lo que retorna span() fuera de una traza"""
+
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+    def set_error(self, error: BaseException) -> None:
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+class Trace:
+    """Los spans de una llamada a una herramienta"""
+
+    __slots__ = ("trace_id", "spans", "root", "sampled", "dropped")
+
+    def __init__(self, trace_id: str = "", sampled: bool = False):
+        self.trace_id = trace_id or _random_id(128)
+        self.spans: List[Span] = []
+        self.root: Optional[Span] = None
+        self.sampled = sampled
+        self.dropped = 0
+
+    def add(self, name: str, parent_id: str, kind: int, start: float, attributes: Dict) -> Optional[Span]:
+        if len(self.spans) >= MAX_SPANS:
+            self.dropped += 1
+            return None
+        span = Span(self, name, parent_id, kind, start, attributes)
+        self.spans.append(span)
+        return span
+
+    def phases(self) -> Dict[str, float]:
+        """Milisegundos por nombre de span (suma de los spans con ese nombre, sin la raíz)"""
+        totals: Dict[str, float] = {}
+        for span in self.spans:
+            if span is not self.root:
+                totals[span.name] = totals.get(span.name, 0.0) + 1000 * span.duration
+        return {name: round(ms, 3) for name, ms in totals.items()}
+
+def otlp_attributes(attributes: Dict) -> List[Dict]:
+    result = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            encoded = {"boolValue": value}
+        elif isinstance(value, int):
+            encoded = {"intValue": str(value)}
+        elif isinstance(value, float):
+            encoded = {"doubleValue": value}
+        else:
+            encoded = {"stringValue": str(value)}
+        result.append({"key": key, "value": encoded})
+    return result
+
+def current() -> Optional[Span]:
+    """Span activo en esta tarea (None fuera de una traza)"""
+    return _current.get()
+
+@contextmanager
+def span(name: str, kind: int = INTERNAL, **attributes):
+    """Context manager que mide un span hijo del activo; fuera de una traza no hace nada"""
+    parent = _current.get()
+    created = parent.trace.add(name, parent.span_id, kind, time.perf_counter(), attributes) if parent is not None else None
+    if created is None:
+        yield NOOP_SPAN
+        return
+    token = _current.set(created)
+    try:
+        yield created
+    except BaseException as e:
+        created.set_error(e)
+        raise
+    finally:
+        created.end = time.perf_counter()
+        _current.reset(token)
+
+def record(name: str, start: float, end: float, kind: int = INTERNAL, **attributes) -> None:
+    """Añade un span ya terminado (tiempos de perf_counter) como hijo del activo"""
+    parent = _current.get()
+    if parent is None:
+        return
+    created = parent.trace.add(name, parent.span_id, kind, start, attributes)
+    if created is not None:
+        created.end = end
+
+def argument_size(value) -> int:
+    """Tamaño aproximado de un argumento en caracteres, sin serializarlo"""
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(argument_size(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(argument_size(item) for item in value)
+    return len(str(value))
+
+def parse_traceparent(value: Optional[str]):
+    """(trace_id, parent_span_id, sampled) de una cabecera W3C traceparent, o None si no es válida"""
+    if not value:
+        return None
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or parts[1] == "0" * 32:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+class Exporter:
+    """
+    Envía las trazas terminadas en lotes, en segundo plano.
+
+    Args:
+        path: Fichero donde se añade una línea OTLP/JSON por lote (vacío = no se escribe)
+        endpoint: URL OTLP/HTTP de un collector, p. ej. http://localhost:4318/v1/traces (vacío = no se envía)
+        service_name: service.name del recurso
+    """
+
+    def __init__(self, path: str = "", endpoint: str = "", service_name: str = "claude-mcp"):
+        self.path = path
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.queue: deque = deque()
+        self._task: Optional[asyncio.Task] = None
+        self.exported = 0
+        self.dropped = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path or self.endpoint)
+
+    def export(self, trace: Trace) -> None:
+        self.queue.append(trace)
+        while len(self.queue) > MAX_QUEUED:
+            self.queue.popleft()
+            self.dropped += 1
+
+    def payload(self, traces: List[Trace]) -> Dict:
+        """ExportTraceServiceRequest de OTLP en JSON"""
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": otlp_attributes({"service.name": self.service_name})},
+                "scopeSpans": [{
+                    "scope": {"name": "claude-mcp.tracing"},
+                    "spans": [span.to_otlp() for trace in traces for span in trace.spans],
+                }],
+            }]
+        }
+
+    def start(self) -> None:
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(EXPORT_INTERVAL)
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self.queue or not self.enabled:
+            return
+        traces = list(self.queue)
+        self.queue.clear()
+        body = json.dumps(self.payload(traces), separators=(",", ":"))
+        try:
+            if self.path:
+                await asyncio.to_thread(self._append, body)
+            if self.endpoint:
+                async with httpx.AsyncClient(timeout=10) as client:
+                    response = await client.post(self.endpoint, content=body, headers={"Content-Type": "application/json"})
+                    response.raise_for_status()
+            self.exported += len(traces)
+        except (OSError, httpx.HTTPError) as e:
+            self.failures += 1
+            self.dropped += len(traces)
+            self.last_error = f"{type(e).__name__}: {e}"
+
+    def _append(self, body: str) -> None:
+        with open(self.path, "a", encoding="utf-8") as output:
+            output.write(body + "\n")
+
+class SlowCallLog:
+    """
+    Llamadas que tardaron más de `threshold` segundos, con su desglose por fase.
+
+    Cada una se escribe, desde un hilo del executor, como una línea JSON en
+    `path` (o en stderr si está vacío) y las últimas `keep` quedan en memoria
+    para claude://status.
+    """
+
+    def __init__(self, threshold: float = 10.0, path: str = "", keep: int = 20):
+        self.threshold = threshold
+        self.path = path
+        self.recent: deque = deque(maxlen=keep)
+        self.count = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def entry(self, trace: Trace) -> Dict:
+        root = trace.root
+        return {
+            "trace_id": trace.trace_id,
+            "tool": root.attributes.get("mcp.tool"),
+            "time": round(root.start + EPOCH_OFFSET, 3),
+            "duration_ms": round(1000 * root.duration, 3),
+            "client": root.attributes.get("mcp.client"),
+            "session": root.attributes.get("mcp.session"),
+            "error": root.error,
+            "arguments": {
+                key[len("mcp.argument."):]: value for key, value in root.attributes.items() if key.startswith("mcp.argument.")
+            },
+            "phases": trace.phases(),
+            "spans": [
+                {
+                    "name": span.name,
+                    "start_ms": round(1000 * (span.start - root.start), 3),
+                    "duration_ms": round(1000 * span.duration, 3),
+                    **({"attributes": span.attributes} if span.attributes and span is not root else {}),
+                    **({"error": span.error} if span.error else {}),
+                }
+                for span in trace.spans if span is not root
+            ],
+        }
+
+    def record(self, trace: Trace) -> None:
+        entry = self.entry(trace)
+        self.count += 1
+        self.recent.append(entry)
+        metrics.slow_calls.inc(tool=entry["tool"] or "")
+        line = json.dumps(entry, ensure_ascii=False, default=str)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(line)
+        else:
+            # The file (or a blocked stderr pipe) must not stall the event loop
+            loop.run_in_executor(None, self._write, line)
+
+    def _write(self, line: str) -> None:
+        with self._lock:
+            try:
+                if self.path:
+                    with open(self.path, "a", encoding="utf-8") as output:
+                        output.write(line + "\n")
+                else:
+                    print(f"🐢 Llamada lenta: {line}", file=sys.stderr)
+            except OSError:
+                self.failures += 1
+
+class Tracer:
+    """
+    Crea la traza de cada llamada a una herramienta y decide qué hacer con ella al terminar.
+
+    Args:
+        enabled: Si es false no se crea ninguna traza (los spans no hacen nada)
+        sample_rate: Fracción de trazas que se exportan (las lentas y las que llegan con traceparent muestreado, siempre)
+        exporter: Destino de las trazas exportadas
+        slow_log: Registro de llamadas lentas
+    """
+
+    def __init__(self, enabled: bool = True, sample_rate: float = 1.0, exporter: Optional[Exporter] = None, slow_log: Optional[SlowCallLog] = None):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.exporter = exporter or Exporter()
+        self.slow_log = slow_log or SlowCallLog(0)
+        self.traces = 0
+
+    def start(self) -> None:
+        self.exporter.start()
+
+    async def stop(self) -> None:
+        await self.exporter.stop()
+
+    def begin(self, name: str, start: float, traceparent: Optional[str] = None, **attributes):
+        """Abre la traza de una petición; retorna (span raíz, token del contextvar)"""
+        parent = parse_traceparent(traceparent)
+        trace_id, parent_id, sampled = parent if parent is not None else ("", "", False)
+        trace = Trace(trace_id, sampled or random.random() < self.sample_rate)
+        trace.root = trace.add(name, parent_id, SERVER, start, attributes)
+        self.traces += 1
+        return trace.root, _current.set(trace.root)
+
+    def finish(self, root: Span, token) -> None:
+        root.end = time.perf_counter()
+        _current.reset(token)
+        trace = root.trace
+        slow = self.slow_log.enabled() and root.duration >= self.slow_log.threshold
+        if slow:
+            self.slow_log.record(trace)
+        if self.exporter.enabled and (trace.sampled or slow):
+            self.exporter.export(trace)
+
+    def tool(self, fn):
+        """
+        Decorador de las herramientas MCP, debajo de `@mcp.tool()`.
+
+        Cada llamada que llega por MCP abre su traza: el despacho (desde que
+        llegó la petición HTTP hasta que empieza la herramienta, validación de
+        argumentos incluida) y el cuerpo de la herramienta. El trace_id vuelve
+        en el `_meta` del primer bloque del resultado. Fuera de una petición
+        MCP (llamadas directas desde Python) solo llama a la función.
+        """
+        if not self.enabled:
+            return fn
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def traced(*args, **kwargs):
+                opened = self._open(fn.__name__, kwargs)
+                if opened is None:
+                    return await fn(*args, **kwargs)
+                try:
+                    with span("tool.run"):
+                        result = await fn(*args, **kwargs)
+                    return with_trace_id(result, opened[0])
+                except BaseException as e:
+                    opened[0].set_error(e)
+                    raise
+                finally:
+                    self.finish(*opened)
+        else:
+            @functools.wraps(fn)
+            def traced(*args, **kwargs):
+                opened = self._open(fn.__name__, kwargs)
+                if opened is None:
+                    return fn(*args, **kwargs)
+                try:
+                    with span("tool.run"):
+                        result = fn(*args, **kwargs)
+                    return with_trace_id(result, opened[0])
+                except BaseException as e:
+                    opened[0].set_error(e)
+                    raise
+                finally:
+                    self.finish(*opened)
+        return traced
+
+    def _open(self, name: str, arguments: Dict):
+        """Abre la traza de una llamada a la herramienta `name`; None si no llegó por MCP"""
+        tool_start = time.perf_counter()
+        try:
+            context = request_ctx.get()
+        except LookupError:
+            return None
+        http_request = context.request
+        received_at = http_request.scope.get(RECEIVED_KEY) if http_request is not None else None
+        session = ""
+        if http_request is not None:
+            session = http_request.query_params.get("session_id") or http_request.headers.get("mcp-session-id") or ""
+        client_params = getattr(context.session, "client_params", None)
+        attributes = {
+            "mcp.tool": name,
+            "mcp.session": session,
+            "mcp.client": client_params.clientInfo.name if client_params is not None else "",
+            **{f"mcp.argument.{key}": argument_size(value) for key, value in arguments.items() if not isinstance(value, Context)},
+        }
+        start = received_at if received_at is not None else tool_start
+        root, token = self.begin(
+            f"tools/call {name}",
+            start,
+            http_request.headers.get("traceparent") if http_request is not None else None,
+            **attributes,
+        )
+        # From the HTTP request to the tool: transport, JSON-RPC parsing, the session's queue and argument validation
+        record("mcp.dispatch", start, tool_start)
+        return root, token
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "traces": self.traces,
+            "sample_rate": self.sample_rate,
+            "export_file": self.exporter.path or None,
+            "export_endpoint": self.exporter.endpoint or None,
+            "exported": self.exporter.exported,
+            "export_dropped": self.exporter.dropped,
+            "export_failures": self.exporter.failures,
+            "export_last_error": self.exporter.last_error,
+            "slow_threshold": self.slow_log.threshold,
+            "slow_calls": self.slow_log.count,
+            "slow_log_failures": self.slow_log.failures,
+            "recent_slow_calls": list(self.slow_log.recent),
+        }
+
+def with_trace_id(result, root: Span):
+    """Marca el resultado de una herramienta como error si es un "Error ..." y añade el trace_id a su primer bloque"""
+    first = result[0] if isinstance(result, (list, tuple)) and result else result
+    if isinstance(first, str):
+        if first.startswith("Error"):
+            root.error = first
+        block = types.TextContent(type="text", text=first, _meta={"trace_id": root.trace.trace_id})
+    elif isinstance(first, types.TextContent):
+        meta = (first.model_extra or {}).get("_meta") or {}
+        block = types.TextContent(type="text", text=first.text, annotations=first.annotations, _meta={**meta, "trace_id": root.trace.trace_id})
+    else:
+        return result
+    return [block, *result[1:]] if first is not result else block
+
+class TraceMiddleware:
+    """Middleware ASGI que anota en el scope cuándo llegó cada petición HTTP (inicio del despacho MCP)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "http":
+            scope[RECEIVED_KEY] = time.perf_counter()
+        await self.app(scope, receive, send)
+
+def tracer_from_env() -> Tracer:
+    """Crea el tracer a partir de las variables de entorno"""
+    return Tracer(
+        enabled=os.environ.get("CLAUDE_TRACE_ENABLED", "true").lower() not in ("0", "false", "no"),
+        sample_rate=float(os.environ.get("CLAUDE_TRACE_SAMPLE_RATE", 1.0)),
+        exporter=Exporter(
+            path=os.environ.get("CLAUDE_TRACE_FILE", ""),
+            endpoint=os.environ.get("CLAUDE_TRACE_OTLP_ENDPOINT", ""),
+            service_name=os.environ.get("OTEL_SERVICE_NAME", "claude-mcp"),
+        ),
+        slow_log=SlowCallLog(
+            threshold=float(os.environ.get("CLAUDE_SLOW_CALL_MS", 10000)) / 1000,
+            path=os.environ.get("CLAUDE_SLOW_CALL_LOG", ""),
+        ),
+    )
@@ -0,0 +1,541 @@
+"""
+Contabilidad de uso de tokens y coste por cliente, sesión y modelo
+Cada respuesta de la API se anota en un registro SQLite de solo inserción que
+se compacta periódicamente (las filas antiguas se agregan por día), y los
+presupuestos configurados rechazan llamadas antes de que lleguen al upstream.
+Con un backend de estado compartido los presupuestos cuentan el uso de todas
+las réplicas: cada respuesta se suma también a contadores comunes por cliente
+y día y por sesión, que se leen en segundo plano.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import state_backend
+
+# USD per million tokens (input, output), matched by substring of the model name in order
+DEFAULT_PRICES = [
+    ("opus", 15.0, 75.0),
+    ("sonnet", 3.0, 15.0),
+    ("3-5-haiku", 0.8, 4.0),
+    ("haiku", 0.25, 1.25),
+]
+# Prompt caching: writes cost 25% more than input tokens, reads 10% of the input price
+CACHE_WRITE_FACTOR = 1.25
+CACHE_READ_FACTOR = 0.1
+
+TOKEN_FIELDS = ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+GROUP_COLUMNS = ("client", "session", "model", "day")
+
+# Shared budget counters outlive their day (or an idle session) by this long
+SHARED_COUNTER_TTL = 2 * 86400
+# Callers whose budget was not checked for this long stop being refreshed from the shared counters
+SHARED_REFRESH_IDLE = 600
+# In-memory budget totals kept before the oldest sessions are forgotten (and re-read when needed)
+MAX_TOTALS = 10000
+
+class BudgetExceeded(Exception):
+    """El cliente o la sesión agotaron su presupuesto de uso"""
+
+class Caller:
+    """Cliente y sesión MCP a los que se atribuye el uso de una llamada, y su clase de prioridad"""
+
+    def __init__(self, client: str = "anonymous", session: str = "", priority: str = ""):
+        self.client = client or "anonymous"
+        self.session = session
+        self.priority = priority
+
+def today(now: Optional[float] = None) -> str:
+    """Día UTC (YYYY-MM-DD) de un instante"""
+    return datetime.fromtimestamp(now if now is not None else time.time(), timezone.utc).strftime("%Y-%m-%d")
+
+def total_tokens(usage: Dict) -> int:
+    return sum(int(usage.get(field) or 0) for field in TOKEN_FIELDS)
+
+class PriceTable:
+    """Precios por modelo para estimar el coste en USD de cada respuesta"""
+
+    def __init__(self, overrides: Optional[Dict[str, List[float]]] = None):
+        self.prices = [(name, float(prices[0]), float(prices[1])) for name, prices in (overrides or {}).items()]
+        self.prices += DEFAULT_PRICES
+
+    def rates(self, model: str) -> Optional[Tuple[float, float]]:
+        for name, input_price, output_price in self.prices:
+            if name in model:
+                return input_price, output_price
+        return None
+
+    def cost(self, model: str, usage: Dict) -> float:
+        """Coste en USD del bloque usage (0 si el modelo no tiene precio conocido)"""
+        rates = self.rates(model)
+        if rates is None:
+            return 0.0
+        input_price, output_price = rates
+        return (
+            int(usage.get("input_tokens") or 0) * input_price
+            + int(usage.get("cache_creation_input_tokens") or 0) * input_price * CACHE_WRITE_FACTOR
+            + int(usage.get("cache_read_input_tokens") or 0) * input_price * CACHE_READ_FACTOR
+            + int(usage.get("output_tokens") or 0) * output_price
+        ) / 1_000_000
+
+class Budgets:
+    """
+    Presupuestos de uso.
+
+    Args:
+        client_tokens: Tokens diarios por cliente (0 = sin límite)
+        client_usd: Coste diario en USD por cliente (0 = sin límite)
+        session_tokens: Tokens totales por sesión (0 = sin límite)
+        overrides: Presupuestos por cliente {"cliente": {"tokens": N, "usd": X}}
+    """
+
+    def __init__(self, client_tokens: int = 0, client_usd: float = 0, session_tokens: int = 0, overrides: Optional[Dict[str, Dict]] = None):
+        self.client_tokens = client_tokens
+        self.client_usd = client_usd
+        self.session_tokens = session_tokens
+        self.overrides = overrides or {}
+
+    def for_client(self, client: str) -> Dict:
+        override = self.overrides.get(client, {})
+        return {
+            "tokens_per_day": int(override.get("tokens", self.client_tokens)),
+            "usd_per_day": float(override.get("usd", self.client_usd)),
+            "session_tokens": int(override.get("session_tokens", self.session_tokens)),
+        }
+
+class UsageLedger:
+    """
+    Registro de uso en SQLite.
+
+    Cada llamada añade una fila; `compact()` sustituye las filas más
+    antiguas que `compact_after` segundos por una fila por (cliente, sesión,
+    modelo, día) con los totales, de modo que las sumas no cambian.
+
+    Nada de SQLite corre en el bucle de eventos: las filas se acumulan en
+    memoria y un hilo propio las escribe en lote cada `flush_interval`
+    segundos (o al juntarse `flush_rows`), y ese mismo hilo compacta. Los
+    presupuestos se comprueban contra totales diarios por cliente y por
+    sesión que se mantienen en memoria; se leen de la base de datos solo la
+    primera vez que se consulta cada cliente o sesión.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        prices: Optional[PriceTable] = None,
+        budgets: Optional[Budgets] = None,
+        compact_after: float = 3600,
+        compact_every: int = 1000,
+        flush_interval: float = 0.5,
+        flush_rows: int = 500,
+    ):
+        self.path = path
+        self.prices = prices or PriceTable()
+        self.budgets = budgets or Budgets()
+        self.compact_after = compact_after
+        self.compact_every = compact_every
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.since_compaction = 0
+        self.rejected = 0
+        self.write_errors = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        # Every SQLite statement runs here, in submission order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="usage-ledger")
+        self.pending: List[Tuple] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # (column, value, day) -> [tokens, cost]; usage recorded while a key is being loaded goes to `loading`
+        self.totals: Dict[Tuple[str, str, str], List[float]] = {}
+        self.loading: Dict[Tuple[str, str, str], List[float]] = {}
+        self._loads: Dict[Tuple[str, str, str], Future] = {}
+        self.shared: Optional[state_backend.StateBackend] = None
+        self.sync_interval = 0.25
+        self._sync_task: Optional[asyncio.Task] = None
+        # Latest value of each shared counter and when a budget check last needed it
+        self.shared_used: Dict[str, float] = {}
+        self.shared_wanted: Dict[str, float] = {}
+
+    def attach(self, backend: state_backend.StateBackend, interval: float) -> None:
+        """Cuenta el uso de todas las réplicas en los presupuestos, leyendo `backend` cada `interval` segundos"""
+        self.shared = backend
+        self.sync_interval = interval
+
+    def start(self) -> None:
+        if self.shared is not None and self._sync_task is None:
+            self._sync_task = asyncio.create_task(self._sync_loop())
+
+    async def stop(self) -> None:
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            try:
+                await self._sync_task
+            except asyncio.CancelledError:
+                pass
+            self._sync_task = None
+        await asyncio.wrap_future(self._flush())
+
+    async def sync(self, now: Optional[float] = None) -> None:
+        """Lee los contadores compartidos que usaron los presupuestos recientemente (en un mismo lote)"""
+        now = now if now is not None else time.time()
+        for key, wanted in list(self.shared_wanted.items()):
+            if wanted < now - SHARED_REFRESH_IDLE:
+                del self.shared_wanted[key]
+                self.shared_used.pop(key, None)
+        keys = list(self.shared_wanted)
+        values = await asyncio.gather(*(self.shared.get(key) for key in keys))
+        for key, value in zip(keys, values):
+            if value is not None:
+                self.shared_used[key] = float(value)
+
+    async def load(self, caller: Caller, now: Optional[float] = None) -> None:
+        """Lee (en el hilo del registro) los totales del cliente y la sesión que aún no están en memoria"""
+        for key in self._keys(caller, today(now)):
+            future = self._seed(key)
+            if future is not None:
+                # A failed read is raised (and forgotten) by the check that consumes it
+                await asyncio.wait([asyncio.wrap_future(future)])
+
+    async def check_async(self, caller: Caller, now: Optional[float] = None) -> None:
+        """
+        Como check, pero sin bloquear el bucle: la primera vez que esta
+        réplica ve al cliente o la sesión lee antes sus totales de la base de
+        datos y sus contadores compartidos (después los mantiene frescos la
+        sincronización en segundo plano).
+
+        Raises:
+            BudgetExceeded: si el cliente o la sesión ya agotaron su presupuesto
+        """
+        now = now if now is not None else time.time()
+        budget = self.budgets.for_client(caller.client)
+        if budget["tokens_per_day"] or budget["usd_per_day"] or (budget["session_tokens"] and caller.session):
+            await self.load(caller, now)
+        if self.shared is not None:
+            keys = self._shared_keys(caller, today(now))
+            if not (budget["tokens_per_day"] or budget["usd_per_day"]):
+                keys.pop("tokens"), keys.pop("cost")
+            if not budget["session_tokens"]:
+                keys.pop("session", None)
+            unknown = [key for key in keys.values() if key not in self.shared_used]
+            values = await asyncio.gather(*(self.shared.get(key) for key in unknown))
+            for key, value in zip(unknown, values):
+                self.shared_used[key] = float(value) if value is not None else 0.0
+        self.check(caller, now)
+
+    async def _sync_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            await self.sync()
+
+    @staticmethod
+    def _keys(caller: Caller, day: str) -> List[Tuple[str, str, str]]:
+        keys = [("client", caller.client, day)]
+        if caller.session:
+            keys.append(("session", caller.session, ""))
+        return keys
+
+    @staticmethod
+    def _shared_keys(caller: Caller, day: str) -> Dict[str, str]:
+        keys = {"tokens": f"usage:{day}:client:{caller.client}:tokens", "cost": f"usage:{day}:client:{caller.client}:usd"}
+        if caller.session:
+            keys["session"] = f"usage:session:{caller.session}:tokens"
+        return keys
+
+    def _shared(self, key: str, now: float) -> float:
+        """Último valor conocido de un contador compartido (0 hasta la primera lectura)"""
+        self.shared_wanted[key] = now
+        return self.shared_used.get(key, 0.0)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Conexión SQLite (solo desde el hilo del registro); se abre y se crea el esquema la primera vez que se usa"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                " ts REAL NOT NULL, day TEXT NOT NULL, client TEXT NOT NULL, session TEXT NOT NULL, model TEXT NOT NULL,"
+                " calls INTEGER NOT NULL, input_tokens INTEGER NOT NULL, output_tokens INTEGER NOT NULL,"
+                " cache_creation_input_tokens INTEGER NOT NULL, cache_read_input_tokens INTEGER NOT NULL, cost_usd REAL NOT NULL);"
+                "CREATE INDEX IF NOT EXISTS usage_client_day ON usage (client, day);"
+                "CREATE INDEX IF NOT EXISTS usage_session ON usage (session);"
+                "CREATE INDEX IF NOT EXISTS usage_ts ON usage (ts);"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def record(self, caller: Caller, model: str, usage: Optional[Dict], now: Optional[float] = None) -> float:
+        """Anota el uso de una respuesta (se escribe en segundo plano) y retorna su coste en USD"""
+        if not usage:
+            return 0.0
+        now = now if now is not None else time.time()
+        day = today(now)
+        cost = self.prices.cost(model, usage)
+        self.pending.append((now, day, caller.client, caller.session, model, 1, *(int(usage.get(f) or 0) for f in TOKEN_FIELDS), cost))
+        for key in self._keys(caller, day):
+            totals = self.totals.get(key) or self.loading.get(key)
+            if totals is not None:
+                totals[0] += total_tokens(usage)
+                totals[1] += cost
+        if self.shared is not None:
+            keys = self._shared_keys(caller, day)
+            self.shared.add(keys["tokens"], total_tokens(usage), SHARED_COUNTER_TTL)
+            self.shared.add(keys["cost"], cost, SHARED_COUNTER_TTL)
+            if "session" in keys:
+                self.shared.add(keys["session"], total_tokens(usage), SHARED_COUNTER_TTL)
+
+        self.since_compaction += 1
+        if len(self.pending) >= self.flush_rows:
+            self._flush()
+        elif self._flush_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self._flush()
+            else:
+                self._flush_handle = loop.call_later(self.flush_interval, self._flush)
+        return cost
+
+    def _flush(self) -> Future:
+        """Pasa las filas pendientes (y la compactación, si toca) al hilo del registro"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        rows, self.pending = self.pending, []
+        compact = self.since_compaction >= self.compact_every
+        if compact:
+            self.since_compaction = 0
+        return self._executor.submit(self._write, rows, compact)
+
+    def _write(self, rows: List[Tuple], compact: bool) -> None:
+        try:
+            if rows:
+                with self.conn:
+                    self.conn.executemany(
+                        "INSERT INTO usage (ts, day, client, session, model, calls, " + ", ".join(TOKEN_FIELDS) + ", cost_usd)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        rows,
+                    )
+            if compact:
+                self._compact(time.time())
+        except sqlite3.Error as e:
+            self.write_errors += 1
+            print(f"⚠️  No se pudo escribir el registro de uso en {self.path}: {e}", file=sys.stderr)
+
+    def _query(self, fn, *args) -> Future:
+        """Ejecuta una consulta en el hilo del registro, después de escribir lo pendiente"""
+        self._flush()
+        return self._executor.submit(fn, *args)
+
+    def flush(self) -> None:
+        """Espera a que las filas pendientes estén escritas"""
+        self._flush().result()
+
+    def _seed(self, key: Tuple[str, str, str]) -> Optional[Future]:
+        """Lectura en curso del total de `key` (None si ya está en memoria)"""
+        if key in self.totals:
+            return None
+        future = self._loads.get(key)
+        if future is None:
+            # Rows recorded from now on are not part of the query: they are added on top of its result
+            self.loading[key] = [0, 0.0]
+            future = self._loads[key] = self._query(self._used, *key)
+        return future
+
+    def _total(self, key: Tuple[str, str, str]) -> List[float]:
+        """Total en memoria de `key`; si aún no se leyó, espera a la lectura (bloqueando)"""
+        future = self._seed(key)
+        if future is not None:
+            try:
+                tokens, cost = future.result()
+            finally:
+                del self._loads[key]
+                delta = self.loading.pop(key)
+            self.totals[key] = [tokens + delta[0], cost + delta[1]]
+            self._prune(key)
+        return self.totals[key]
+
+    def _prune(self, key: Tuple[str, str, str]) -> None:
+        """Olvida los totales de días pasados y, pasado el máximo, los de las sesiones más antiguas"""
+        if key[0] == "client":
+            for stale in [k for k in self.totals if k[0] == "client" and k[2] != key[2]]:
+                del self.totals[stale]
+        elif len(self.totals) > MAX_TOTALS:
+            for stale in [k for k in self.totals if k[0] == "session"][: len(self.totals) - MAX_TOTALS]:
+                del self.totals[stale]
+
+    def compact(self, now: Optional[float] = None) -> int:
+        """Agrega las filas antiguas por (cliente, sesión, modelo, día); retorna cuántas filas se eliminaron"""
+        self.since_compaction = 0
+        return self._query(self._compact, now if now is not None else time.time()).result()
+
+    def _compact(self, now: float) -> int:
+        cutoff = now - self.compact_after
+        with self.conn:
+            rows = self.conn.execute(
+                "SELECT MAX(ts), day, client, session, model, SUM(calls), "
+                + ", ".join(f"SUM({f})" for f in TOKEN_FIELDS)
+                + ", SUM(cost_usd), COUNT(*) FROM usage WHERE ts < ? GROUP BY client, session, model, day",
+                (cutoff,),
+            ).fetchall()
+            before = sum(row[-1] for row in rows)
+            if before == len(rows):
+                return 0
+            self.conn.execute("DELETE FROM usage WHERE ts < ?", (cutoff,))
+            self.conn.executemany(
+                "INSERT INTO usage (ts, day, client, session, model, calls, " + ", ".join(TOKEN_FIELDS) + ", cost_usd)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [row[:-1] for row in rows],
+            )
+        return before - len(rows)
+
+    def summary(self, group_by: str = "model", client: str = "", session: str = "", model: str = "", since_day: str = "") -> List[Dict]:
+        """
+        Totales de uso agrupados por `group_by` (client, session, model o day).
+
+        Los filtros vacíos no se aplican; `since_day` (YYYY-MM-DD) limita a
+        partir de ese día incluido.
+        """
+        return self._query(self._summary, group_by, client, session, model, since_day).result()
+
+    async def summary_async(self, group_by: str = "model", client: str = "", session: str = "", model: str = "", since_day: str = "") -> List[Dict]:
+        """Como summary, sin bloquear el bucle de eventos"""
+        return await asyncio.wrap_future(self._query(self._summary, group_by, client, session, model, since_day))
+
+    def _summary(self, group_by: str, client: str, session: str, model: str, since_day: str) -> List[Dict]:
+        if group_by not in GROUP_COLUMNS:
+            raise ValueError(f"group_by inválido: '{group_by}' (usa {', '.join(GROUP_COLUMNS)})")
+        conditions, params = [], []
+        for column, value in (("client", client), ("session", session), ("model", model)):
+            if value:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if since_day:
+            conditions.append("day >= ?")
+            params.append(since_day)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        rows = self.conn.execute(
+            f"SELECT {group_by}, SUM(calls), " + ", ".join(f"SUM({f})" for f in TOKEN_FIELDS)
+            + f", SUM(cost_usd) FROM usage{where} GROUP BY {group_by} ORDER BY SUM(cost_usd) DESC, {group_by}",
+            params,
+        ).fetchall()
+        return [
+            {group_by: row[0], "calls": row[1], **dict(zip(TOKEN_FIELDS, row[2:6])), "cost_usd": round(row[6], 6)}
+            for row in rows
+        ]
+
+    def _used(self, column: str, value: str, day: str = "") -> Tuple[int, float]:
+        query = "SELECT " + " + ".join(f"COALESCE(SUM({f}), 0)" for f in TOKEN_FIELDS) + f", COALESCE(SUM(cost_usd), 0) FROM usage WHERE {column} = ?"
+        params = [value]
+        if day:
+            query += " AND day = ?"
+            params.append(day)
+        tokens, cost = self.conn.execute(query, params).fetchone()
+        return int(tokens), float(cost)
+
+    def remaining(self, caller: Caller, now: Optional[float] = None) -> Dict:
+        """Uso de hoy del cliente (y total de la sesión) frente a sus presupuestos"""
+        budget = self.budgets.for_client(caller.client)
+        now = now if now is not None else time.time()
+        tokens, cost = self._total(("client", caller.client, today(now)))
+        keys = self._shared_keys(caller, today(now)) if self.shared is not None else {}
+        if keys:
+            tokens = max(tokens, self._shared(keys["tokens"], now))
+            cost = max(cost, self._shared(keys["cost"], now))
+        status = {
+            "client": caller.client,
+            "tokens_today": int(tokens),
+            "cost_usd_today": round(cost, 6),
+            "tokens_per_day": budget["tokens_per_day"] or None,
+            "usd_per_day": budget["usd_per_day"] or None,
+        }
+        if caller.session:
+            status["session"] = caller.session
+            status["session_tokens"] = int(self._total(("session", caller.session, ""))[0])
+            if keys:
+                status["session_tokens"] = int(max(status["session_tokens"], self._shared(keys["session"], now)))
+            status["session_token_budget"] = budget["session_tokens"] or None
+        return status
+
+    def check(self, caller: Caller, now: Optional[float] = None) -> None:
+        """
+        Comprueba los presupuestos del cliente y la sesión antes de llamar a la API.
+
+        Raises:
+            BudgetExceeded: si el cliente o la sesión ya agotaron su presupuesto
+        """
+        budget = self.budgets.for_client(caller.client)
+        now = now if now is not None else time.time()
+        keys = self._shared_keys(caller, today(now)) if self.shared is not None else {}
+        if budget["tokens_per_day"] or budget["usd_per_day"]:
+            tokens, cost = self._total(("client", caller.client, today(now)))
+            if keys:
+                # Local rows are part of the shared total, which may lag by one sync interval
+                tokens = max(tokens, self._shared(keys["tokens"], now))
+                cost = max(cost, self._shared(keys["cost"], now))
+            if budget["tokens_per_day"] and tokens >= budget["tokens_per_day"]:
+                self.rejected += 1
+                raise BudgetExceeded(f"el cliente '{caller.client}' agotó su presupuesto diario de {budget['tokens_per_day']} tokens")
+            if budget["usd_per_day"] and cost >= budget["usd_per_day"]:
+                self.rejected += 1
+                raise BudgetExceeded(f"el cliente '{caller.client}' agotó su presupuesto diario de {budget['usd_per_day']:g} USD")
+        if budget["session_tokens"] and caller.session:
+            tokens = self._total(("session", caller.session, ""))[0]
+            if keys:
+                tokens = max(tokens, self._shared(keys["session"], now))
+            if tokens >= budget["session_tokens"]:
+                self.rejected += 1
+                raise BudgetExceeded(f"la sesión '{caller.session}' agotó su presupuesto de {budget['session_tokens']} tokens")
+
+    def stats(self) -> Dict:
+        return self._query(self._stats).result()
+
+    async def stats_async(self) -> Dict:
+        """Como stats, sin bloquear el bucle de eventos"""
+        return await asyncio.wrap_future(self._query(self._stats))
+
+    def _stats(self) -> Dict:
+        rows, calls, cost = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(calls), 0), COALESCE(SUM(cost_usd), 0) FROM usage").fetchone()
+        today_cost = self.conn.execute("SELECT COALESCE(SUM(cost_usd), 0) FROM usage WHERE day = ?", (today(),)).fetchone()[0]
+        return {
+            "path": self.path,
+            "rows": rows,
+            "calls": calls,
+            "cost_usd": round(cost, 6),
+            "cost_usd_today": round(today_cost, 6),
+            "rejected": self.rejected,
+            "write_errors": self.write_errors,
+            "shared_counters": len(self.shared_wanted),
+        }
+
+
+def ledger_from_env() -> Optional[UsageLedger]:
+    """
+    Crea el registro de uso a partir de las variables de entorno.
+
+    Retorna None si CLAUDE_USAGE_ENABLED es "false".
+    """
+    if os.environ.get("CLAUDE_USAGE_ENABLED", "true").lower() in ("0", "false", "no"):
+        return None
+
+    return UsageLedger(
+        os.environ.get("CLAUDE_USAGE_DB", "usage_ledger.db"),
+        prices=PriceTable(json.loads(os.environ.get("CLAUDE_PRICES", "{}"))),
+        budgets=Budgets(
+            client_tokens=int(os.environ.get("CLAUDE_BUDGET_CLIENT_TOKENS", 0)),
+            client_usd=float(os.environ.get("CLAUDE_BUDGET_CLIENT_USD", 0)),
+            session_tokens=int(os.environ.get("CLAUDE_BUDGET_SESSION_TOKENS", 0)),
+            overrides=json.loads(os.environ.get("CLAUDE_BUDGETS", "{}")),
+        ),
+        compact_after=float(os.environ.get("CLAUDE_USAGE_COMPACT_AFTER", 3600)),
+        compact_every=int(os.environ.get("CLAUDE_USAGE_COMPACT_EVERY", 1000)),
+        flush_interval=float(os.environ.get("CLAUDE_USAGE_FLUSH_INTERVAL", 0.5)),
+        flush_rows=int(os.environ.get("CLAUDE_USAGE_FLUSH_ROWS", 500)),
+    )